@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+
+from chodewars import game,metrics
+from chodewars.population import PopulationTable
+from chodewars.player import Player
+from chodewars.planet import Planet
+from chodewars.ship import Ship
+
+#Scenarios in the order they run, signup builds the players the others use
+scenario_names = ["signup","warps","moves","land_takeoff","page_view","tick"]
+
+config_template = """[database]
+type = %(database)s
+location = %(location)s
+name = bench
+codec = %(codec)s
+
+[log]
+level = error
+
+[cache]
+size = %(cache_size)s
+
+[universe]
+cluster_size = %(cluster_size)s
+clusters = %(clusters)s
+"""
+
+class Timer(object):
+  """Time each operation of a scenario, along with the storage reads and writes it makes."""
+  def __init__(self,name,cold = False,game_obj = None):
+    self.name = name
+    self.cold = cold
+    self.game = game_obj
+    self.times = []
+    self.reads = 0
+    self.writes = 0
+
+  def run(self,fn,*args,**kwargs):
+    if self.cold:
+      self.game.cache.clear()
+    metrics.begin_request()
+    start = time.time()
+    try:
+      return fn(*args,**kwargs)
+    finally:
+      self.times.append(time.time() - start)
+      reads,writes = metrics.end_request()
+      self.reads += reads
+      self.writes += writes
+
+  def result(self):
+    """Return the scenario's timings as a dictionary, times are in milliseconds."""
+    times = sorted(self.times)
+    count = len(times)
+    if not count:
+      return {'operations': 0}
+    percentile = lambda p: times[min(count - 1,int(p * count))] * 1000
+    return {
+      'operations': count,
+      'seconds': sum(times),
+      'ops_per_second': count / sum(times) if sum(times) else None,
+      'mean_ms': sum(times) / count * 1000,
+      'p50_ms': percentile(0.5),
+      'p95_ms': percentile(0.95),
+      'p99_ms': percentile(0.99),
+      'max_ms': times[-1] * 1000,
+      'reads_per_op': float(self.reads) / count,
+      'writes_per_op': float(self.writes) / count,
+    }
+
+def create_game(args,location):
+  """Create a game with a new universe in location, configured from the command line arguments."""
+  config_file = os.path.join(location,"bench.cfg")
+  with open(config_file,'w') as f:
+    f.write(config_template % {
+      'database': args.database,
+      'location': os.path.join(location,"data"),
+      'codec': args.codec,
+      'cache_size': args.cache_size,
+      'cluster_size': args.cluster_size,
+      'clusters': ",".join("cluster%s" % i for i in xrange(args.clusters)),
+    })
+  return game.Game(config_file = config_file)
+
+def generate_universe(game_obj,args,timer):
+  """Sign up args.players players, then scatter args.planets planets and args.ships ships over random sectors.
+
+  Returns the list of players."""
+  players = []
+  for i in xrange(args.players):
+    player = game_obj.add_player(Player(initial_state = {'id':"player%s@bench" % i,'name':"Player %s" % i}))
+    if not timer.run(game_obj.assign_home_sector,player,"Home %s" % i,"Ship %s" % i):
+      print "Universe is full after %s players" % i
+      break
+    players.append(player)
+
+  #Planets and ships that don't belong to anyone, added a batch of sectors at a time
+  extras = [Planet(initial_state = {'name':"Planet %s" % i}) for i in xrange(args.planets)]
+  extras += [Ship(initial_state = {'name':"Derelict %s" % i}) for i in xrange(args.ships)]
+  sector_count = args.cluster_size * args.cluster_size
+  for i in xrange(0,len(extras),100):
+    batch = extras[i:i + 100]
+    names = ["%s-%s" % (random.choice(game_obj.cluster_list),random.randint(1,sector_count)) for entity in batch]
+    for sector,entity in zip(game_obj.get_sectors(names),batch):
+      game_obj.assign_child(sector,entity)
+  return players
+
+def run_warps(game_obj,players,timer,operations):
+  for i in xrange(operations):
+    ship = game_obj.get_parent(random.choice(players))
+    timer.run(game_obj.get_available_warps,ship = ship,read_only = True)
+
+def run_moves(game_obj,players,timer,operations):
+  """Move random ships to a random neighbouring sector."""
+  for i in xrange(operations):
+    ship = game_obj.get_parent(random.choice(players))
+    warps = game_obj.get_available_warps(ship = ship,read_only = True)
+    if warps:
+      timer.run(game_obj.move_ship,ship,random.choice(warps))
+
+def run_land_takeoff(game_obj,players,timer,operations):
+  """Land random ships on a planet in their sector and take off again, landing and taking off are each an operation."""
+  for i in xrange(operations):
+    ship = game_obj.get_parent(random.choice(players))
+    sector = game_obj.get_parent(ship)
+    planets = [child for child in game_obj.get_children(sector) if child.type == "Planet"]
+    if not planets:
+      continue
+    timer.run(game_obj.move_ship,ship,random.choice(planets))
+    timer.run(game_obj.move_ship,ship,sector)
+
+def run_page_view(game_obj,players,timer,operations):
+  """Load everything the index page renders, the way MainHandler does."""
+  for i in xrange(operations):
+    player = random.choice(players)
+    timer.run(lambda: game_obj.get_view(game_obj.get_player_by_id(player.id)))
+
+def run_tick(args,timer):
+  """Time population ticks over args.tick_planets planets held in columns, without saving them."""
+  table = PopulationTable()
+  table.extend(xrange(args.tick_planets),[1000] * args.tick_planets,[random.randint(-5,10) for i in xrange(args.tick_planets)])
+  for i in xrange(10):
+    timer.run(table.tick)
+
+def run(args):
+  random.seed(args.seed)
+  location = tempfile.mkdtemp(prefix = "chodewars-bench-")
+  try:
+    start = time.time()
+    game_obj = create_game(args,location)
+    timers = dict((name,Timer(name,cold = args.cold,game_obj = game_obj)) for name in scenario_names)
+    players = generate_universe(game_obj,args,timers['signup'])
+    generated = time.time() - start
+    if players:
+      run_warps(game_obj,players,timers['warps'],args.operations)
+      run_moves(game_obj,players,timers['moves'],args.operations)
+      run_land_takeoff(game_obj,players,timers['land_takeoff'],args.operations)
+      run_page_view(game_obj,players,timers['page_view'],args.operations)
+    if args.tick_planets:
+      run_tick(args,timers['tick'])
+
+    return {
+      'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+      'python': platform.python_version(),
+      'settings': dict((key,value) for key,value in vars(args).items() if key != 'output'),
+      'universe': {
+        'players': len(players),
+        'sectors': args.clusters * args.cluster_size * args.cluster_size,
+        'generate_seconds': generated,
+      },
+      'cache': {'size': len(game_obj.cache),'hits': game_obj.cache.hits,'misses': game_obj.cache.misses},
+      'scenarios': dict((name,timer.result()) for name,timer in timers.items()),
+    }
+  finally:
+    if args.keep:
+      print "Universe kept in %s" % location
+    else:
+      shutil.rmtree(location)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = 'Time game operations against a generated universe.')
+  parser.add_argument('--database', default = 'file', choices = ['file','sqlite','log'], help = 'Database type to store the universe in.')
+  parser.add_argument('--codec', default = 'json', choices = ['json','binary'], help = 'Codec objects are stored with.')
+  parser.add_argument('--clusters', type = int, default = 1, help = 'Number of clusters.')
+  parser.add_argument('--cluster-size', type = int, default = 10, help = 'Width and height of each cluster in sectors.')
+  parser.add_argument('--players', type = int, default = 20, help = 'Number of players to sign up, each gets a home planet and ship.')
+  parser.add_argument('--planets', type = int, default = 50, help = 'Number of extra planets placed in random sectors.')
+  parser.add_argument('--ships', type = int, default = 50, help = 'Number of extra ships placed in random sectors.')
+  parser.add_argument('--operations', type = int, default = 200, help = 'Number of operations timed in each scenario.')
+  parser.add_argument('--tick-planets', type = int, default = 100000, help = 'Number of planets in the population tick scenario, 0 skips it.')
+  parser.add_argument('--cache-size', type = int, default = 1000, help = 'Number of objects the game caches.')
+  parser.add_argument('--cold', action = 'store_true', help = 'Clear the cache before each operation.')
+  parser.add_argument('--seed', type = int, default = 1, help = 'Random seed, so runs can be compared.')
+  parser.add_argument('--keep', action = 'store_true', help = 'Keep the generated universe instead of deleting it.')
+  parser.add_argument('--output', default = 'bench_output.txt', help = 'File the JSON results are written to, - for stdout only.')
+  args = parser.parse_args()
+
+  results = run(args)
+  output = json.dumps(results,indent = 2,sort_keys = True)
+  if args.output != '-':
+    with open(args.output,'w') as f:
+      f.write(output + "\n")
+  print output
+
+  for name in scenario_names:
+    result = results['scenarios'][name]
+    if result['operations']:
+      sys.stderr.write("%-13s %6s ops  mean %8.3fms  p95 %8.3fms  %6.2f reads/op  %6.2f writes/op\n" % (name,result['operations'],result['mean_ms'],result['p95_ms'],result['reads_per_op'],result['writes_per_op']))
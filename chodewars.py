@@ -2,16 +2,28 @@ import tornado.ioloop
 import tornado.web
 import tornado.auth
 import tornado.escape
+import tornado.gen
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
+import tornado.websocket
+import tornado.log
 import os.path
 import logging
 import datetime
+import time
 import sys
 import argparse
 
+from concurrent.futures import ThreadPoolExecutor
 from tornado.options import define,options
-from chodewars.game import Game
+from chodewars.game import Game,read_config
+from chodewars.shard import Router
+from chodewars.notify import Notifier
+from chodewars.feed import Feed
 from chodewars.player import Player
 from chodewars.planet import Planet
+from chodewars import metrics
 
 define("port", default=9000, help="run on the given port", type=int)
 
@@ -19,6 +31,12 @@ version = "0.0"
 
 game = None
 
+#Game calls read and write storage, so they run here instead of on the IOLoop thread
+executor = None
+
+#Moves made by this process's game, pushed to the WebSockets watching the places they affect
+feed = None
+
 class Application(tornado.web.Application):
   def __init__(self):
     handlers=[
@@ -27,6 +45,9 @@ class Application(tornado.web.Application):
       (r"/logout", LogoutHandler),
       (r"/add/([\w]*)", AddHandler),
       (r"/c/([\w]*)/", CommandHandler),
+      (r"/ws", SocketHandler),
+      (r"/api/commands", BatchHandler),
+      (r"/metrics", MetricsHandler),
     ]
     
     settings = dict(
@@ -38,7 +59,8 @@ class Application(tornado.web.Application):
     )
     tornado.web.Application.__init__(self,handlers,**settings)
 
-class BaseHandler(tornado.web.RequestHandler):
+class UserMixin(object):
+  """The logged in user, from the cookie set by LoginHandler, for page handlers and WebSockets."""
   def get_current_user(self):
     user_json = self.get_secure_cookie("user")
     """user_json is of the form:
@@ -49,29 +71,54 @@ class BaseHandler(tornado.web.RequestHandler):
     u'name': u'Matthew Parlette'}"""
     if not user_json: return None
     return tornado.escape.json_decode(user_json)
+
+class BaseHandler(UserMixin,tornado.web.RequestHandler):
+  def initialize(self):
+    #Objects read from and written to storage by this request's game calls
+    self.storage_reads = 0
+    self.storage_writes = 0
+  
+  def run_game(self,fn,*args,**kwargs):
+    """Run a blocking game call on the storage executor, returning a Future to yield."""
+    return executor.submit(self._count_storage,fn,*args,**kwargs)
   
+  def _count_storage(self,fn,*args,**kwargs):
+    """Run a game call, adding the storage reads and writes it makes to this request's counts."""
+    metrics.begin_request()
+    try:
+      return fn(*args,**kwargs)
+    finally:
+      reads,writes = metrics.end_request()
+      self.storage_reads += reads
+      self.storage_writes += writes
+  
+  def on_finish(self):
+    metrics.record_request(self.__class__.__name__,self.request.request_time(),self.storage_reads,self.storage_writes)
+  
+  @tornado.gen.coroutine
   def get_current_player(self):
-    if not self.current_user: return None
-    if not game: return None
+    if not self.current_user: raise tornado.gen.Return(None)
+    if not game: raise tornado.gen.Return(None)
     if 'email' in self.current_user:
-      return game.get_player_by_id(self.current_user['email'])
+      player = yield self.run_game(game.get_player_by_id,self.current_user['email'])
+      raise tornado.gen.Return(player)
     else:
       #If email doesn't exist in the cookie, then it needs to be refreshed
       self.clear_cookie('user')
       self.redirect("/")
-    return None
+    raise tornado.gen.Return(None)
 
 class MainHandler(BaseHandler):
   @tornado.web.authenticated
+  @tornado.gen.coroutine
   def get(self):
-    player = self.get_current_player()
+    player = yield self.get_current_player()
     if not player:
       self.redirect("/add/player")
+      return
     
-    ship = game.get_parent(player) if player else None
-    if player: print "player loaded as %s" % str(player.to_dict())
-    if ship: print "ship loaded as %s" % str(ship.to_dict())
-    render_location = game.get_parent(ship) if ship else None
+    #Everything the templates need is loaded up front, so rendering doesn't touch the database
+    view = yield self.run_game(game.get_view,player)
     
     #for line in game.visualize_cluster(player):
       #print "%s\n" % line
@@ -82,10 +129,7 @@ class MainHandler(BaseHandler):
       header_text = "Heading",
       footer_text = "Chodewars",
       user = self.current_user,
-      player = player,
-      ship = ship,
-      render_location = render_location,
-      game = game,
+      view = view,
     )
 
 class LoginHandler(BaseHandler, tornado.auth.GoogleMixin):
@@ -119,57 +163,46 @@ class AddHandler(BaseHandler):
       add_type = add_type,
     )
   
+  @tornado.gen.coroutine
   def post(self,add_type):
     if game:
       if add_type == "player":
         name = self.get_argument('name','')
         print "Creating new player %s..." % name
-        if game.add_player(Player(initial_state = {'id':self.current_user['email'],'name':name})):
-          print "Player %s created" % name
-          planet_name = self.get_argument('planet_name',None)
-          ship_name = self.get_argument('ship_name',None)
-          if planet_name and ship_name:
-            player = self.get_current_player()
-            print "Creating home sector..."
-            if game.assign_home_sector(player,planet_name,ship_name):
-              print "...ok"
-            else:
-              print "Error assigning home sector for %s" % str(player)
-          else:
-            print "planet_name or ship_name was not received, nothing was created for this player"
-        else:
-          print "Error creating player %s" % name
+        player = yield self.run_game(game.sign_up,
+                                     self.current_user['email'],
+                                     name,
+                                     planet_name = self.get_argument('planet_name',None),
+                                     ship_name = self.get_argument('ship_name',None))
+        print "Player %s created" % name if player else "Error creating player %s" % name
     else:
       print "Game is not initialized!"
         
     self.redirect("/")
 
 class CommandHandler(BaseHandler):
+  @tornado.gen.coroutine
   def get(self,command):
     print "cmd: %s" % str(command)
-    player = self.get_current_player()
-    if game:
-      if command == "move":
-        print "\n\n---------------------"
-        sector_id = self.get_argument("sector",default = None, strip = True)
-        if sector_id:
-          sector = game.load_object_by_id(sector_id)
-          print "sector loaded as %s" % str(sector)
-          if sector:
-            print "Moving player"
-            game.move_ship(game.get_parent(player),sector)
-      if command in ("land"):
-        target_id = self.get_argument("target",default = None, strip = True)
-        if target_id:
-          target = game.load_object_by_id(target_id)
-          if target:
-            print "Landing on %s" % str(target)
-            game.move_ship(game.get_parent(player),target)
-      if command in ("takeoff"):
-        ship = game.get_parent(player)
-        current_ship_location = game.get_parent(ship)
-        if current_ship_location.type in ("Planet"):
-          game.move_ship(ship,game.get_parent(current_ship_location))
+    player = yield self.get_current_player()
+    if game and command == "scan":
+      scan = yield self.run_game(game.scan,player,target_id = self.get_argument("target",default = None, strip = True))
+      if scan:
+        self.render(
+          "scan.html",
+          page_title = "Scan of %s" % scan.centre,
+          header_text = "Scan",
+          footer_text = "Chodewars",
+          user = self.current_user,
+          scan = scan,
+        )
+        return
+    elif game:
+      yield self.run_game(game.run_command,
+                          player,
+                          command,
+                          sector_id = self.get_argument("sector",default = None, strip = True),
+                          target_id = self.get_argument("target",default = None, strip = True))
     else:
       self.write("Game not initialized")
     
@@ -178,27 +211,226 @@ class CommandHandler(BaseHandler):
   def post(self,command,argument):
     pass
 
+class BatchHandler(BaseHandler):
+  """Carries out a list of commands, or flies the player's ship to a destination, in one request.
+  
+  The body is JSON, either {"commands": [{"command": "move", "sector": "alpha-5"}, ...]} or
+  {"destination": "alpha-57"}. Commands stop at the first one that fails. The response has the number
+  of commands carried out (hops for a destination) and the player's location afterwards."""
+  max_commands = 100
+  
+  @tornado.web.authenticated
+  @tornado.gen.coroutine
+  def post(self):
+    try:
+      body = tornado.escape.json_decode(self.request.body)
+    except ValueError:
+      body = None
+    commands = body.get('commands') if isinstance(body,dict) else None
+    destination = body.get('destination') if isinstance(body,dict) else None
+    if not destination and not (isinstance(commands,list) and all(isinstance(c,dict) for c in commands)):
+      self.send_error(400)
+      return
+    if commands and len(commands) > self.max_commands:
+      self.set_status(400)
+      self.write({'error': "At most %s commands can be sent at once" % self.max_commands})
+      return
+    player = None
+    if 'email' in self.current_user:
+      player = yield self.get_current_player()
+    if not player:
+      self.send_error(403)
+      return
+    
+    result = {}
+    if destination:
+      route = yield self.run_game(game.autopilot,player,destination)
+      result['ok'] = route is not None
+      result['done'] = len(route) if route else 0
+      result['route'] = route or []
+    else:
+      done = yield self.run_game(game.run_commands,player,commands)
+      result['ok'] = done == len(commands)
+      result['done'] = done
+    
+    player = yield self.run_game(game.get_player_by_id,player.id)
+    view = yield self.run_game(game.get_view,player)
+    result['location'] = {'id': str(view.location.id),'name': str(view.location),'type': view.location.type} if view.location else None
+    result['children'] = [{'id': str(c.id),'name': c.name,'type': c.type} for c in view.children]
+    result['warps'] = [str(s) for s in view.warps]
+    self.write(result)
+
+class SocketHandler(UserMixin,tornado.websocket.WebSocketHandler):
+  """Carries out move, land and takeoff commands sent as JSON, and pushes changes to the player's location.
+  
+  Commands look like {"command": "move", "sector": "alpha-5"} or {"command": "land", "target": planet id}.
+  Each command is answered with a result event. The socket is sent entered and left events when something
+  arrives at or leaves the player's location, and a warps event with the new location when their ship moves."""
+  commands = ("move","land","takeoff")
+  
+  def open(self):
+    #Ids of the player's ship and location, which this socket is subscribed to
+    self.subscriptions = []
+    self.location_id = None
+    if not game or not self.current_user or 'email' not in self.current_user:
+      self.close()
+      return
+    self.start_refresh()
+  
+  def on_close(self):
+    self.subscribe([])
+  
+  @tornado.gen.coroutine
+  def on_message(self,message):
+    start = time.time()
+    try:
+      command = tornado.escape.json_decode(message)
+    except ValueError:
+      command = None
+    if not isinstance(command,dict) or command.get('command') not in self.commands:
+      self.send({'event': 'error','message': "Commands are JSON objects with a command of %s" % ", ".join(self.commands)})
+      return
+    done,reads,writes = yield executor.submit(self._run_command,
+                                              self.current_user['email'],
+                                              command['command'],
+                                              sector_id = command.get('sector'),
+                                              target_id = command.get('target'))
+    self.send({'event': 'result','command': command['command'],'ok': bool(done)})
+    metrics.record_request(self.__class__.__name__,time.time() - start,reads,writes)
+  
+  def _run_command(self,player_id,command,sector_id = None,target_id = None):
+    """Load the player and carry out a command on the storage executor, returning (result, reads, writes)."""
+    metrics.begin_request()
+    try:
+      player = game.get_player_by_id(player_id)
+      done = game.run_command(player,command,sector_id = sector_id,target_id = target_id) if player else False
+    finally:
+      reads,writes = metrics.end_request()
+    return (done,reads,writes)
+  
+  def start_refresh(self):
+    """Refresh without waiting for it, logging anything that goes wrong since nothing yields the Future."""
+    tornado.ioloop.IOLoop.current().add_future(self.refresh(),self._refreshed)
+  
+  def _refreshed(self,future):
+    if future.exception():
+      tornado.log.app_log.error("SocketHandler.refresh(): Error refreshing the location",exc_info = future.exc_info())
+  
+  @tornado.gen.coroutine
+  def refresh(self):
+    """Send the player's location with its warps if it has changed, and watch it for changes."""
+    player = yield executor.submit(game.get_player_by_id,self.current_user['email'])
+    if not player:
+      return
+    view = yield executor.submit(game.get_view,player)
+    if not view.location or str(view.location.id) == self.location_id:
+      return
+    self.location_id = str(view.location.id)
+    self.subscribe([str(view.ship.id),self.location_id])
+    self.send({'event': 'warps',
+               'location': self.location_id,
+               'warps': [str(s) for s in view.warps],
+               'html': self.render_string("location.html",view = view)})
+  
+  def subscribe(self,ids):
+    if not feed:
+      return
+    for id in self.subscriptions:
+      feed.unsubscribe(id,self.on_update)
+    self.subscriptions = ids
+    for id in ids:
+      feed.subscribe(id,self.on_update)
+  
+  def on_update(self,event,location,entity):
+    """Called on the IOLoop by the feed when something enters or leaves the location, or the ship moves."""
+    if event == "moved":
+      self.start_refresh()
+    elif str(location.id) == self.location_id:
+      self.send({'event': event,
+                 'location': self.location_id,
+                 'entity': {'id': str(entity.id),'name': entity.name,'type': entity.type},
+                 'html': self.render_string("entity-panel.html",entity = entity)})
+  
+  def send(self,message):
+    if self.ws_connection:
+      self.write_message(tornado.escape.json_encode(message))
+
+class MetricsHandler(tornado.web.RequestHandler):
+  """Storage counts and latency histograms in the Prometheus text format."""
+  def get(self):
+    self.set_header("Content-Type","text/plain; version=0.0.4")
+    self.write(metrics.registry.render())
+
+def start_ticks(ticking_game):
+  """Run the game's population tick on the storage executor every tick_seconds, skipping a tick if the last one is still running."""
+  running = []
+  def tick():
+    if running and not running[0].done():
+      ticking_game.log.warning("start_ticks(): The last population tick is still running, skipping this one")
+      return
+    running[:] = [executor.submit(ticking_game.tick)]
+  tornado.ioloop.PeriodicCallback(tick,ticking_game.tick_seconds * 1000).start()
+
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='Process command line options.')
   parser.add_argument('--bigbang', action='store_true', help='Execute a Big Bang, this deletes an existing universe and creates a new one.')
+  parser.add_argument('--storage-threads', type=int, default=4, help='Number of threads that run game storage calls.')
+  parser.add_argument('--processes', type=int, default=1, help='Number of processes serving requests on the port, 0 starts one for each CPU.')
+  parser.add_argument('--shards', type=int, default=0, help='Number of worker processes to share the clusters between (sqlite only), 0 runs the game in this process.')
   parser.add_argument('--version', action='version', version='Chodewars v'+version)
   args = parser.parse_args()
   
-  print "Creating game object..."
-  game = Game()
-  if game:
-    print "...ok"
-  else:
-    print "error initializing game"
+  if args.processes != 1 and args.shards:
+    print "--processes and --shards can't be used together"
+    sys.exit(1)
+  if args.processes != 1 and read_config("chodewars.cfg").get('database','type') == "log":
+    print "The log database can only be used by one process, use --processes 1"
     sys.exit(1)
   
   if args.bigbang:
     print "Executing Big Bang..."
-    game.big_bang()
+    Game().big_bang()
     print "...ok"
     sys.exit(0)
   
+  #Processes are forked before the game is created, so each one opens its own database connections
+  sockets = tornado.netutil.bind_sockets(options.port)
+  if args.processes != 1:
+    tornado.process.fork_processes(args.processes)
+  
+  if args.shards:
+    #The workers run their own games, this process only routes calls to them
+    print "Starting worker processes..."
+    game = Router(workers = args.shards)
+    if not game.start():
+      print "error starting worker processes"
+      sys.exit(1)
+  else:
+    print "Creating game object..."
+    game = Game()
+    if game:
+      print "...ok"
+    else:
+      print "error initializing game"
+      sys.exit(1)
+    if args.processes != 1:
+      #Objects saved by one process are dropped from the caches of the others
+      game.listen_for_changes(Notifier(os.path.join(game.db.location,"%s.notify" % game.db.name)))
+    metrics.add_cache_metrics(game.cache)
+  
+  #Moves are pushed to WebSockets from the IOLoop, the game (or the router, for moves the workers make)
+  #calls the feed on the storage executor
+  feed = Feed(deliver = tornado.ioloop.IOLoop.instance().add_callback)
+  game.add_listener(feed.moved)
+  
+  #Only one process ticks, the others drop the objects it saves from their caches. The workers don't tick
+  if not args.shards and game.population_mode == "tick" and game.tick_seconds and not tornado.process.task_id():
+    start_ticks(game)
+  
+  #Each worker process answers one call at a time, so more threads than workers lets them all run at once
+  executor = ThreadPoolExecutor(max_workers = max(args.storage_threads,args.shards))
+  
   print "Game created, listening for connections..."
-  app = Application()
-  app.listen(options.port)
+  server = tornado.httpserver.HTTPServer(Application())
+  server.add_sockets(sockets)
   tornado.ioloop.IOLoop.instance().start()
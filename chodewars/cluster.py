@@ -1,10 +1,58 @@
+import random
+
 from entity import Entity
 
+#Neighbour tables for each cluster geometry, keyed by (x, y)
+neighbor_tables = {}
+
+def neighbor_table(x,y):
+  """Return a tuple of the neighbouring sector numbers of every sector in an x by y cluster.
+  
+  Sectors are numbered from 1 across each row of x sectors, so the table is indexed by sector number
+  (index 0 is unused). Neighbours are listed nw, n, ne, e, se, s, sw, w. Tables are built once per geometry."""
+  x = int(x)
+  y = int(y)
+  if (x,y) not in neighbor_tables:
+    table = [()]
+    for sector_number in xrange(1,x * y + 1):
+      row = (sector_number - 1) // x
+      column = (sector_number - 1) % x
+      neighbors = []
+      for row_offset,column_offset in ((-1,-1),(-1,0),(-1,1),(0,1),(1,1),(1,0),(1,-1),(0,-1)):
+        if 0 <= row + row_offset < y and 0 <= column + column_offset < x:
+          neighbors.append(sector_number + row_offset * x + column_offset)
+      table.append(tuple(neighbors))
+    neighbor_tables[(x,y)] = tuple(table)
+  return neighbor_tables[(x,y)]
+
 class Cluster(Entity):
-  def __init__(self,initial_state = {}):
-    super(Cluster,self).__init__(initial_state = initial_state)
-    self.x = initial_state['x'] if 'x' in initial_state else 10
-    self.y = initial_state['y'] if 'y' in initial_state else 10
+  fields = Entity.fields + (
+    ('x',10,None),
+    ('y',10,None),
+    #Sector numbers that can still be used as a home sector, None until the list is first built
+    ('free_sectors',None,None),
+  )
+  __slots__ = ('x','y','free_sectors')
   
   def __repr__(self):
-    return "%s (%s x %s)" % (self.name,self.x,self.y)
+    return "%s (%s x %s)" % (super(Cluster,self).__repr__(),self.x,self.y)
+  
+  def neighbors(self,sector_number):
+    """Return the sector numbers next to the given sector."""
+    return neighbor_table(self.x,self.y)[int(sector_number)]
+  
+  def build_free_sectors(self,occupied = []):
+    """Build the list of free sectors, which is every sector number not in occupied."""
+    occupied = set(int(sector_number) for sector_number in occupied)
+    self.free_sectors = [n for n in xrange(1,int(self.x) * int(self.y) + 1) if n not in occupied]
+  
+  def allocate_sector(self):
+    """Remove a random sector number from the free list and return it.
+    
+    The chosen number is swapped with the last one so it can be removed in constant time.
+    Returns None if there are no free sectors left."""
+    if not self.free_sectors:
+      return None
+    i = random.randrange(len(self.free_sectors))
+    self.free_sectors[i],self.free_sectors[-1] = self.free_sectors[-1],self.free_sectors[i]
+    return self.free_sectors.pop()
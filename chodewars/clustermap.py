@@ -0,0 +1,90 @@
+import threading
+
+class ClusterMap(object):
+  """Map tiles of each cluster, drawn from a SpatialIndex and cached.
+
+  A tile is one character for what is in a sector: . for nothing, P for planets, S for ships, * for both
+  and + for anything else. moved() is a Game listener, added after the spatial index's, which marks the
+  tiles of the sectors an object left and entered so only they are drawn again, and changed() does the
+  same for sectors another process changed. Rows of tiles are kept as strings, and a row is only joined
+  again when one of its tiles changed. A cluster's tiles are all drawn again when the spatial index
+  rebuilds the cluster."""
+  empty,planet,ship,both,other = ".","P","S","*","+"
+
+  def __init__(self,spatial):
+    self.spatial = spatial
+    #Cluster name to [x, y, generation of the index, tiles by sector number, row strings], None for ones to draw
+    self.clusters = {}
+    self.lock = threading.Lock()
+
+    #Counters
+    self.drawn = 0
+
+  def moved(self,child,parent,previous_parent):
+    self.changed([(sector.cluster_name,int(sector.name)) for sector in (parent,previous_parent) if sector and sector.type == "Sector"])
+
+  def changed(self,sectors):
+    """Mark the tiles of a list of (cluster name, sector number) to be drawn again, such as sectors another process changed."""
+    with self.lock:
+      for cluster_name,number in sectors:
+        cached = self.clusters.get(cluster_name)
+        if cached:
+          cached[3][number] = None
+          cached[4][(number - 1) // cached[0]] = None
+
+  def _cluster(self,cluster_name):
+    """Return the cached map of a cluster, starting a new one if the spatial index was built since. None if it isn't indexed."""
+    geometry = self.spatial.geometry(cluster_name)
+    if not geometry:
+      self.clusters.pop(cluster_name,None)
+      return None
+    x,y,generation = geometry
+    cached = self.clusters.get(cluster_name)
+    if not cached or cached[2] != generation:
+      cached = self.clusters[cluster_name] = [x,y,generation,[None] * (x * y + 1),[None] * y]
+    return cached
+
+  def _tile(self,cluster_name,cached,number):
+    tile = cached[3][number]
+    if tile is None:
+      types = self.spatial.types_at(cluster_name,number)
+      planets = "Planet" in types
+      ships = "Ship" in types
+      if planets and ships:
+        tile = self.both
+      elif planets:
+        tile = self.planet
+      elif ships:
+        tile = self.ship
+      elif types:
+        tile = self.other
+      else:
+        tile = self.empty
+      cached[3][number] = tile
+      self.drawn += 1
+    return tile
+
+  def lines(self,cluster_name):
+    """Return the rows of a cluster's map as strings of tiles separated by spaces, or None if it isn't indexed."""
+    with self.lock:
+      cached = self._cluster(cluster_name)
+      if not cached:
+        return None
+      x,y,generation,tiles,rows = cached
+      for row in xrange(y):
+        if rows[row] is None:
+          rows[row] = " ".join(self._tile(cluster_name,cached,row * x + column + 1) for column in xrange(x))
+      return list(rows)
+
+  def window(self,cluster_name,sector_number,radius):
+    """Return the tiles within radius of a sector as rows of (sector number, tile), or None if it isn't indexed.
+
+    Only the tiles in the window are looked at, so the cost doesn't depend on the size of the cluster."""
+    with self.lock:
+      cached = self._cluster(cluster_name)
+      if not cached:
+        return None
+      x,y = cached[0],cached[1]
+      row,column = (sector_number - 1) // x,(sector_number - 1) % x
+      return [[(r * x + c + 1,self._tile(cluster_name,cached,r * x + c + 1)) for c in xrange(max(0,column - radius),min(x,column + radius + 1))]
+              for r in xrange(max(0,row - radius),min(y,row + radius + 1))]
@@ -0,0 +1,212 @@
+import re
+import json
+import struct
+import binascii
+
+from entity import Entity
+from player import Player
+from cluster import Cluster
+from planet import Planet
+from sector import Sector
+from ship import Ship
+
+#Type name to the class objects of that type are created as
+types = {}
+
+def register(cls,type_name = None):
+  """Add a class to the type registry, so objects saved with its type are loaded as it."""
+  types[type_name or cls.__name__] = cls
+  return cls
+
+for cls in (Entity,Cluster,Sector,Player,Planet,Ship):
+  register(cls)
+
+def object_from_dict(d):
+  """Create a game object of the right class from its dictionary, unknown types are loaded as an Entity."""
+  return types.get(d.get('type'),Entity)(initial_state = d)
+
+class JsonCodec(object):
+  """Store dictionaries as compact JSON."""
+  name = "json"
+
+  def encode(self,d):
+    return json.dumps(d,separators = (',',':'))
+
+  def decode(self,data):
+    return json.loads(data)
+
+class BinaryCodec(object):
+  """Store dictionaries in a compact binary format, similar to msgpack, built on struct.
+
+  Encoded data starts with the magic byte, which JSON never starts with. Each value is a tag byte followed
+  by its data. Small integers fit in the tag, ids are stored as their 16 bytes instead of 36 characters,
+  and dictionary keys that are in the keys table are stored as their position in it. Lists that are all
+  ids (children) or all integers (free sectors) are stored as one packed block."""
+  name = "binary"
+  magic = "\xc1"
+
+  #Field names stored as their position in this list, names must only ever be appended to it
+  keys = ['id','name','type','parent','children','landable','tradeable','dockable','scanable','habitable',
+          'version','population','population_growth','cluster_name','holds','x','y','free_sectors',
+          'population_time']
+
+  #Tags, 0x00-0x7f are the integers 0 to 127 and 0xe0-0xff are -32 to -1
+  NONE,FALSE,TRUE = "\xc0","\xc2","\xc3"
+  STR8,STR32,UUID,INT,FLOAT,LIST,DICT = "\xc4","\xc5","\xc6","\xd3","\xcb","\xdd","\xdf"
+  UUID_LIST,INT_LIST = "\xd4","\xd5"
+
+  uuid_pattern = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+  length = struct.Struct(">I")
+
+  def __init__(self):
+    self.key_positions = dict((key,i) for i,key in enumerate(self.keys))
+    self.int_struct = struct.Struct(">q")
+    self.float_struct = struct.Struct(">d")
+    #Tag byte to the method that reads that kind of value
+    self.readers = {
+      self.NONE: lambda data,pos: (None,pos),
+      self.FALSE: lambda data,pos: (False,pos),
+      self.TRUE: lambda data,pos: (True,pos),
+      self.STR8: self._read_str8,
+      self.STR32: self._read_str32,
+      self.UUID: self._read_uuid,
+      self.INT: self._read_int,
+      self.FLOAT: self._read_float,
+      self.LIST: self._read_list,
+      self.UUID_LIST: self._read_uuid_list,
+      self.INT_LIST: self._read_int_list,
+      self.DICT: self._read_dict,
+    }
+
+  def encode(self,d):
+    out = [self.magic]
+    self._write(d,out)
+    return "".join(out)
+
+  def decode(self,data):
+    if data[:1] != self.magic:
+      raise ValueError("Data does not start with the binary codec's magic byte")
+    return self._read(data,1)[0]
+
+  def _write(self,value,out):
+    if value is None:
+      out.append(self.NONE)
+    elif value is True:
+      out.append(self.TRUE)
+    elif value is False:
+      out.append(self.FALSE)
+    elif isinstance(value,(int,long)):
+      if 0 <= value < 0x80 or -32 <= value < 0:
+        out.append(chr(value & 0xff))
+      else:
+        out.append(self.INT + self.int_struct.pack(value))
+    elif isinstance(value,float):
+      out.append(self.FLOAT + self.float_struct.pack(value))
+    elif isinstance(value,basestring):
+      if len(value) == 36 and self.uuid_pattern.match(value):
+        out.append(self.UUID + binascii.unhexlify(value.replace("-","")))
+        return
+      #str is already bytes (UTF-8 from the web handlers), only unicode needs encoding
+      s = value.encode('utf-8') if isinstance(value,unicode) else value
+      if len(s) < 0x100:
+        out.append(self.STR8 + chr(len(s)) + s)
+      else:
+        out.append(self.STR32 + self.length.pack(len(s)) + s)
+    elif isinstance(value,(list,tuple)):
+      if value and all(isinstance(item,basestring) and len(item) == 36 and self.uuid_pattern.match(item) for item in value):
+        out.append(self.UUID_LIST + self.length.pack(len(value)))
+        out.append(binascii.unhexlify("".join(value).replace("-","")))
+        return
+      if value and all(type(item) is int and -0x80000000 <= item < 0x80000000 for item in value):
+        out.append(self.INT_LIST + self.length.pack(len(value)) + struct.pack(">%si" % len(value),*value))
+        return
+      out.append(self.LIST + self.length.pack(len(value)))
+      for item in value:
+        self._write(item,out)
+    elif isinstance(value,dict):
+      out.append(self.DICT + self.length.pack(len(value)))
+      for key,item in value.items():
+        position = self.key_positions.get(key)
+        if position is not None:
+          self._write(position,out)
+        else:
+          self._write(key,out)
+        self._write(item,out)
+    else:
+      raise TypeError("%s can not be stored by the binary codec" % repr(value))
+
+  def _read(self,data,pos):
+    tag = data[pos]
+    reader = self.readers.get(tag)
+    if reader:
+      return reader(data,pos + 1)
+    n = ord(tag)
+    if n < 0x80:
+      return n,pos + 1
+    if n >= 0xe0:
+      return n - 0x100,pos + 1
+    raise ValueError("Unknown tag %s at position %s" % (hex(n),pos))
+
+  def _read_str8(self,data,pos):
+    end = pos + 1 + ord(data[pos])
+    return data[pos + 1:end].decode('utf-8'),end
+
+  def _read_str32(self,data,pos):
+    end = pos + 4 + self.length.unpack_from(data,pos)[0]
+    return data[pos + 4:end].decode('utf-8'),end
+
+  def _read_uuid(self,data,pos):
+    h = binascii.hexlify(data[pos:pos + 16])
+    return u"%s-%s-%s-%s-%s" % (h[:8],h[8:12],h[12:16],h[16:20],h[20:]),pos + 16
+
+  def _read_int(self,data,pos):
+    return self.int_struct.unpack_from(data,pos)[0],pos + 8
+
+  def _read_float(self,data,pos):
+    return self.float_struct.unpack_from(data,pos)[0],pos + 8
+
+  def _read_list(self,data,pos):
+    count = self.length.unpack_from(data,pos)[0]
+    pos += 4
+    items = []
+    for i in xrange(count):
+      item,pos = self._read(data,pos)
+      items.append(item)
+    return items,pos
+
+  def _read_uuid_list(self,data,pos):
+    count = self.length.unpack_from(data,pos)[0]
+    pos += 4
+    h = binascii.hexlify(data[pos:pos + count * 16])
+    return [u"%s-%s-%s-%s-%s" % (h[i:i + 8],h[i + 8:i + 12],h[i + 12:i + 16],h[i + 16:i + 20],h[i + 20:i + 32]) for i in xrange(0,len(h),32)],pos + count * 16
+
+  def _read_int_list(self,data,pos):
+    count = self.length.unpack_from(data,pos)[0]
+    pos += 4
+    return list(struct.unpack_from(">%si" % count,data,pos)),pos + count * 4
+
+  def _read_dict(self,data,pos):
+    count = self.length.unpack_from(data,pos)[0]
+    pos += 4
+    d = {}
+    for i in xrange(count):
+      key,pos = self._read(data,pos)
+      if isinstance(key,int):
+        key = self.keys[key]
+      d[key],pos = self._read(data,pos)
+    return d,pos
+
+#Codec name to codec
+codecs = dict((codec.name,codec) for codec in (JsonCodec(),BinaryCodec()))
+
+def get_codec(name):
+  """Return the codec with the given name, or None if there isn't one."""
+  return codecs.get(name)
+
+def decode(data):
+  """Decode data written by any codec, using the first byte to tell which one wrote it.
+
+  This is what lets a database switch codecs, objects are read in whichever format they were saved in."""
+  if isinstance(data,str) and data[:1] == BinaryCodec.magic:
+    return codecs['binary'].decode(data)
+  return codecs['json'].decode(data)
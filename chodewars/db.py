@@ -3,13 +3,53 @@ import logging
 import random
 import shutil
 import json
+import sqlite3
+import struct
+import threading
+import zlib
 
+import metrics
+from journal import Journal,GroupCommit,ConflictError
+from codec import object_from_dict,get_codec,decode
+from entity import Entity
 from player import Player
 from cluster import Cluster
 from planet import Planet
 from sector import Sector
 from ship import Ship
 
+class Transaction(object):
+  """Collect objects during a unit of work, and save them all together when it is committed.
+  
+  Used as a context manager, the objects are committed if the block finishes without an exception.
+  The database can be anything with a save_objects() method."""
+  def __init__(self,database):
+    self.db = database
+    self.objects = []
+    self.committed = False
+  
+  def __enter__(self):
+    return self
+  
+  def __exit__(self,exc_type,exc_value,traceback):
+    if exc_type is None:
+      self.commit()
+    return False
+  
+  def save(self,obj):
+    """Add an object to be saved when the transaction is committed."""
+    if not any(o is obj for o in self.objects):
+      self.objects.append(obj)
+  
+  def rollback(self):
+    """Discard the objects, so nothing is saved when the transaction finishes."""
+    self.objects = []
+  
+  def commit(self):
+    """Save every object in one atomic operation. Returns a boolean on if it was successful."""
+    self.committed = all(self.db.save_objects(self.objects)) if self.objects else True
+    return self.committed
+
 class Database(object):
   """This is a base class which defines the methods that need to be implemented for database operations.
   
@@ -18,7 +58,7 @@ class Database(object):
   
   To program the game to support any of the databases, only the methods defined in the Database base class should be used to avoid any database-specific code."""
   
-  def __init__(self,name,location):
+  def __init__(self,name,location,codec = "json"):
     #Setup logging for this module
     self.create_logger("chodewars.db.%s" % self.__class__.__name__)
     
@@ -27,6 +67,12 @@ class Database(object):
     
     #Location of the database (server address, file path)
     self.location = location
+    
+    #Codec objects are saved with, objects saved with any codec can still be loaded
+    self.codec = get_codec(codec)
+    if not self.codec:
+      self.log.error("Unknown codec %s, saving objects as json" % codec)
+      self.codec = get_codec("json")
   
   def create_logger(self,name):
     self.log = logging.getLogger(name)
@@ -80,6 +126,47 @@ class Database(object):
     This may be slower depending on database type."""
     return None
   
+  def save_objects(self,objs):
+    """Save a list of game objects to the database in one operation.
+    
+    Returns the list of saved objects (None for any that failed). Databases should override this
+    to save the whole list atomically, and to write several objects faster than one at a time.
+    
+    Each object's version must match the version in the database (compare and swap), and is increased by one
+    when it is saved. If any object is out of date, nothing is saved and ConflictError is raised."""
+    return [self.save_object(obj) for obj in objs]
+  
+  def transaction(self):
+    """Return a Transaction, which saves all of the objects added to it atomically."""
+    return Transaction(self)
+  
+  def bulk_load(self,batches):
+    """Write batches (lists) of new objects into a universe that was just created by big_bang().
+    
+    This is for creating a whole universe at once, so databases should override it to write as fast as they can.
+    There are no version checks, and a crash part way through can leave some of the objects written,
+    so the big bang has to be run again. Returns the number of objects written."""
+    count = 0
+    for batch in batches:
+      count += len([obj for obj in self.save_objects(batch) if obj])
+    return count
+  
+  def load_objects(self,ids):
+    """Load a list of objects in one operation.
+    
+    Returns a list in the same order as ids, with None for any object that does not exist."""
+    return [self.load_object(id) for id in ids]
+  
+  def refresh(self,ids):
+    """Called with the ids of objects another process saved, for databases that keep anything about them in memory."""
+    return True
+  
+  def load_objects_by_name(self,names):
+    """Load a list of objects by name in one operation.
+    
+    Returns a list in the same order as names, with None for any object that does not exist."""
+    return [self.load_object_by_name(name) for name in names]
+  
   def add_player(self,player):
     """Add a player to the database."""
     return self.save_object(player)
@@ -124,7 +211,69 @@ class Database(object):
     """Retrieve a ship from the database with the given name."""
     return None
   
+  #Serialization helpers
+  
+  def _encode(self,obj):
+    """Convert an object to the bytes it is stored as, using this database's codec."""
+    return self.codec.encode(obj.to_dict())
+  
+  def _decode(self,data):
+    """Create an object from stored bytes, whichever codec they were written with."""
+    return object_from_dict(decode(data))
+  
+  def _name_key(self,name):
+    """Return a name as unicode, the form names are indexed and looked up in.
+    
+    Names come from players as unicode and from str literals as UTF-8, and the codecs give back unicode."""
+    return name.decode('utf-8') if isinstance(name,str) else unicode(name)
+  
+  #Name index helpers, for databases that keep a name index in memory
+  
+  def _index_keys(self,obj):
+    """Return the list of names that an object can be looked up by."""
+    keys = [self._name_key(obj.name)]
+    if obj.type == "Sector":
+      keys.append(u"%s-%s" % (self._name_key(obj.cluster_name),keys[0]))
+    return keys
+  
+  def _reset_index(self):
+    """Clear the in-memory name index."""
+    #Name (or cluster-N sector name) to object id
+    self.names = {}
+    #Object id to the names that point to it, used to drop old names when an object is renamed
+    self.named_ids = {}
+  
+  def _index_object(self,obj):
+    """Add an object's names to the in-memory name index.
+    
+    Returns True if the index changed and needs to be written to disk."""
+    id = str(obj.id)
+    keys = self._index_keys(obj)
+    previous_keys = self.named_ids.get(id)
+    if previous_keys == keys:
+      return False
+    for key in previous_keys or []:
+      if self.names.get(key) == id:
+        del self.names[key]
+    self.named_ids[id] = keys
+    for key in keys:
+      #The first object saved with a name owns it
+      self.names.setdefault(key,id)
+    return True
+  
 class FlatFileDatabase(Database):
+  def __init__(self,name,location,codec = "json"):
+    super(FlatFileDatabase,self).__init__(name = name,location = location,codec = codec)
+    
+    #The name index is kept next to the data directory so it is never mistaken for an object
+    self.index_path = os.path.join(self.location,"%s.index" % self.name)
+    self.index_lock = threading.RLock()
+    self._reset_index()
+    
+    #Saves go through a journal so a list of objects is replaced all at once
+    self.journal_path = os.path.join(self.location,"%s.journal" % self.name)
+    self.journal = None
+  
   def db_exists(self):
     if self.path:
       if os.path.exists(self.path):
@@ -142,30 +291,56 @@ class FlatFileDatabase(Database):
       os.makedirs(self.path)
       
     if os.path.exists(self.path):
+      self.journal = Journal(self.journal_path,self.path,current_version = self._stored_version)
+      replayed = self.journal.open()
+      if replayed:
+        self.log.info("Replayed %s objects from the journal %s" % (len(replayed),self.journal_path))
+      
       if self.is_empty():
         self.log.info("Universe appears to be empty, executing Big Bang.")
         return self.big_bang()
+      if not self._load_index():
+        self.log.info("Name index is missing or stale, rebuilding it.")
+        self._rebuild_index()
+      elif replayed:
+        for o in self.load_objects(replayed):
+          if o: self._index_object(o)
+        self._write_index()
       return True
     else:
       self.log.error("Database directory (%s) could not be created" % self.path)
       return False
   
   def big_bang(self):
-    """Delete all of the files in the directory."""
-    if self.path:
-      if os.path.exists(self.path):
-        self.log.debug("Removing directory (%s) contents" % self.path)
-        for f in os.listdir(self.path):
-          if os.path.isdir(os.path.join(self.path,f)):
-            shutil.rmtree(os.path.join(self.path,f))
-          else:
-            os.remove(os.path.join(self.path,f))
-      else:
-        self.log.debug("Path %s does not exist, creating it..." % self.path)
-        os.makedirs(self.path)
-    else:
+    """Delete all of the files in the directory.
+    
+    The journal is locked throughout, so no commit from this or another process lands part way through."""
+    if not self.path:
       self.log.error("FlatFileDatabase instance variable 'path' is not defined")
       return False
+    with self.index_lock:
+      if not self.journal:
+        return self._clear()
+      with self.journal.locked():
+        return self._clear()
+  
+  def _clear(self):
+    if os.path.exists(self.path):
+      self.log.debug("Removing directory (%s) contents" % self.path)
+      for f in os.listdir(self.path):
+        if os.path.isdir(os.path.join(self.path,f)):
+          shutil.rmtree(os.path.join(self.path,f))
+        else:
+          os.remove(os.path.join(self.path,f))
+    else:
+      self.log.debug("Path %s does not exist, creating it..." % self.path)
+      os.makedirs(self.path)
+    
+    #Start with an empty name index, and make sure nothing from the old universe is replayed
+    self._reset_index()
+    self._replace_index()
+    if self.journal:
+      self.journal.checkpoint()
     
     #Create the universe
     ##nothing to do yet
@@ -192,74 +367,181 @@ class FlatFileDatabase(Database):
   
   def save_object(self,obj):
     """Save a game object to the database."""
-    self.log.debug("Saving object: %s" % str(obj))
-    return obj if self._write_json(obj,str(obj.id)) else None
+    return self.save_objects([obj])[0]
   
   def load_object(self,id):
     """Load an object and return it."""
     if os.path.exists(os.path.join(self.path,str(id))):
-      return self._read_json(str(id))
+      return self._read_object(str(id))
+  
+  def save_objects(self,objs):
+    """Save a list of game objects atomically through the journal, writing the name index once for the whole list."""
+    files = {}
+    versions = {}
+    for obj in objs:
+      self.log.debug("Saving object: %s",obj)
+      versions[str(obj.id)] = obj.version
+      obj.version += 1
+      files[str(obj.id)] = self._encode(obj)
+    try:
+      self.journal.commit(files,versions)
+    except ConflictError:
+      for obj in objs:
+        obj.version -= 1
+      raise
+    except (IOError,OSError),e:
+      for obj in objs:
+        obj.version -= 1
+      self.log.error("save_objects(): Error committing %s: %s" % (str(objs),e))
+      return [None for obj in objs]
+    metrics.wrote(len(objs))
+    
+    with self.index_lock:
+      index_changed = False
+      for obj in objs:
+        index_changed = self._index_object(obj) or index_changed
+      if index_changed:
+        self._write_index()
+    return list(objs)
+  
+  def bulk_load(self,batches):
+    """Write each object's file directly instead of through the journal, and write the name index once at the end.
+    
+    The files are not fsynced, the big bang has to be run again if the machine crashes while it runs."""
+    count = 0
+    with self.index_lock:
+      for batch in batches:
+        for obj in batch:
+          obj.version += 1
+          with open(os.path.join(self.path,str(obj.id)),'wb') as f:
+            f.write(self._encode(obj))
+          self._index_object(obj)
+        metrics.wrote(len(batch))
+        count += len(batch)
+      self._write_index()
+    return count
+  
+  def load_objects(self,ids):
+    """Load a list of objects, skipping the existence check that load_object makes for each file."""
+    objs = []
+    for id in ids:
+      try:
+        objs.append(self._read_object(str(id)) if id else None)
+      except IOError:
+        objs.append(None)
+    return objs
+  
+  def refresh(self,ids):
+    """Add the names of new objects another process saved to the name index.
+    
+    Only objects that aren't in the index yet are read, objects aren't renamed once they are created."""
+    with self.index_lock:
+      new_ids = [id for id in ids if str(id) not in self.named_ids]
+      for obj in self.load_objects(new_ids):
+        if obj:
+          self._index_object(obj)
+    return True
+  
+  def load_objects_by_name(self,names):
+    """Load a list of objects by name, resolving all of the names through the name index first."""
+    return self.load_objects([self.names.get(self._name_key(name),"") for name in names])
   
   def load_object_by_name(self,name):
     """Load an object from the database by name.
     
-    This is slow for this database type."""
-    for f in os.listdir(self.path):
-      o = self.load_object(f)
-      self.log.debug("load_object() returned %s, checking it for name of %s" % (str(o),name))
-      
-      if o and o.name == name:
+    Names are resolved through the name index, sectors can also be found by their cluster-N name."""
+    id = self.names.get(self._name_key(name))
+    if id:
+      o = self.load_object(id)
+      if o:
         self.log.debug("load_object_by_name(): Found object %s matching name parameter of %s" % (str(o),name))
-        self.log.debug("load_object_by_name(): %s dictionary: %s" % (str(o),o.to_dict()))
         return o
-      else:
-        #Handle sectors
-        if o and o.type == "Sector" and "%s-%s" % (o.cluster_name,o.name) == name:
-          self.log.debug("load_object_by_name(): Found sector %s matching name parameter of %s" % (str(o),name))
-          return o
+      self.log.error("load_object_by_name(): Name index points %s to %s, but it could not be loaded" % (name,id))
     self.log.info("load_object_by_name(): No object found with name %s, returning None" % name)
     return None
   
-  def _write_json(self,obj,filename):
-    """Convert the object's dictionary into json."""
-    f = open(os.path.join(self.path,str(filename)),'w')
-    with f:
-      self.log.debug("Attempting to JSON-ify dictionary %s" % obj.to_dict())
-      s = json.dumps(obj.to_dict())
-      s = s.replace("True","true").replace("False","false")
-      self.log.debug("Attempting to write json %s to %s" % (s,f))
-      f.write(s)
-      f.close()
-      self.log.info("_write_json(): Wrote %s to %s" % (s,f))
-      return True
-    self.log.error("_write_json(): Error opening %s for writing" % os.path.join(self.path,filename))
-    return False
+  def _load_index(self):
+    """Load the name index from disk.
+    
+    Returns False if the index file is missing, unreadable, or does not match the number of objects in the database."""
+    self._reset_index()
+    if not os.path.exists(self.index_path):
+      return False
+    try:
+      with open(self.index_path,'r') as f:
+        index = json.loads(f.read())
+    except (IOError,ValueError),e:
+      self.log.error("_load_index(): Could not read %s: %s" % (self.index_path,e))
+      return False
+    if index.get('objects') != len(os.listdir(self.path)):
+      self.log.debug("_load_index(): %s lists %s objects, but %s exist" % (self.index_path,index.get('objects'),len(os.listdir(self.path))))
+      return False
+    self.names = index['names']
+    self.named_ids = index['ids']
+    self.log.debug("_load_index(): Loaded %s names from %s" % (len(self.names),self.index_path))
+    return True
   
-  def _read_json(self,filename):
-    """Read a file's content as json to create an object."""
-    self.log.debug("_read_file(): Opening %s for reading" % os.path.join(self.path,filename))
-    f = open(os.path.join(self.path,filename),'r')
-    with f:
-      json_str = f.read()
-      self.log.debug("JSON read from file as string: %s" % json_str)
-      try:
-        json_dict = json.loads(json_str)
-        self.log.debug("JSON converted to dictionary: %s" % str(json_dict))
-        #TODO: Can this be generic? To create a class from a variable?
-        if json_dict['type'] == "Cluster":
-          return Cluster(initial_state = json_dict)
-        elif json_dict['type'] == "Sector":
-          return Sector(initial_state = json_dict)
-        elif json_dict['type'] == "Player":
-          return Player(initial_state = json_dict)
-        elif json_dict['type'] == "Planet":
-          return Planet(initial_state = json_dict)
-        elif json_dict['type'] == "Ship":
-          return Ship(initial_state = json_dict)
-        else:
-          return Entity(initial_state = json_dict)
-      except TypeError,te:
-        self.log.error("File %s does not appear to be valid JSON: %s" % (filename,te))
+  def _rebuild_index(self):
+    """Rebuild the name index by reading every object in the database."""
+    self._reset_index()
+    for f in sorted(os.listdir(self.path)):
+      o = self.load_object(f)
+      if o:
+        self._index_object(o)
+    return self._write_index()
+  
+  def _write_index(self):
+    """Write the name index to disk.
+    
+    Other processes write the same file, so the names they added are read back into this index first,
+    while holding the journal lock. The index is written to a temporary file first and renamed over
+    the old one so it is never left half written."""
+    with self.index_lock:
+      if not self.journal:
+        return self._replace_index()
+      with self.journal.locked():
+        self._merge_index()
+        return self._replace_index()
+  
+  def _merge_index(self):
+    """Add the objects in the index on disk that this index doesn't have, objects aren't renamed once they are created."""
+    try:
+      with open(self.index_path,'r') as f:
+        index = json.loads(f.read())
+    except (IOError,ValueError):
+      return
+    for id,keys in index.get('ids',{}).items():
+      if id not in self.named_ids:
+        self.named_ids[id] = keys
+        for key in keys:
+          self.names.setdefault(key,id)
+  
+  def _replace_index(self):
+    index = {'objects': len(self.named_ids), 'names': self.names, 'ids': self.named_ids}
+    tmp_path = "%s.%s.tmp" % (self.index_path,os.getpid())
+    with open(tmp_path,'w') as f:
+      f.write(json.dumps(index))
+    os.rename(tmp_path,self.index_path)
+    self.log.debug("_write_index(): Wrote %s names to %s" % (len(self.names),self.index_path))
+    return True
+  
+  def _stored_version(self,filename):
+    """Return the version of an object as it is on disk, or 0 if it hasn't been saved."""
+    try:
+      with open(os.path.join(self.path,filename),'rb') as f:
+        return int(decode(f.read()).get('version',0))
+    except IOError:
+      return 0
+  
+  def _read_object(self,filename):
+    """Read a file's content to create an object."""
+    with open(os.path.join(self.path,filename),'rb') as f:
+      data = f.read()
+    metrics.read()
+    try:
+      return self._decode(data)
+    except (TypeError,ValueError),e:
+      self.log.error("File %s could not be decoded: %s" % (filename,e))
 
   def get_player(self,player_name):
     """Verify a player file exists and load that Player object."""
@@ -332,3 +614,506 @@ class FlatFileDatabase(Database):
       self.log.error("get_ship(): Database does not exist, aborting...")
       return None
   
+
+class SqliteDatabase(Database):
+  """Store every object in a single SQLite file.
+  
+  The columns the game looks objects up by (id, name, type, parent and cluster_name) are indexed,
+  and parent/child relationships are kept in their own table instead of in each object's data.
+  The database runs in WAL mode and each thread gets its own connection, so readers don't block each other."""
+  
+  #Number of ids to put in a single "IN (...)" query, SQLite allows at most 999 variables
+  batch_size = 500
+  
+  def __init__(self,name,location,codec = "json"):
+    super(SqliteDatabase,self).__init__(name = name,location = location,codec = codec)
+    self.path = os.path.join(self.location,"%s.sqlite" % self.name)
+    self.local = threading.local()
+  
+  def db_exists(self):
+    return os.path.exists(self.path)
+  
+  def connect(self):
+    """Open the SQLite file (creating it if needed) and make sure the tables exist."""
+    if not os.path.exists(self.location):
+      self.log.debug("Creating directory %s" % self.location)
+      os.makedirs(self.location)
+    
+    conn = self._connection()
+    with conn:
+      conn.execute("CREATE TABLE IF NOT EXISTS objects (id TEXT PRIMARY KEY, name TEXT, type TEXT, parent TEXT, cluster_name TEXT, data TEXT NOT NULL)")
+      conn.execute("CREATE INDEX IF NOT EXISTS objects_name ON objects (name)")
+      conn.execute("CREATE INDEX IF NOT EXISTS objects_type ON objects (type)")
+      conn.execute("CREATE INDEX IF NOT EXISTS objects_parent ON objects (parent)")
+      conn.execute("CREATE INDEX IF NOT EXISTS objects_sector ON objects (cluster_name, name)")
+      conn.execute("CREATE TABLE IF NOT EXISTS children (parent TEXT NOT NULL, child TEXT NOT NULL, position INTEGER NOT NULL, PRIMARY KEY (parent, child))")
+      #Databases created before objects had versions
+      if "version" not in [column[1] for column in conn.execute("PRAGMA table_info(objects)")]:
+        conn.execute("ALTER TABLE objects ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    
+    if self.is_empty():
+      self.log.info("Universe appears to be empty, executing Big Bang.")
+      return self.big_bang()
+    return True
+  
+  def big_bang(self):
+    """Delete every object and relationship."""
+    conn = self._connection()
+    with conn:
+      self.log.debug("Removing all objects from %s" % self.path)
+      conn.execute("DELETE FROM children")
+      conn.execute("DELETE FROM objects")
+    
+    #Create the universe
+    ##nothing to do yet
+    return True
+  
+  def is_empty(self):
+    return self._connection().execute("SELECT COUNT(*) FROM objects").fetchone()[0] == 0
+  
+  def save_object(self,obj):
+    """Save a game object to the database."""
+    return self.save_objects([obj])[0]
+  
+  def save_objects(self,objs):
+    """Save a list of game objects in a single SQLite transaction."""
+    conn = self._connection()
+    versions = [obj.version for obj in objs]
+    try:
+      with conn:
+        conflicts = []
+        for obj in objs:
+          self.log.debug("Saving object: %s",obj)
+          if not self._write_object(conn,obj):
+            conflicts.append(str(obj.id))
+        if conflicts:
+          #Leaving the with block by raising rolls the transaction back
+          raise ConflictError(conflicts)
+    except (ConflictError,sqlite3.Error),e:
+      for obj,version in zip(objs,versions):
+        obj.version = version
+      if isinstance(e,ConflictError):
+        raise
+      self.log.error("save_objects(): Error saving %s: %s" % (str(objs),e))
+      return [None for obj in objs]
+    metrics.wrote(len(objs))
+    return list(objs)
+  
+  def bulk_load(self,batches):
+    """Insert every batch in a single transaction, with one statement per batch for the objects and one for their children."""
+    conn = self._connection()
+    count = 0
+    with conn:
+      for batch in batches:
+        rows = []
+        children = []
+        for obj in batch:
+          obj.version += 1
+          d = obj.to_dict()
+          children.extend((d['id'],str(child),position) for position,child in enumerate(d.pop('children',[])))
+          rows.append((d['id'],self._name_key(d['name']),d['type'],d['parent'],d.get('cluster_name'),self._encode_data(d),d['version']))
+        conn.executemany("INSERT OR REPLACE INTO objects (id, name, type, parent, cluster_name, data, version) VALUES (?, ?, ?, ?, ?, ?, ?)",rows)
+        conn.executemany("INSERT OR REPLACE INTO children (parent, child, position) VALUES (?, ?, ?)",children)
+        metrics.wrote(len(batch))
+        count += len(batch)
+    return count
+  
+  def load_object(self,id):
+    """Load an object and return it."""
+    return self.load_objects([id])[0]
+  
+  def load_objects(self,ids):
+    """Load a list of objects with one query per batch of ids."""
+    ids = [str(id) if id else None for id in ids]
+    wanted = [id for id in ids if id]
+    conn = self._connection()
+    loaded = {}
+    for i in xrange(0,len(wanted),self.batch_size):
+      batch = wanted[i:i + self.batch_size]
+      rows = conn.execute("SELECT id, data FROM objects WHERE id IN (%s)" % ",".join("?" * len(batch)),batch).fetchall()
+      loaded.update(self._objects_from_rows(conn,rows))
+    metrics.read(len(loaded))
+    return [loaded.get(id) for id in ids]
+  
+  def load_object_by_name(self,name):
+    """Load an object from the database by name, sectors can also be found by their cluster-N name."""
+    return self.load_objects_by_name([name])[0]
+  
+  def load_objects_by_name(self,names):
+    """Load a list of objects by name using the name and (cluster_name, name) indexes."""
+    conn = self._connection()
+    ids = []
+    for name in names:
+      name = self._name_key(name)
+      row = conn.execute("SELECT id FROM objects WHERE name = ? LIMIT 1",(name,)).fetchone()
+      if not row and '-' in name:
+        cluster_name,sector_name = name.split('-',1)
+        row = conn.execute("SELECT id FROM objects WHERE type = 'Sector' AND cluster_name = ? AND name = ? LIMIT 1",(cluster_name,sector_name)).fetchone()
+      if not row:
+        self.log.info("load_objects_by_name(): No object found with name %s" % name)
+      ids.append(row[0] if row else None)
+    return self.load_objects(ids)
+  
+  def _connection(self):
+    """Return the SQLite connection for the current thread."""
+    conn = getattr(self.local,'conn',None)
+    if conn is None:
+      conn = sqlite3.connect(self.path,check_same_thread = False)
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.execute("PRAGMA synchronous=NORMAL")
+      self.local.conn = conn
+    return conn
+  
+  def _write_object(self,conn,obj):
+    """Write an object's row if its version is current, and bring its rows in the children table up to date.
+    
+    Returns False if the row has a different version."""
+    version = obj.version
+    obj.version += 1
+    d = obj.to_dict()
+    children = [str(child) for child in d.pop('children',[])]
+    values = (self._name_key(d['name']),d['type'],d['parent'],d.get('cluster_name'),self._encode_data(d),d['version'],d['id'],version)
+    if not conn.execute("UPDATE objects SET name = ?, type = ?, parent = ?, cluster_name = ?, data = ?, version = ? WHERE id = ? AND version = ?",values).rowcount:
+      if version != 0 or conn.execute("SELECT 1 FROM objects WHERE id = ?",(d['id'],)).fetchone():
+        return False
+      conn.execute("INSERT INTO objects (name, type, parent, cluster_name, data, version, id) VALUES (?, ?, ?, ?, ?, ?, ?)",values[:-1])
+    
+    #Only write the rows that changed, clusters can have a lot of them. Positions are the index in the
+    #new list, so children after a removed one are moved up and the rows stay in order
+    existing = dict(conn.execute("SELECT child, position FROM children WHERE parent = ?",(d['id'],)))
+    removed = set(existing).difference(children)
+    if removed:
+      conn.executemany("DELETE FROM children WHERE parent = ? AND child = ?",[(d['id'],child) for child in removed])
+    moved = [(position,d['id'],child) for position,child in enumerate(children) if child in existing and existing[child] != position]
+    if moved:
+      conn.executemany("UPDATE children SET position = ? WHERE parent = ? AND child = ?",moved)
+    added = [(d['id'],child,position) for position,child in enumerate(children) if child not in existing]
+    if added:
+      conn.executemany("INSERT INTO children (parent, child, position) VALUES (?, ?, ?)",added)
+    return True
+  
+  def _encode_data(self,d):
+    """Encode an object's dictionary (without its children) for the data column."""
+    data = self.codec.encode(d)
+    #Binary data is stored as a blob, sqlite only accepts text that is valid UTF-8
+    if self.codec.name != "json":
+      data = buffer(data)
+    return data
+  
+  def _objects_from_rows(self,conn,rows):
+    """Create objects from (id, data) rows, loading their children from the children table.
+    
+    Returns a dictionary of id to object."""
+    dicts = {}
+    for id,data in rows:
+      dicts[id] = decode(data if isinstance(data,unicode) else str(data))
+      dicts[id]['children'] = []
+    ids = list(dicts.keys())
+    for i in xrange(0,len(ids),self.batch_size):
+      batch = ids[i:i + self.batch_size]
+      for parent,child in conn.execute("SELECT parent, child FROM children WHERE parent IN (%s) ORDER BY parent, position" % ",".join("?" * len(batch)),batch):
+        dicts[parent]['children'].append(child)
+    return dict((id,object_from_dict(d)) for id,d in dicts.items())
+
+class LogDatabase(Database):
+  """Store objects as records appended to segment files.
+  
+  Saving an object appends a record to the newest segment instead of rewriting a file. An in-memory
+  index of id to record position is rebuilt from the segments on connect and used to read objects back.
+  When enough full segments build up, a background thread compacts them into one segment that only
+  holds the latest record of each object.
+  
+  Each record says how many more records follow it in the same save, so a save that was only partly
+  written is dropped as a whole on connect. Concurrent saves are grouped so one fsync covers all of them."""
+  
+  #Each record is the payload length, crc32 and number of records left in its save, followed by the encoded object
+  header = struct.Struct(">III")
+  
+  def __init__(self,name,location,codec = "json",segment_size = 4 * 1024 * 1024,compact_segments = 4):
+    super(LogDatabase,self).__init__(name = name,location = location,codec = codec)
+    self.path = os.path.join(self.location,"%s.segments" % self.name)
+    
+    #A new segment is started once the current one is this many bytes
+    self.segment_size = segment_size
+    #Full segments are compacted once there are this many of them
+    self.compact_segments = compact_segments
+    
+    #Object id to (segment, offset, length) of its latest record
+    self.offsets = {}
+    #Object id to the version of its latest record
+    self.versions = {}
+    #Segment numbers in order, the last one is written to
+    self.segments = []
+    self.readers = {}
+    self.writer = None
+    self.compactor = None
+    self.lock = threading.RLock()
+    self.group_commit = GroupCommit(self._append)
+    self._reset_index()
+  
+  def db_exists(self):
+    return os.path.exists(self.path)
+  
+  def connect(self):
+    """Create the segment directory if needed, and rebuild the index from the segments in it."""
+    if not os.path.exists(self.path):
+      self.log.debug("Creating directory %s" % self.path)
+      os.makedirs(self.path)
+    
+    with self.lock:
+      self._load_segments()
+    
+    if self.is_empty():
+      self.log.info("Universe appears to be empty, executing Big Bang.")
+      return self.big_bang()
+    return True
+  
+  def big_bang(self):
+    """Delete every segment and start again with an empty one."""
+    self.close()
+    with self.lock:
+      self.log.debug("Removing segments in %s" % self.path)
+      for f in os.listdir(self.path):
+        os.remove(os.path.join(self.path,f))
+      self.offsets = {}
+      self.versions = {}
+      self.segments = []
+      self._reset_index()
+      self._open_segment(1)
+    
+    #Create the universe
+    ##nothing to do yet
+    return True
+  
+  def is_empty(self):
+    return not self.offsets
+  
+  def close(self):
+    """Wait for any running compaction, then close all of the segment files."""
+    if self.compactor:
+      self.compactor.join()
+    with self.lock:
+      for reader in self.readers.values():
+        reader.close()
+      self.readers = {}
+      if self.writer:
+        self.writer.close()
+        self.writer = None
+  
+  def save_object(self,obj):
+    """Save a game object to the database."""
+    return self.save_objects([obj])[0]
+  
+  def save_objects(self,objs):
+    """Append a record for each object to the current segment as one atomic save."""
+    records = []
+    for obj in objs:
+      self.log.debug("Saving object: %s",obj)
+      obj.version += 1
+      records.append((obj,self._encode(obj)))
+    try:
+      self.group_commit.commit(records)
+    except ConflictError:
+      for obj in objs:
+        obj.version -= 1
+      raise
+    except (IOError,OSError),e:
+      for obj in objs:
+        obj.version -= 1
+      self.log.error("save_objects(): Error appending %s: %s" % (str(objs),e))
+      return [None for obj in objs]
+    metrics.wrote(len(objs))
+    return list(objs)
+  
+  def bulk_load(self,batches):
+    """Append every object as a save of its own, with one write per batch and an fsync for each segment that is filled."""
+    count = 0
+    with self.lock:
+      for batch in batches:
+        segment = self.segments[-1]
+        offset = self.writer.tell()
+        data = []
+        for obj in batch:
+          obj.version += 1
+          payload = self._encode(obj)
+          data.append(self.header.pack(len(payload),zlib.crc32(payload) & 0xffffffff,0))
+          data.append(payload)
+          self.offsets[str(obj.id)] = (segment,offset + self.header.size,len(payload))
+          self.versions[str(obj.id)] = obj.version
+          self._index_object(obj)
+          offset += self.header.size + len(payload)
+        self.writer.write("".join(data))
+        metrics.wrote(len(batch))
+        count += len(batch)
+        if offset >= self.segment_size:
+          self.writer.flush()
+          os.fsync(self.writer.fileno())
+          self._rotate()
+      self.writer.flush()
+      os.fsync(self.writer.fileno())
+    return count
+  
+  def load_object(self,id):
+    """Load an object and return it."""
+    return self.load_objects([id])[0]
+  
+  def load_objects(self,ids):
+    """Load a list of objects by reading each one's latest record."""
+    objs = []
+    with self.lock:
+      for id in ids:
+        position = self.offsets.get(str(id)) if id else None
+        objs.append(self._decode(self._read(*position)) if position else None)
+    metrics.read(len([obj for obj in objs if obj]))
+    return objs
+  
+  def load_object_by_name(self,name):
+    """Load an object from the database by name, sectors can also be found by their cluster-N name."""
+    return self.load_objects([self.names.get(self._name_key(name))])[0]
+  
+  def load_objects_by_name(self,names):
+    return self.load_objects([self.names.get(self._name_key(name)) for name in names])
+  
+  def compact(self):
+    """Rewrite all of the full segments into one, keeping only the latest record of each object.
+    
+    The compacted segment replaces the newest of the old segments, so replaying the segments in order
+    on connect still ends with the latest record of every object."""
+    with self.lock:
+      old_segments = self.segments[:-1]
+      live = dict((id,position) for id,position in self.offsets.items() if position[0] in old_segments)
+    if len(old_segments) < 2:
+      return False
+    
+    target = old_segments[-1]
+    tmp_path = "%s.compact" % self._segment_path(target)
+    moved = {}
+    with open(tmp_path,'wb') as out:
+      for segment in old_segments:
+        with open(self._segment_path(segment),'rb') as f:
+          for id,position in sorted(live.items(),key = lambda item: item[1]):
+            if position[0] != segment:
+              continue
+            f.seek(position[1])
+            payload = f.read(position[2])
+            out.write(self.header.pack(len(payload),zlib.crc32(payload) & 0xffffffff,0))
+            moved[id] = (target,out.tell(),len(payload))
+            out.write(payload)
+      out.flush()
+      os.fsync(out.fileno())
+    
+    with self.lock:
+      for segment in old_segments:
+        if segment in self.readers:
+          self.readers.pop(segment).close()
+      os.rename(tmp_path,self._segment_path(target))
+      for segment in old_segments[:-1]:
+        os.remove(self._segment_path(segment))
+      for id,position in moved.items():
+        #Objects saved again while compacting already point at a newer segment
+        if self.offsets.get(id) == live[id]:
+          self.offsets[id] = position
+      self.segments = [s for s in self.segments if s >= target]
+    self.log.info("compact(): Compacted segments %s into %s with %s records" % (old_segments,target,len(moved)))
+    return True
+  
+  def _append(self,batches):
+    """Append a group of saves to the current segment with one write and one fsync.
+    
+    Returns a list with a ConflictError (or None) for each save."""
+    with self.lock:
+      errors = []
+      for records in batches:
+        conflicts = [str(obj.id) for obj,payload in records if self.versions.get(str(obj.id),0) != obj.version - 1]
+        errors.append(ConflictError(conflicts) if conflicts else None)
+        if not conflicts:
+          for obj,payload in records:
+            self.versions[str(obj.id)] = obj.version
+      batches = [records for records,error in zip(batches,errors) if not error]
+      if not batches:
+        return errors
+      
+      segment = self.segments[-1]
+      offset = self.writer.tell()
+      data = []
+      for records in batches:
+        for i,(obj,payload) in enumerate(records):
+          data.append(self.header.pack(len(payload),zlib.crc32(payload) & 0xffffffff,len(records) - i - 1))
+          data.append(payload)
+      self.writer.write("".join(data))
+      self.writer.flush()
+      os.fsync(self.writer.fileno())
+      
+      for records in batches:
+        for obj,payload in records:
+          self.offsets[str(obj.id)] = (segment,offset + self.header.size,len(payload))
+          self._index_object(obj)
+          offset += self.header.size + len(payload)
+      if offset >= self.segment_size:
+        self._rotate()
+      return errors
+  
+  def _segment_path(self,segment):
+    return os.path.join(self.path,"%08d.segment" % segment)
+  
+  def _open_segment(self,segment):
+    """Start appending to the given segment."""
+    if self.writer:
+      self.writer.close()
+    self.writer = open(self._segment_path(segment),'ab')
+    if segment not in self.segments:
+      self.segments.append(segment)
+  
+  def _rotate(self):
+    """Start a new segment, and compact the full ones in the background if there are enough of them."""
+    self._open_segment(self.segments[-1] + 1)
+    self.log.debug("_rotate(): Writing to segment %s" % self.segments[-1])
+    if len(self.segments) > self.compact_segments and not (self.compactor and self.compactor.is_alive()):
+      self.compactor = threading.Thread(target = self.compact,name = "chodewars-compactor")
+      self.compactor.daemon = True
+      self.compactor.start()
+  
+  def _read(self,segment,offset,length):
+    if segment not in self.readers:
+      self.readers[segment] = open(self._segment_path(segment),'rb')
+    reader = self.readers[segment]
+    reader.seek(offset)
+    return reader.read(length)
+  
+  def _load_segments(self):
+    """Rebuild the offset and name indexes by reading every record in every segment."""
+    self.offsets = {}
+    self.versions = {}
+    self._reset_index()
+    self.segments = sorted(int(f.split('.')[0]) for f in os.listdir(self.path) if f.endswith(".segment"))
+    for segment in self.segments:
+      with open(self._segment_path(segment),'rb') as f:
+        offset = 0
+        #Records of the save being read, they are only used once the whole save has been read
+        save_offset = 0
+        save = []
+        while True:
+          header = f.read(self.header.size)
+          if not header and not save:
+            break
+          length,crc,remaining = self.header.unpack(header) if len(header) == self.header.size else (None,None,None)
+          payload = f.read(length) if length is not None else ""
+          if length is None or len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+            #A save was interrupted, drop it and everything after it
+            self.log.error("_load_segments(): Segment %s has an incomplete save at offset %s, truncating it" % (segment,save_offset))
+            f.close()
+            with open(self._segment_path(segment),'r+b') as damaged:
+              damaged.truncate(save_offset)
+            break
+          save.append((self._decode(payload),offset + self.header.size,len(payload)))
+          offset += self.header.size + len(payload)
+          if remaining == 0:
+            for obj,record_offset,record_length in save:
+              self.offsets[str(obj.id)] = (segment,record_offset,record_length)
+              self.versions[str(obj.id)] = obj.version
+              self._index_object(obj)
+            save = []
+            save_offset = offset
+    self.log.debug("_load_segments(): Loaded %s objects from segments %s" % (len(self.offsets),self.segments))
+    if self.segments:
+      self._open_segment(self.segments[-1])
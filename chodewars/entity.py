@@ -1,37 +1,62 @@
 from uuid import uuid4
 
+def parent_id(value):
+  """Convert a parent to an id string, the string "None" is loaded as python None."""
+  return str(value) if value is not None and str(value) != "None" else None
+
 class Entity(object):
-  def __init__(self,initial_state = {}):
-    
-    """We set each value from the initial_state dictionary if it is exists, otherwise set it to default."""
-    self.id = initial_state['id'] if 'id' in initial_state else uuid4()
-    
-    self.name = initial_state['name'] if 'name' in initial_state else "Entity"
-    
-    self.type = initial_state['type'] if 'type' in initial_state else self.__class__.__name__
-    
+  #The fields of an entity as (name, default, conversion). They are set from initial_state in __init__
+  #and saved by to_dict(). A callable default is called to make a new value for each entity.
+  #Subclasses add their own fields by extending this tuple, and list them in their __slots__.
+  fields = (
+    ('id',None,str),
+    ('name',"Entity",None),
+    ('type',None,None),
     #Parent is the id of this entity's parent
-    self.parent = str(initial_state['parent']) if 'parent' in initial_state else None
-    ##However, if parent is loaded as the string "None", we should convert it to be python None
-    if self.parent == "None":
-      self.parent = None
-    
+    ('parent',None,parent_id),
     #Children is a list of ids that belong to this entity
-    self.children = initial_state['children'] if 'children' in initial_state else []
-    
+    ('children',list,None),
     #Attributes
-    self.landable = initial_state['landable'] if 'landable' in initial_state else False
-    self.tradeable = initial_state['tradeable'] if 'tradeable' in initial_state else False
-    self.dockable = initial_state['dockable'] if 'dockable' in initial_state else False
-    self.scanable = initial_state['scanable'] if 'scanable' in initial_state else False
-    self.habitable = initial_state['habitable'] if 'habitable' in initial_state else False
-    
+    ('landable',False,None),
+    ('tradeable',False,None),
+    ('dockable',False,None),
+    ('scanable',False,None),
+    ('habitable',False,None),
+    #Number of times this entity has been saved, used to detect saves made from an out of date copy
+    ('version',0,int),
     #Variables
-    self.population = int(initial_state['population']) if 'population' in initial_state else 0
-    self.population_growth = int(initial_state['population_growth']) if 'population_growth' in initial_state else 0
+    ('population',0,int),
+    ('population_growth',0,int),
+    #Time population was last brought up to date when populations are lazy, see Game.evaluate_populations()
+    ('population_time',None,None),
+  )
+  __slots__ = tuple(name for name,default,convert in fields)
+  
+  #Defaults that a subclass uses instead of the ones in fields
+  defaults = {}
+  
+  def __init__(self,initial_state = {}):
+    """We set each value from the initial_state dictionary if it is exists, otherwise set it to default."""
+    for name,default,convert in self.fields:
+      if name in initial_state:
+        value = initial_state[name]
+        setattr(self,name,convert(value) if convert else value)
+      else:
+        default = self.defaults.get(name,default)
+        setattr(self,name,default() if callable(default) else default)
+    
+    if self.id is None:
+      self.id = str(uuid4())
+    if self.type is None:
+      self.type = self.__class__.__name__
+  
+  def __reduce__(self):
+    """Pickle entities (for example to send them to another process) as their dictionary."""
+    return (self.__class__,(self.to_dict(),))
   
   def __repr__(self):
-    return str(self.name)
+    #Escaped, so non-ASCII names can be put in log messages alongside unicode
+    return self.name.encode('ascii','backslashreplace') if isinstance(self.name,unicode) else str(self.name)
   
   def __cmp__(self,other):
     """Default comparison is on the name."""
@@ -43,24 +68,20 @@ class Entity(object):
       return 1
   
   def to_dict(self):
-    """Return a dictionary of all of the values of this object (excluding parent and children).
+    """Return a dictionary of all of the fields of this object.
     
     We only use parent and children ids since that could cause some very large dictionaries when
     converting a cluster to a dictionary, which would include all sectors, ships, players, and so on."""
+    d = dict((name,getattr(self,name)) for name,default,convert in self.fields)
     
-    #We don't want to modify the instance's dictionary, so we make a copy first
-    d = dict(self.__dict__)
+    #Copy the list of children so the dictionary can be changed without changing this object
+    d['children'] = list(self.children)
     
     #Convert the id value to a string
     d['id'] = str(self.id)
     
     #Convert the parent object to an id string
     d['parent'] = str(self.parent) if self.parent else None
-    
-    #Convert all child objects into a list of id strings
-    #print "children: %s" % str(self.children)
-    #for child in self.children:
-      #d['children'].append(str(child))
     return d
   
   def add_child(self,child):
@@ -0,0 +1,48 @@
+import logging
+import threading
+
+class Feed(object):
+  """Tell subscribers when objects enter or leave the places they are watching.
+
+  moved() is a Game listener (see Game.add_listener()). Subscribers are called with (event, location, entity):
+  entered and left go to the subscribers of the location, and moved goes to the subscribers of the object that
+  moved, with its new location. Each call is made by deliver(subscriber, event, location, entity), so a web
+  server can hand the calls to its IOLoop instead of making them on the thread that moved the object."""
+
+  def __init__(self,deliver = None):
+    self.log = logging.getLogger('chodewars.feed')
+    #Id of a location or object to the set of its subscribers
+    self.subscribers = {}
+    self.lock = threading.Lock()
+    self.deliver = deliver or (lambda subscriber,*args: subscriber(*args))
+
+    #Counters
+    self.sent = 0
+
+  def subscribe(self,id,subscriber):
+    with self.lock:
+      self.subscribers.setdefault(str(id),set()).add(subscriber)
+
+  def unsubscribe(self,id,subscriber):
+    with self.lock:
+      subscribers = self.subscribers.get(str(id))
+      if subscribers:
+        subscribers.discard(subscriber)
+        if not subscribers:
+          del self.subscribers[str(id)]
+
+  def moved(self,child,parent,previous_parent):
+    if previous_parent:
+      self._send(previous_parent.id,"left",previous_parent,child)
+    self._send(parent.id,"entered",parent,child)
+    self._send(child.id,"moved",parent,child)
+
+  def _send(self,id,event,location,entity):
+    with self.lock:
+      subscribers = list(self.subscribers.get(str(id),()))
+    for subscriber in subscribers:
+      try:
+        self.deliver(subscriber,event,location,entity)
+        self.sent += 1
+      except Exception:
+        self.log.exception("_send(): Error sending %s of %s to %s" % (event,entity,subscriber))
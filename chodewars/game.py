@@ -1,8 +1,20 @@
+import re
+import time
 import logging
 import db
 import random
+import metrics
+import ConfigParser
+import threading
+import itertools
+import multiprocessing
 
-from collections import deque
+from collections import OrderedDict,namedtuple
+from contextlib import contextmanager
+from routes import RoutePlanner
+from population import PopulationTable
+from spatial import SpatialIndex
+from clustermap import ClusterMap
 
 from player import Player
 from cluster import Cluster
@@ -10,8 +22,108 @@ from sector import Sector
 from planet import Planet
 from ship import Ship
 
+#Snapshot of everything needed to render a player's location, built by Game.get_view()
+View = namedtuple('View',['player','ship','location','children','warps','map'])
+
+#Result of Game.scan(), sectors is a list of (sector name, distance in warps, objects) nearest first
+Scan = namedtuple('Scan',['centre','radius','sectors'])
+
+#Sector names are the cluster name and sector number, such as alpha-5
+sector_name_pattern = re.compile(r"^\w+-\d+$")
+
+#Settings used when they are not in the config file
+default_config = {
+  'database': {
+    'type': 'file',
+    'location': 'data',
+    'name': 'universe',
+    #json or binary, objects saved with either codec can always be loaded
+    'codec': 'json',
+    #Only used by the log database
+    'segment_size': str(4 * 1024 * 1024),
+    'compact_segments': '4',
+  },
+  'log': {
+    #debug logs every object the game loads and changes
+    'level': 'info',
+  },
+  'cache': {
+    'size': '1000',
+  },
+  'universe': {
+    'cluster_size': '10',
+    'clusters': 'alpha',
+    #Create every sector when the universe is created, instead of when something first moves into it
+    'eager': 'false',
+    #Fraction of sectors given a planet when sectors are created eagerly
+    'planet_density': '0',
+    #Processes that create sectors, 0 uses one for each CPU
+    'processes': '0',
+    #Warps between clusters, as comma separated pairs of sectors such as "alpha-100 beta-1"
+    'links': '',
+    #Route tables kept for each cluster geometry that has blocked sectors
+    'route_tables': '64',
+    #Warps a scan reaches
+    'scan_range': '2',
+    #Sectors shown on each side of the player's sector in the map on the index page, 0 hides the map
+    'map_radius': '3',
+  },
+  'population': {
+    #tick saves every population each tick, lazy works a population out from its growth when it is read
+    'mode': 'tick',
+    #Seconds between population ticks, 0 stops the web server ticking
+    'tick_seconds': '60',
+    #Objects saved at a time after a tick
+    'save_batch': '5000',
+  },
+}
+
+def read_config(config_file):
+  """Return a ConfigParser with the settings in config_file, using default_config for anything it doesn't set."""
+  config = ConfigParser.SafeConfigParser()
+  for section,settings in default_config.items():
+    config.add_section(section)
+    for key,value in settings.items():
+      config.set(section,key,value)
+  config.read(config_file)
+  return config
+
+def parse_links(links):
+  """Return a dictionary of sector name to the list of sector names it is linked to, from the links setting.
+  
+  Links work in both directions."""
+  linked = {}
+  for pair in links.split(','):
+    sectors = pair.split()
+    if len(sectors) != 2:
+      continue
+    linked.setdefault(sectors[0],[]).append(sectors[1])
+    linked.setdefault(sectors[1],[]).append(sectors[0])
+  return linked
+
+def generate_sectors(job):
+  """Create the sectors start to end - 1 of a cluster, giving each a planet with a chance of planet_density.
+  
+  Runs in the processes of Game.big_bang(), and returns the list of new sectors and planets."""
+  cluster_name,cluster_id,start,end,planet_density,seed = job
+  rng = random.Random(seed)
+  objs = []
+  for n in xrange(start,end):
+    sector = Sector(initial_state = {'cluster_name': cluster_name,'name': str(n),'parent': cluster_id})
+    objs.append(sector)
+    if planet_density and rng.random() < planet_density:
+      planet = Planet(initial_state = {'name': "Planet %s-%s" % (cluster_name,n),'parent': sector.id})
+      sector.add_child(planet)
+      objs.append(planet)
+  return objs
+
 class Game(object):
-  def __init__(self,bigbang = False):
+  #Number of sectors each process creates at a time during the big bang
+  generate_batch = 5000
+  #Number of objects loaded at a time when walking a cluster
+  load_batch = 5000
+  
+  def __init__(self,bigbang = False,config_file = "chodewars.cfg",clusters = None):
     #Setup logging for this module
     self.log = logging.getLogger('chodewars.game')
     self.log.setLevel(logging.DEBUG)
@@ -35,6 +147,26 @@ class Game(object):
     #Setup instance variables
     self.db = None
     self.clusters = {}
+    self.config_file = config_file
+    #Names of the clusters this game loads and gives home sectors in, None for every cluster in the config
+    self.owned_clusters = clusters
+    #Notifier that tells other processes which objects this game saves, see listen_for_changes()
+    self.notifier = None
+    #Functions called with (child, parent, previous parent) when assign_child() moves an object, see add_listener()
+    self.listeners = []
+    #Locks held while objects are saved, so two threads sharing a cached object don't both check and bump its version
+    self.save_locks = [threading.RLock() for i in xrange(64)]
+    #Population of every habitable object, built by the first tick()
+    self.population = None
+    #Ids of objects moved here or changed by other processes since the last tick, so their rows can be brought up to date
+    self.population_changes = set()
+    self.population_lock = threading.Lock()
+    #Objects in each sector by type, for scans
+    self.spatial = SpatialIndex()
+    self.add_listener(self.spatial.moved)
+    #Map tiles drawn from the spatial index, added after it so it is up to date when tiles are drawn again
+    self.map = ClusterMap(self.spatial)
+    self.add_listener(self.map.moved)
     
     #Output a header to the log
     self.log.info("\n%s\nGame Initialized: %s\n%s" % ("_" * 20,"","_" * 20))
@@ -48,18 +180,69 @@ class Game(object):
       self._load_clusters()
   
   def load_config(self):
-    self.log.debug("Loading configuration")
+    """Load settings from the config file, using default_config for anything it doesn't set."""
+    self.log.debug("Loading configuration from %s" % self.config_file)
+    config = read_config(self.config_file)
+    
+    #Log Config
+    self.log.setLevel(getattr(logging,config.get('log','level').upper(),logging.INFO))
     
     #Database Config
-    self.db_type = "file"
-    if self.db_type is "file":
+    self.db_type = config.get('database','type')
+    db_location = config.get('database','location')
+    db_name = config.get('database','name')
+    db_codec = config.get('database','codec')
+    if self.db_type == "file":
       self.log.info('Using flat file database')
-      self.db = db.FlatFileDatabase(location = "data",
-                                    name = "universe")
+      self.db = db.FlatFileDatabase(location = db_location,
+                                    name = db_name,
+                                    codec = db_codec)
+    elif self.db_type == "sqlite":
+      self.log.info('Using SQLite database')
+      self.db = db.SqliteDatabase(location = db_location,
+                                  name = db_name,
+                                  codec = db_codec)
+    elif self.db_type == "log":
+      self.log.info('Using log-structured database')
+      self.db = db.LogDatabase(location = db_location,
+                               name = db_name,
+                               codec = db_codec,
+                               segment_size = config.getint('database','segment_size'),
+                               compact_segments = config.getint('database','compact_segments'))
+    else:
+      self.log.error("Unknown database type %s in %s" % (self.db_type,self.config_file))
+      return False
+    
+    #Cache Config
+    self.cache_size = config.getint('cache','size')
+    self.cache = Cache(size = self.cache_size,database = self.db)
+    
+    #Concurrency Config
+    ##Number of times to retry a save that conflicts with one made by another request
+    self.conflict_retries = 5
     
     #Universe Config
-    self.cluster_size = 10
-    self.cluster_list = ['alpha']
+    self.cluster_size = config.getint('universe','cluster_size')
+    self.cluster_list = [c.strip() for c in config.get('universe','clusters').split(',') if c.strip()]
+    if self.owned_clusters is not None:
+      self.cluster_list = [c for c in self.cluster_list if c in self.owned_clusters]
+    self.links = parse_links(config.get('universe','links'))
+    self.scan_range = config.getint('universe','scan_range')
+    self.map_radius = config.getint('universe','map_radius')
+    self.eager = config.getboolean('universe','eager')
+    self.planet_density = config.getfloat('universe','planet_density')
+    self.processes = config.getint('universe','processes') or multiprocessing.cpu_count()
+    self.routes = RoutePlanner(self.links,
+                               load_cluster = lambda name: self.clusters.get(name) or self.load_object(name),
+                               table_count = config.getint('universe','route_tables'))
+    
+    #Population Config
+    self.population_mode = config.get('population','mode')
+    if self.population_mode not in ("tick","lazy"):
+      self.log.error("Unknown population mode %s in %s, using tick" % (self.population_mode,self.config_file))
+      self.population_mode = "tick"
+    self.tick_seconds = config.getfloat('population','tick_seconds')
+    self.save_batch = config.getint('population','save_batch')
     
     return True
   
@@ -72,56 +255,345 @@ class Game(object):
       return False
   
   def big_bang(self):
+    """Delete the universe and create its clusters again, with all of their sectors if eager is set."""
     if self.db:
       self.log.info("Executing Big Bang")
-      return self.db.big_bang()
+      if not self.db.big_bang():
+        return False
+      self.cache.clear()
+      self.clusters = {}
+      if self.eager:
+        self._generate_universe()
+      self._load_clusters()
+      return True
+    return False
+  
+  def _generate_universe(self):
+    """Create every sector of every cluster, spreading the work over a pool of processes.
+    
+    Each batch of sectors is written with bulk_load() as it arrives, and the clusters are written last
+    with their children and free sector lists (sectors given a planet are not free)."""
+    clusters = [Cluster(initial_state = {'name':c,'x':self.cluster_size,'y':self.cluster_size}) for c in self.cluster_list]
+    jobs = []
+    for cluster in clusters:
+      sector_count = cluster.x * cluster.y
+      for start in xrange(1,sector_count + 1,self.generate_batch):
+        jobs.append((cluster.name,cluster.id,start,min(start + self.generate_batch,sector_count + 1),self.planet_density,random.random()))
+    self.log.info("_generate_universe(): Creating %s clusters in %s batches with %s processes" % (len(clusters),len(jobs),self.processes))
+    
+    pool = multiprocessing.Pool(self.processes) if self.processes > 1 and len(jobs) > 1 else None
+    results = pool.imap(generate_sectors,jobs) if pool else itertools.imap(generate_sectors,jobs)
+    by_name = dict((cluster.name,cluster) for cluster in clusters)
+    occupied = dict((cluster.name,[]) for cluster in clusters)
+    
+    def batches():
+      for objs in results:
+        for obj in objs:
+          if obj.type == "Sector":
+            by_name[obj.cluster_name].children.append(obj.id)
+            if obj.children:
+              occupied[obj.cluster_name].append(obj.name)
+        yield objs
+      for cluster in clusters:
+        cluster.build_free_sectors(occupied[cluster.name])
+      yield clusters
+    
+    try:
+      count = self.db.bulk_load(batches())
+    finally:
+      if pool:
+        pool.close()
+        pool.join()
+    self.log.info("_generate_universe(): Wrote %s objects" % count)
+    return count
+  
+  def tick(self,ticks = 1):
+    """Advance the population of every habitable object, and save the ones that changed.
+    
+    The populations are kept in a PopulationTable, which is built the first time. After that, objects moved
+    by assign_child() and objects other processes saved (see invalidate()) are read again at the start of
+    the next tick, so new planets join the table and changed populations replace the table's. Returns the
+    number of objects saved."""
+    if self.population_mode != "tick":
+      self.log.info("tick(): Populations are %s, there is nothing to tick" % self.population_mode)
+      return 0
+    if self.population is None:
+      self.population = self._build_population()
+      self.add_listener(self._track_population)
+    self._refresh_population()
+    #Ticks make a new column, so this still has the populations from before the tick
+    before = self.population.populations
+    changed = self.population.tick(ticks)
+    saved = 0
+    for i in xrange(0,len(changed),self.save_batch):
+      saved += self._retry_on_conflict(self._save_populations,changed[i:i + self.save_batch],before) or 0
+    self.log.info("tick(): Saved %s of %s changed populations" % (saved,len(changed)))
+    return saved
+  
+  def evaluate_populations(self,entities,now = None):
+    """Bring the populations of habitable objects up to date when populations are lazy, returning the objects.
+    
+    A population grows by population_growth (never going below 0) for each whole tick_seconds since its
+    population_time, the same as it would have with ticks. Objects are only changed in memory, so the new
+    population is saved the next time something else saves them. Objects that have never been evaluated
+    are given a population_time and saved, once."""
+    if self.population_mode != "lazy" or not self.tick_seconds:
+      return entities
+    now = time.time() if now is None else now
+    unstamped = []
+    for entity in entities:
+      if not entity or not entity.habitable:
+        continue
+      #Objects are shared through the cache, so the time is checked and moved on under the object's save
+      #lock, or two requests reading it at once could both add the same growth
+      with self._locked([entity]):
+        if entity.population_time is None:
+          entity.population_time = now
+          unstamped.append(entity)
+          continue
+        ticks = int((now - entity.population_time) // self.tick_seconds)
+        if ticks > 0:
+          entity.population = max(0,entity.population + entity.population_growth * ticks)
+          entity.population_time += ticks * self.tick_seconds
+    if unstamped:
+      try:
+        self.save_objects(unstamped)
+      except db.ConflictError,e:
+        #They have been dropped from the cache, and are stamped the next time they are read
+        self.log.info("evaluate_populations(): %s" % e)
+    return entities
+  
+  def get_population(self,entity):
+    """Return the current population of an object, for game logic that reads it."""
+    return self.evaluate_populations([entity])[0].population
+  
+  def _build_population(self):
+    """Find every habitable object by walking down from the clusters, loading a batch of objects at a time."""
+    table = PopulationTable()
+    ids = [str(cluster.id) for cluster in self.db.load_objects_by_name(self.cluster_list) if cluster]
+    while ids:
+      children = []
+      for i in xrange(0,len(ids),self.load_batch):
+        for obj in self.db.load_objects(ids[i:i + self.load_batch]):
+          if not obj:
+            continue
+          if obj.habitable:
+            table.add(obj)
+          children.extend(obj.children)
+      ids = children
+    self.log.info("_build_population(): Found %s habitable objects" % len(table))
+    return table
+  
+  def _track_population(self,child,parent,previous_parent):
+    if child.habitable and child.id not in self.population:
+      with self.population_lock:
+        self.population_changes.add(str(child.id))
+  
+  def _refresh_population(self):
+    """Read the objects in population_changes again, adding the habitable ones to the table or updating their rows."""
+    with self.population_lock:
+      ids = list(self.population_changes)
+      self.population_changes = set()
+    for i in xrange(0,len(ids),self.load_batch):
+      for obj in self.db.load_objects(ids[i:i + self.load_batch]):
+        if obj and obj.habitable:
+          self.population.add(obj)
+  
+  def _save_populations(self,ids,before):
+    """Add each object's growth in the last tick to the population saved in the database.
+    
+    The growth is the table's population less the one in before, so changes other processes made since the
+    table read the object are kept. Objects are loaded from the database, not the cache, so a tick doesn't
+    push everything else out of it, and cached copies are replaced with the saved ones."""
+    table = self.population
+    objs = [obj for obj in self.db.load_objects(ids) if obj]
+    for obj in objs:
+      i = table.index[str(obj.id)]
+      obj.population = max(0,obj.population + table.populations[i] - before[i])
+    saved = [s for s in self.db.save_objects(objs) if s]
+    for obj in saved:
+      table.populations[table.index[str(obj.id)]] = obj.population
+      if obj.id in self.cache:
+        self.cache.put(obj)
+    self._publish([obj.id for obj in saved])
+    return len(saved)
+  
+  def scan(self,player,target_id = None,radius = None,types = ("Planet","Ship")):
+    """Return a Scan of the objects of the given types within radius warps of the player's sector.
+    
+    With a target, the scan is around the sector of the target, which has to be the player's location or
+    a scanable object in it. The ids come from the spatial index, which is built for a cluster the first
+    time it is scanned, and the objects are loaded in one batch. Returns None if there is nothing to scan around."""
+    centre = player
+    if target_id:
+      ship = self.get_parent(player) if player else None
+      location = self.get_parent(ship) if ship else None
+      if not location or (str(target_id) != str(location.id) and str(target_id) not in location.children):
+        self.log.info("scan(): %s is not at the location of %s" % (target_id,player))
+        return None
+      centre = self.load_object_by_id(target_id)
+      if not centre or not (centre is location or centre.scanable):
+        self.log.info("scan(): %s can't be scanned" % target_id)
+        return None
+    centre = self._sector_of(centre)
+    if not centre:
+      return None
+    radius = self.scan_range if radius is None else radius
+    if centre.cluster_name not in self.spatial:
+      self._index_cluster(centre.cluster_name)
+    found = self.spatial.within(centre.cluster_name,int(centre.name),radius,types) or []
+    loaded = self.cache.get_many([id for number,distance,ids in found for id in ids])
+    self.evaluate_populations(loaded)
+    entities = dict((str(entity.id),entity) for entity in loaded if entity)
+    sectors = [("%s-%s" % (centre.cluster_name,number),distance,[entities[id] for id in ids if id in entities]) for number,distance,ids in found]
+    return Scan(centre = centre,radius = radius,sectors = sectors)
+  
+  def _index_cluster(self,cluster_name):
+    """Add a cluster to the spatial index, loading its sectors and their children a batch at a time.
+    
+    The index records the moves made while the cluster is being loaded, and applies them once it is added."""
+    cluster = self.load_object(cluster_name)
+    if not cluster:
+      return False
+    if not self.spatial.begin_cluster(cluster_name):
+      return True
+    sectors = []
+    for i in xrange(0,len(cluster.children),self.load_batch):
+      sectors.extend(s for s in self.db.load_objects(cluster.children[i:i + self.load_batch]) if s)
+    ids = [id for sector in sectors for id in sector.children]
+    contents = {}
+    for i in xrange(0,len(ids),self.load_batch):
+      for obj in self.db.load_objects(ids[i:i + self.load_batch]):
+        if obj:
+          contents.setdefault(obj.parent,[]).append(obj)
+    self.spatial.add_cluster(cluster,sectors,contents)
+    self.log.info("_index_cluster(): Indexed %s objects in %s sectors of %s" % (len(ids),len(sectors),cluster))
+    return True
   
   def get_parent(self,entity):
     """Return the parent object for the given entity"""
-    return self.db.load_object(entity.parent) if entity.parent else None
+    return self.cache.get(entity.parent) if entity.parent else None
   
   def get_children(self,entity):
     """Return a list of child objects for the given entity"""
-    children = []
-    for child_id in entity.children:
-      children.append(self.db.load_object(child_id))
-    return children
+    return [child for child in self.cache.get_many(entity.children) if child]
+  
+  def get_view(self,player):
+    """Return a View of the player's ship, its location, the location's children, the available warps and the map around it.
+    
+    Everything is loaded here in a fixed number of batches, so rendering the view doesn't touch the database."""
+    ship = self.get_parent(player) if player else None
+    location = self.get_parent(ship) if ship else None
+    children = tuple(self.get_children(location)) if location else ()
+    self.evaluate_populations((location,) + children if location else ())
+    warps = ()
+    tiles = ()
+    if location and location.type == "Sector":
+      warps = tuple(self.get_available_warps(ship = ship,read_only = True))
+      if self.map_radius:
+        tiles = self.get_map(location,self.map_radius)
+    return View(player = player,ship = ship,location = location,children = children,warps = warps,map = tiles)
   
+  @metrics.timed("assign_child")
   def assign_child(self,parent,child):
-    """Assign a child to a parent object and save both objects"""
-    previous_parent = self.get_parent(child)
-    self.log.debug("Assigning %s as a child of %s" % (child,parent))
-    if child.id in parent.children:
-      self.log.debug("%s is already a child of %s" % (child,parent))
+    """Assign a child to a parent object and save both objects.
+    
+    If another request saved the parent, child or previous parent first, the latest copies are loaded
+    and the assignment is tried again."""
+    for attempt in xrange(self.conflict_retries):
+      try:
+        return self._assign_child(parent,child)
+      except db.ConflictError,e:
+        self.log.info("assign_child(): %s, retrying" % e)
+        #The conflicting objects were dropped from the cache, so the child's stored parent is read again.
+        #Objects that have never been saved aren't in the database, so the same object is used again
+        parent = self.cache.get(parent.id) or parent
+        child = self.cache.get(child.id) or child
+    self.log.error("assign_child(): Could not assign %s to %s after %s conflicting saves" % (child,parent,self.conflict_retries))
+    return False
+  
+  def _assign_child(self,parent,child):
+    #The objects may be shared with other requests through the cache, so their save locks are held from the
+    #first change until the move is committed, and no other save can write a move that isn't finished.
+    #The child can be moved by another request while this waits, so its parent is looked up again
+    while True:
+      previous_parent = self.get_parent(child)
+      with self._locked([o for o in (parent,child,previous_parent) if o]):
+        if self.get_parent(child) is previous_parent:
+          return self._assign_locked(parent,child,previous_parent)
+  
+  def _assign_locked(self,parent,child,previous_parent):
+    self.log.debug("Assigning %s as a child of %s",child,parent)
+    #Both sides of the link are checked, a copy of the parent can list a child that was never saved there
+    if str(child.parent) == str(parent.id) and str(child.id) in parent.children:
+      self.log.debug("%s is already a child of %s",child,parent)
       return True
-    if parent.add_child(child):
-      child.parent = parent.id
-      self.save_object(parent)
-      self.save_object(child)
-      self.log.debug("Added child %s to %s" % (child,parent))
-      
-      #Remove child from previous parent
-      if previous_parent:
-        if previous_parent.remove_child(child):
-          self.save_object(previous_parent)
-          self.log.debug("Removed child %s from %s" % (child,previous_parent))
-          return True
-        else:
-          self.log.error("Error removing child %s from %s, remove_child() returned False" % (child,previous_parent))
+    if previous_parent and str(previous_parent.id) == str(parent.id):
+      previous_parent = None
+    #The objects are put back if nothing is saved
+    parent_children = list(parent.children)
+    child_parent = child.parent
+    previous_children = list(previous_parent.children) if previous_parent else None
+    committed = False
+    try:
+      #Parent, child and previous parent are saved together, so a crash can't leave the child in two places
+      with self.transaction() as t:
+        if not parent.add_child(child):
           return False
-      else:
-        return True
-    return False
+        child.parent = parent.id
+        t.save(parent)
+        t.save(child)
+        self.log.debug("Added child %s to %s",child,parent)
+        
+        #Remove child from previous parent
+        if previous_parent:
+          if previous_parent.remove_child(child):
+            t.save(previous_parent)
+            self.log.debug("Removed child %s from %s",child,previous_parent)
+          else:
+            self.log.error("Error removing child %s from %s, remove_child() returned False" % (child,previous_parent))
+            t.rollback()
+            return False
+      committed = t.committed
+    finally:
+      if not committed:
+        if previous_parent:
+          previous_parent.children = previous_children
+        child.parent = child_parent
+        parent.children = parent_children
+    if committed:
+      self._moved(child,parent,previous_parent)
+    return committed
+  
+  def add_listener(self,listener):
+    """Call listener(child, parent, previous parent) each time assign_child() moves an object.
+    
+    previous parent is None for an object that had no parent. Listeners run on the thread that made the
+    move, after it has been saved."""
+    self.listeners.append(listener)
+    return listener
+  
+  def remove_listener(self,listener):
+    if listener in self.listeners:
+      self.listeners.remove(listener)
+  
+  def _moved(self,child,parent,previous_parent):
+    for listener in list(self.listeners):
+      try:
+        listener(child,parent,previous_parent)
+      except Exception:
+        self.log.exception("assign_child(): Error in listener %s" % listener)
   
   def add_player(self,player):
     if self.db and player:
-      loaded_player = self.db.load_object(id=str(player.id))
+      loaded_player = self.cache.get(str(player.id))
       if loaded_player:
         self.log.info("Player %s already exists, but add_player was called. Nothing is changed and the existing player is being returned")
         return loaded_player
       else:
         self.log.debug("Adding player %s" % player.name)
         result = self.db.add_player(player)
+        if result: self.cache.put(result)
         self.log.debug("add_player() returning %s" % result)
         return result
     return None
@@ -129,54 +601,180 @@ class Game(object):
   def get_player_by_id(self,player_id):
     if self.db:
       self.log.debug("Retrieving player account for id %s" % player_id)
-      player = self.db.load_object(player_id)
-      if player: self.log.debug("Returning player %s" % str(player.__dict__))
+      player = self.cache.get(player_id)
+      if player and self.log.isEnabledFor(logging.DEBUG):
+        self.log.debug("Returning player %s",player.to_dict())
       return player
   
   def save_object(self,entity):
-    return self.db.save_object(entity)
+    """Save an object to the database, and write it through to the cache."""
+    with self._locked([entity]):
+      saved = self.db.save_object(entity)
+    if saved:
+      self.cache.put(saved)
+      self._publish([saved.id])
+    else:
+      self.cache.invalidate(entity.id)
+    return saved
+  
+  def save_objects(self,entities):
+    """Save a list of objects to the database in one operation, and write them through to the cache."""
+    try:
+      with self._locked(entities):
+        saved = self.db.save_objects(entities)
+    except db.ConflictError:
+      #The objects may have been changed in memory before the save failed, so none of them can stay cached
+      for entity in entities:
+        self.cache.invalidate(entity.id)
+      raise
+    for entity,saved_entity in zip(entities,saved):
+      if saved_entity:
+        self.cache.put(saved_entity)
+      else:
+        self.cache.invalidate(entity.id)
+    self._publish([s.id for s in saved if s])
+    return saved
+  
+  @contextmanager
+  def _locked(self,entities):
+    """Hold the save locks of a list of objects, taken in order so two saves can't wait on each other."""
+    stripes = sorted(set(hash(str(entity.id)) % len(self.save_locks) for entity in entities))
+    for i in stripes:
+      self.save_locks[i].acquire()
+    try:
+      yield
+    finally:
+      for i in reversed(stripes):
+        self.save_locks[i].release()
+  
+  def listen_for_changes(self,notifier):
+    """Share changes with the other processes using notifier, when several processes serve the same universe.
+    
+    Objects this game saves are published, and objects other processes save are dropped from the cache."""
+    self.notifier = notifier
+    return notifier.subscribe(self.invalidate)
+  
+  def invalidate(self,ids):
+    """Drop objects another process changed from the cache, update the sectors among them in the spatial index
+    and let the database update its name index.
+    
+    Once populations are ticked here, the objects are also read again by the next tick."""
+    for id in ids:
+      self.cache.invalidate(id)
+    self.db.refresh(ids)
+    self._refresh_sectors(ids)
+    if self.population is not None:
+      with self.population_lock:
+        self.population_changes.update(str(id) for id in ids)
+  
+  def _refresh_sectors(self,ids):
+    """Give the spatial index, and the map tiles drawn from it, the new contents of any indexed sectors in ids.
+    
+    Only the changed sectors and their children are read, so this doesn't depend on the size of the cluster."""
+    if not self.spatial.clusters and not self.spatial.pending:
+      return
+    #The sectors of a cluster that is being loaded aren't known yet, so until it is added every id is read
+    if not self.spatial.pending:
+      ids = self.spatial.sectors_among(ids)
+    if not ids:
+      return
+    sectors = [obj for obj in self.db.load_objects(ids) if obj and obj.type == "Sector"]
+    if not sectors:
+      return
+    children = dict((str(child.id),child) for child in self.cache.get_many([id for sector in sectors for id in sector.children]) if child)
+    contents = dict((str(sector.id),[children[id] for id in sector.children if id in children]) for sector in sectors)
+    self.map.changed(self.spatial.update_sectors(sectors,contents))
+  
+  def _publish(self,ids):
+    if self.notifier and ids:
+      self.notifier.publish(ids)
+  
+  def transaction(self):
+    """Return a Transaction which saves its objects atomically, and writes them through to the cache."""
+    return db.Transaction(self)
   
   def load_object(self,name):
     """Load an object from the database."""
-    return self.db.load_object_by_name(name)
+    return self.cache.add(self.db.load_object_by_name(name))
   
   def load_object_by_id(self,id):
-    return self.db.load_object(id)
+    return self.cache.get(id)
   
   def _load_clusters(self):
     """Load the clusters instance variable from the database using the list in the config."""
     for c in self.cluster_list:
       self.log.debug("Loading cluster %s" % c)
-      self.clusters[c] = self.db.load_object_by_name(c)
+      self.clusters[c] = self.load_object(c)
       if self.clusters[c]:
         self.log.debug("Cluster %s has been loaded" % c)
       else:
         added_cluster = self.db.add_cluster(Cluster(initial_state={'name':c,'x':self.cluster_size,'y':self.cluster_size}))
         if added_cluster:
-          self.clusters[c] = self.db.load_object(added_cluster.id)
+          self.clusters[c] = self.cache.put(added_cluster)
           self.log.debug("Cluster %s did not exist, but has been added" % c)
         else:
           self.log.error("Cluster %s was not successfully loaded. This should be fixed before proceeding. See the logfile for details." % c)
     if self.clusters:
-      self.log.debug("Clusters initialized: %s" % str(self.clusters))
+      self.log.debug("Clusters initialized: %s",self.clusters)
     else:
       self.log.info("No clusters defined, check the config.")
       
+  def _retry_on_conflict(self,fn,*args,**kwargs):
+    """Call fn, calling it again if it fails because an object it saved was changed by another request.
+    
+    The conflicting objects have already been dropped from the cache, so fn loads their latest copies."""
+    for attempt in xrange(self.conflict_retries):
+      try:
+        return fn(*args,**kwargs)
+      except db.ConflictError,e:
+        self.log.info("%s(): %s, retrying" % (fn.__name__,e))
+    self.log.error("%s(): Gave up after %s conflicting saves" % (fn.__name__,self.conflict_retries))
+    return None
+  
   def _find_empty_sector(self):
-    """Return a random empty sector."""
-    #Pick a cluster
-    self.log.debug("_find_empty_sector(): Choosing random cluster from %s" % str(self.clusters))
-    random_cluster = self.clusters[random.choice(self.clusters.keys())]
-    self.log.debug("Random cluster selected as %s" % random_cluster)
-    
-    empty_sector = None
-    while not empty_sector:
-      random_sector_name = random.randint(1,int(random_cluster.x)*int(random_cluster.y))
-      random_sector = self.db.get_sector("%s-%s" % (random_cluster,random_sector_name))
-      if not random_sector:
-        empty_sector = Sector(initial_state={'cluster_name':random_cluster.name,'name':random_sector_name})
-    self.log.info("Empty sector found, returning %s" % empty_sector)
-    return empty_sector
+    """Return a random empty sector, taken from the free sector list of a random cluster."""
+    return self._retry_on_conflict(self._allocate_empty_sector)
+  
+  def _allocate_empty_sector(self):
+    """The cluster is saved with the sector removed from its free list. Returns None if every cluster is full."""
+    cluster_names = list(self.clusters.keys())
+    random.shuffle(cluster_names)
+    self.log.debug("_find_empty_sector(): Choosing random cluster from %s" % str(cluster_names))
+    for cluster_name in cluster_names:
+      cluster = self.load_object(cluster_name)
+      if not cluster:
+        continue
+      if cluster.free_sectors is None:
+        self._build_free_sectors(cluster)
+      free_count = len(cluster.free_sectors)
+      #Ships can move into a free sector after it was listed, so occupied ones are dropped as they are found
+      sector_number = cluster.allocate_sector()
+      while sector_number is not None and self._sector_occupied("%s-%s" % (cluster.name,sector_number)):
+        self.log.debug("_find_empty_sector(): %s-%s is occupied, removing it from the free sectors" % (cluster.name,sector_number))
+        sector_number = cluster.allocate_sector()
+      if sector_number is None:
+        self.log.debug("_find_empty_sector(): Cluster %s has no free sectors" % cluster)
+        if len(cluster.free_sectors) != free_count:
+          self.save_object(cluster)
+        continue
+      self.save_object(cluster)
+      empty_sector = Sector(initial_state={'cluster_name':cluster.name,'name':sector_number})
+      self.log.info("Empty sector found, returning %s" % empty_sector)
+      return empty_sector
+    self.log.error("_find_empty_sector(): Every cluster is full, there are no empty sectors left in %s" % str(cluster_names))
+    return None
+  
+  def _sector_occupied(self,sector_name):
+    sectors = self.get_sectors([sector_name],create = False)
+    return bool(sectors and sectors[0] and sectors[0].children)
+  
+  def _build_free_sectors(self,cluster):
+    """Build a cluster's free sector list for a universe created before clusters kept one.
+    
+    Sectors that have something in them are not free."""
+    occupied = [sector.name for sector in self.get_children(cluster) if sector.children]
+    self.log.info("_build_free_sectors(): Building free sector list for %s, %s sectors are occupied" % (cluster,len(occupied)))
+    cluster.build_free_sectors(occupied)
   
   def assign_home_sector(self,player,planet_name,ship_name):
     """Find an unused sector and assign this player to it.
@@ -187,6 +785,9 @@ class Game(object):
       return True
     
     home_sector = self._find_empty_sector()
+    if not home_sector:
+      self.log.error("assign_home_sector(): The universe is full, no home sector could be found for %s" % player.name)
+      return False
     self.log.debug("assign_home_sector(): Home sector determined to be %s" % home_sector.name)
     #We call get_sector, which will create it if it doesn't exist
     home_sector = self.get_sector("%s-%s" % (home_sector.cluster_name,home_sector.name))
@@ -215,56 +816,241 @@ class Game(object):
     #We now use move_ship instead
     return move_ship(player.parent,self.load_object("sector",name = sector_name, parent = cluster_name))
   
-  def move_ship(self,ship,container):
-    """Move the ship to another container (such as a sector or planet).
-    
-    Currently this only supports moving to sectors and planets."""
+  def can_move(self,ship,container):
+    """Return True if the ship can move to the container (such as a sector or planet) from where it is.
     
-    valid_container = False
+    Ships can warp to a neighbouring or linked sector, land on a planet in their sector, and take off
+    to the sector the planet is in."""
+    location = self.get_parent(ship)
+    if not location:
+      return False
     
     if container.type == "Sector":
       # If moving from one sector to another
-      if self.get_parent(ship).type in ("Sector"):
-        if container in self.get_available_warps(ship = ship):
-          valid_container = True
+      if location.type in ("Sector"):
+        if str(container) in self.warp_names("%s-%s" % (location.cluster_name,location.name)):
+          return True
       # If moving to a sector from a planet
-      if self.get_parent(ship).type in ("Planet"):
-        if self.get_parent(ship) in self.get_children(container):
-          valid_container = True
+      if location.type in ("Planet"):
+        if location in self.get_children(container):
+          return True
     # If landing on a planet
     if container.type == "Planet":
-      if container in self.get_children(self.get_parent(ship)):
-        valid_container = True
+      if container in self.get_children(location):
+        return True
+    return False
+  
+  @metrics.timed("move_ship")
+  def move_ship(self,ship,container):
+    """Move the ship to another container (such as a sector or planet).
     
-    if valid_container:
+    Currently this only supports moving to sectors and planets."""
+    if self.can_move(ship,container):
       self.log.info("Moving %s to %s" % (ship,container))
-      self.assign_child(container,ship)
-      return True
+      if container.type == "Sector":
+        #The sector may not have been created yet if it came from a read only list of warps
+        container = self.get_sector(str(container))
+      return self.assign_child(container,ship)
 
     self.log.info("%s was found to be an invalid entity to move to for ship %s" % (container,ship))
     return False
   
-  #TODO: take a sector or cluster as a parameter
-  def visualize_cluster(self,player):
-    """Get a visual map for the current cluster of the player."""
-    #TODO: player.sector no longer exists
-    if player and player.sector:
-      highlight_sector = player.sector
-      cluster = player.sector.cluster
-      
-      lines = []
-      for y in xrange(0,cluster.y):
-        s = ""
-        for x in xrange(1,cluster.x+1):
-          s += "%s " % str(x + (y * cluster.y))
-        lines.append(s)
-      return lines
+  def sign_up(self,player_id,name,planet_name = None,ship_name = None):
+    """Create a player, and give them a home sector with a planet and ship if planet_name and ship_name are given.
+    
+    Returns the player, or None if the player could not be created."""
+    player = self.add_player(Player(initial_state = {'id':player_id,'name':name}))
+    if not player:
+      self.log.error("sign_up(): Error creating player %s" % name)
+      return None
+    if planet_name and ship_name:
+      if not self.assign_home_sector(player,planet_name,ship_name):
+        self.log.error("sign_up(): Error assigning home sector for %s" % player)
     else:
+      self.log.info("sign_up(): planet_name or ship_name was not given, nothing was created for %s" % player)
+    return player
+  
+  def find_sector(self,sector_id):
+    """Return a sector by id, or by name for sectors that may not have been created yet (as an unsaved Sector)."""
+    sector = self.load_object_by_id(sector_id)
+    if not sector:
+      sectors = self.get_sectors([sector_id],create = False)
+      sector = sectors[0] if sectors else None
+    return sector
+  
+  def run_command(self,player,command,sector_id = None,target_id = None):
+    """Carry out a command for a player, returning True if it was carried out.
+    
+    move takes the sector to warp to (by id or name), land takes the planet to land on as the target,
+    and takeoff moves the player's ship from its planet back to the sector."""
+    ship = self.get_parent(player)
+    if not ship:
+      return False
+    if command == "move":
+      sector = self.find_sector(sector_id) if sector_id else None
+      self.log.debug("run_command(): move to %s",sector)
+      return self.move_ship(ship,sector) if sector else False
+    if command == "land":
+      target = self.load_object_by_id(target_id) if target_id else None
+      return self.move_ship(ship,target) if target else False
+    if command == "takeoff":
+      location = self.get_parent(ship)
+      if location and location.type == "Planet":
+        return self.move_ship(ship,self.get_parent(location))
+      return False
+    self.log.info("run_command(): Unknown command %s" % command)
+    return False
+  
+  def run_commands(self,player,commands):
+    """Carry out a list of commands for a player in order, stopping at the first one that fails.
+    
+    Commands are dictionaries with the command and the arguments of run_command(), such as
+    {'command': 'move', 'sector': 'alpha-5'}. Moves in a row are checked one hop at a time, and the ship
+    is then moved straight to the last sector in one assignment. Returns the number of commands carried out."""
+    done = 0
+    i = 0
+    while i < len(commands):
+      command = commands[i]
+      if command.get('command') == "move":
+        end = i
+        while end < len(commands) and commands[end].get('command') == "move":
+          end += 1
+        hops = self._move_through(player,[c.get('sector') for c in commands[i:end]])
+        done += hops
+        if hops < end - i:
+          return done
+        i = end
+      else:
+        if not self.run_command(player,command.get('command'),sector_id = command.get('sector'),target_id = command.get('target')):
+          return done
+        done += 1
+        i += 1
+    return done
+  
+  def _move_through(self,player,sector_ids):
+    """Move the player's ship through a list of sectors, returning the number of hops made.
+    
+    Each hop has to be a warp from the sector before it. Only the last valid sector is loaded (or created),
+    the sectors in between are checked by name. A ship that isn't in a sector makes its first hop with
+    move_ship(), which lets it take off to the sector of the planet it is on."""
+    ship = self.get_parent(player)
+    location = self.get_parent(ship) if ship else None
+    if not location or not sector_ids:
+      return 0
+    if location.type != "Sector":
+      if not self.run_command(player,"move",sector_id = sector_ids[0]):
+        return 0
+      return 1 + self._move_through(player,sector_ids[1:])
+    current = str(location)
+    hops = 0
+    for name in self.sector_names(sector_ids):
+      if not name or name not in self.warp_names(current):
+        self.log.info("_move_through(): %s can't warp from %s to %s" % (ship,current,name))
+        break
+      current = name
+      hops += 1
+    if hops:
+      self.log.info("Moving %s to %s in %s hops" % (ship,current,hops))
+      if not self.assign_child(self.get_sector(current),ship):
+        return 0
+    return hops
+  
+  def sector_names(self,sector_ids):
+    """Return the names of a list of sectors given by id or name, None for ids that aren't sectors.
+    
+    Names are returned as they are, and the sectors given by id are loaded in one batch."""
+    sector_ids = [str(id) if id else "" for id in sector_ids]
+    ids = [id for id in sector_ids if not sector_name_pattern.match(id)]
+    loaded = dict((str(obj.id),str(obj)) for obj in self.cache.get_many(ids) if obj and obj.type == "Sector") if ids else {}
+    return [id if sector_name_pattern.match(id) else loaded.get(id) for id in sector_ids]
+  
+  def warp_names(self,sector_name):
+    """Return the names of the sectors a ship can warp to from the named sector, its neighbours and then its links.
+    
+    This is the rule for every warp: get_available_warps(), can_move() and batches of moves all use it.
+    Sectors the route planner has been told are blocked are left out, and so are links to clusters that
+    don't exist."""
+    cluster_name,number = sector_name.rsplit('-',1)
+    cluster = self.clusters.get(cluster_name) or self.load_object(cluster_name)
+    if not cluster:
+      return []
+    names = ["%s-%s" % (cluster_name,n) for n in cluster.neighbors(number)]
+    for name in self.links.get(sector_name,[]):
+      linked_cluster = name.rsplit('-',1)[0]
+      if self.clusters.get(linked_cluster) or self.load_object(linked_cluster):
+        names.append(name)
+      else:
+        self.log.error("warp_names(): Cluster %s does not exist, the link from %s to %s is left out" % (linked_cluster,sector_name,name))
+    return [name for name in names if not self.routes.is_blocked(name)]
+  
+  def plan_route(self,start,destination):
+    """Return the names of the sectors to warp through to get from sector start to destination, ending with it.
+    
+    Returns an empty list if start is destination, and None if destination can't be reached. See RoutePlanner."""
+    return self.routes.route(start,destination)
+  
+  def plan_trip(self,player,destination):
+    """Return the route from the player's sector to a destination sector given by id or name, or None."""
+    ship = self.get_parent(player) if player else None
+    location = self.get_parent(ship) if ship else None
+    destination = self.sector_names([destination])[0]
+    if not location or location.type != "Sector" or not destination:
+      return None
+    return self.plan_route(str(location),destination)
+  
+  def autopilot(self,player,destination):
+    """Fly the player's ship along the shortest route to a destination sector given by id or name.
+    
+    Returns the route taken, or None if there is no route or the ship could not be moved."""
+    route = self.plan_trip(player,destination)
+    if route is None:
+      self.log.info("autopilot(): No route for %s to %s" % (player,destination))
+      return None
+    if self.run_commands(player,[{'command': "move",'sector': name} for name in route]) != len(route):
+      return None
+    return route
+  
+  def visualize_cluster(self,player = None,cluster_name = None):
+    """Return the lines of a text map of a cluster, the player's cluster if no name is given.
+    
+    Each sector is a tile (see ClusterMap), and the player's sector is marked with @. The rows are cached,
+    so only the rows with sectors that changed since the last call are drawn again."""
+    sector = self._sector_of(player) if player else None
+    cluster_name = cluster_name or (sector.cluster_name if sector else None)
+    if not cluster_name:
       self.log.debug("visualize_cluster(): Player has no sector, returning empty list")
       return []
+    lines = self.map.lines(cluster_name)
+    if lines is None and self._index_cluster(cluster_name):
+      lines = self.map.lines(cluster_name)
+    if not lines:
+      return []
+    if sector and sector.cluster_name == cluster_name:
+      x = self.spatial.geometry(cluster_name)[0]
+      row,column = (int(sector.name) - 1) // x,(int(sector.name) - 1) % x
+      lines[row] = lines[row][:column * 2] + "@" + lines[row][column * 2 + 1:]
+    return lines
+  
+  def get_map(self,sector,radius):
+    """Return the map tiles within radius of a sector, as rows of (sector name, tile, True for the sector itself)."""
+    rows = self.map.window(sector.cluster_name,int(sector.name),radius)
+    if rows is None and self._index_cluster(sector.cluster_name):
+      rows = self.map.window(sector.cluster_name,int(sector.name),radius)
+    centre = int(sector.name)
+    return tuple(tuple(("%s-%s" % (sector.cluster_name,number),tile,number == centre) for number,tile in row) for row in rows or ())
   
-  def get_available_warps(self,player = None,ship = None):
-    """Return a list of sector objects available for the player."""
+  def _sector_of(self,entity):
+    """Return the sector an object is in, going up through its parents, or None."""
+    while entity and entity.type != "Sector":
+      entity = self.get_parent(entity)
+    return entity
+  
+  @metrics.timed("get_available_warps")
+  def get_available_warps(self,player = None,ship = None,read_only = False):
+    """Return a list of sector objects available for the player.
+    
+    The names come from warp_names(), and the sectors are loaded in one batch.
+    With read_only, sectors that don't exist yet are returned as unsaved Sector objects instead of being created."""
     if not player and not ship:
       self.log.debug("get_available_warps(): Player and Ship are both None, returning empty list")
       return []
@@ -280,84 +1066,164 @@ class Game(object):
     
     sectors = []
     if sector:
-      sector_number = int(sector.name)
-      self.log.debug("Building list of available warps for sector %s" % sector.to_dict())
-      cluster = self.get_parent(sector)
-      self.log.debug("Cluster loaded as %s" % str(cluster))
-      
-      self.log.debug("Calculations: %s mod %s = %s" % (sector_number,cluster.y,sector_number % cluster.y))
+      self.log.debug("Building list of available warps for sector %s" % sector)
+      sector_names = self.warp_names("%s-%s" % (sector.cluster_name,sector.name))
+      sectors = [s for s in self.get_sectors(sector_names,create = not read_only) or [] if s]
       
-      top_row = True if sector_number <= cluster.x else False
-      left_column = True if sector_number % cluster.y == 1 else False
-      bottom_row = True if sector_number >= (cluster.x * cluster.y - cluster.x) else False
-      right_column = True if sector_number % cluster.y == 0 else False
-      
-      sector_names = []
-      #nw
-      if not top_row and not left_column:
-        sector_names.append("%s-%s" % (sector.cluster_name,(sector_number - cluster.x - 1)))
-        
-      #n
-      if not top_row:
-        sector_names.append("%s-%s" % (sector.cluster_name,(sector_number - cluster.x)))
-      
-      #ne
-      if not top_row and not right_column:
-        sector_names.append("%s-%s" % (sector.cluster_name,(sector_number - cluster.x + 1)))
-      
-      #e
-      if not right_column:
-        sector_names.append("%s-%s" % (sector.cluster_name,(sector_number + 1)))
-      
-      #se
-      if not bottom_row and not right_column:
-        sector_names.append("%s-%s" % (sector.cluster_name,(sector_number + cluster.x + 1)))
-      
-      #s
-      if not bottom_row:
-        sector_names.append("%s-%s" % (sector.cluster_name,(sector_number + cluster.x)))
-      
-      #sw
-      if not bottom_row and not left_column:
-        sector_names.append("%s-%s" % (sector.cluster_name,(sector_number + cluster.x - 1)))
-      
-      #w
-      if not left_column:
-        sector_names.append("%s-%s" % (sector.cluster_name,(sector_number - 1)))
-      
-      for sector_name in sector_names:
-        sectors.append(self.get_sector(sector_name))
-      
-    return sorted(sectors, key = lambda sector: sector.name)
+      #Linked sectors in other clusters are listed after the neighbours
+      return sorted(sectors, key = lambda s: (s.cluster_name != sector.cluster_name,s.cluster_name,int(s.name)))
+    return []
 
+  @metrics.timed("get_sector")
   def get_sector(self,sector_name):
     """Retrieve a sector object from the database. If it doesn't exist, then create it here."""
+    sectors = self.get_sectors([sector_name])
+    return sectors[0] if sectors else None
+  
+  def get_sectors(self,sector_names,create = True):
+    """Retrieve a list of sector objects from the database in one operation.
     
-    loaded_sector = self.db.load_object_by_name(sector_name)
-    if loaded_sector:
-      return loaded_sector
-    else:
+    Any sectors that don't exist are created and saved along with their clusters in one operation.
+    If create is False, they are returned as unsaved Sector objects and nothing is written. Sectors of
+    clusters that don't exist are None, so one bad name (such as a link to a removed cluster) doesn't lose the rest."""
+    return self._retry_on_conflict(self._load_sectors,sector_names,create)
+  
+  def _load_sectors(self,sector_names,create):
+    #Sectors are found in the cache by name, and only the ones that aren't cached are loaded
+    sectors = self.cache.get_sectors(sector_names)
+    missing = [i for i,sector in enumerate(sectors) if not sector]
+    if missing:
+      for i,sector in zip(missing,self.db.load_objects_by_name([sector_names[i] for i in missing])):
+        sectors[i] = self.cache.add(sector)
+    
+    changed = []
+    for i,sector_name in enumerate(sector_names):
+      if sectors[i]:
+        continue
       cluster_name = sector_name.split('-')[0]
       name = sector_name.split('-')[1]
       new_sector = Sector(initial_state = {'cluster_name': cluster_name,'name': name})
-      cluster = self.db.load_object_by_name(cluster_name)
-      self.log.debug("get_sector(): Loaded cluster as %s" % str(cluster))
-      self.assign_child(cluster,new_sector)
-      self.log.debug("get_sector(): Returning sector %s with parent %s" % (str(new_sector),str(new_sector.parent)))
-      return new_sector
+      cluster = self.load_object(cluster_name)
+      self.log.debug("get_sectors(): Loaded cluster as %s",cluster)
+      if not cluster:
+        self.log.error("get_sectors(): Cluster %s does not exist, sector %s was not created" % (cluster_name,sector_name))
+        continue
+      new_sector.parent = cluster.id
+      sectors[i] = new_sector
+      if not create:
+        continue
+      cluster.add_child(new_sector)
+      changed.append(new_sector)
+      if not any(c is cluster for c in changed):
+        changed.append(cluster)
     
-    return None
+    if changed:
+      self.log.debug("get_sectors(): Creating sectors %s",changed)
+      if not all(self.save_objects(changed)):
+        self.log.error("get_sectors(): Error saving new sectors %s" % str(changed))
+        return None
+    return sectors
     
-class Cache(deque):
-  """Hold a cache of objects of a limited size. When the cache is full, the oldest item is removed from the left."""
+class Cache(object):
+  """Hold an identity map of objects of a limited size, so the same id always returns the same object.
+  
+  When the cache is full, the least recently used object is removed. The cache can be shared between
+  threads, objects are loaded from the database outside of the lock so threads don't wait on each other's reads."""
   def __init__(self,size,database):
-    super(Cache,self).__init__()
     self.size = size
     self.db = database
+    self.objects = OrderedDict()
+    #Sector name (such as alpha-5) to the id of the cached sector, so sectors can be found by name
+    self.sector_ids = {}
+    self.lock = threading.RLock()
+    
+    #Counters
+    self.hits = 0
+    self.misses = 0
+  
+  def __len__(self):
+    return len(self.objects)
+  
+  def __contains__(self,id):
+    return str(id) in self.objects
   
   def get(self,id):
-    if id in self:
-      return self[id]
+    """Return the object with the given id, loading it from the database if it isn't cached."""
+    id = str(id)
+    obj = self._lookup(id)
+    if obj:
+      return obj
     else:
       #Load item from database
-      self.db.load()
+      with self.lock:
+        self.misses += 1
+      return self.add(self.db.load_object(id))
+  
+  def get_many(self,ids):
+    """Return a list of objects for the given ids, loading all of the uncached objects in one database operation."""
+    ids = [str(id) for id in ids]
+    objs = [self._lookup(id) for id in ids]
+    missing = [id for id,obj in zip(ids,objs) if obj is None]
+    if missing:
+      with self.lock:
+        self.misses += len(missing)
+      loaded = dict((id,self.add(obj)) for id,obj in zip(missing,self.db.load_objects(missing)) if obj)
+      objs = [obj if obj else loaded.get(id) for id,obj in zip(ids,objs)]
+    return objs
+  
+  def get_sectors(self,sector_names):
+    """Return a list of the cached sectors with the given names, None for any that aren't cached."""
+    with self.lock:
+      return [self._lookup(self.sector_ids[name]) if name in self.sector_ids else None for name in sector_names]
+  
+  def add(self,obj):
+    """Add an object loaded outside of the cache.
+    
+    If the id is already cached, the cached object is returned instead so there is only one copy of each object."""
+    if not obj:
+      return None
+    with self.lock:
+      return self._lookup(str(obj.id)) or self._store(obj)
+  
+  def put(self,obj):
+    """Store an object that was just saved, replacing any cached copy (write-through)."""
+    with self.lock:
+      self._remove(str(obj.id))
+      return self._store(obj)
+  
+  def invalidate(self,id):
+    """Remove an object from the cache, so it will be reloaded from the database next time."""
+    with self.lock:
+      self._remove(str(id))
+  
+  def clear(self):
+    with self.lock:
+      self.objects.clear()
+      self.sector_ids.clear()
+  
+  def _lookup(self,id):
+    """Return a cached object and mark it as the most recently used, or None if it isn't cached."""
+    with self.lock:
+      obj = self.objects.pop(id,None)
+      if obj is None:
+        return None
+      self.hits += 1
+      self.objects[id] = obj
+      return obj
+  
+  def _store(self,obj):
+    self.objects[str(obj.id)] = obj
+    if obj.type == "Sector":
+      self.sector_ids[str(obj)] = str(obj.id)
+    while len(self.objects) > self.size:
+      self._forget(*self.objects.popitem(last = False))
+    return obj
+  
+  def _remove(self,id):
+    obj = self.objects.pop(id,None)
+    if obj is not None:
+      self._forget(id,obj)
+  
+  def _forget(self,id,obj):
+    if obj.type == "Sector" and self.sector_ids.get(str(obj)) == id:
+      del self.sector_ids[str(obj)]
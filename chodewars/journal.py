@@ -0,0 +1,270 @@
+import os
+import json
+import fcntl
+import struct
+import threading
+import zlib
+
+from contextlib import contextmanager
+
+class ConflictError(Exception):
+  """Raised when an object is saved from an older version than the one in the database.
+  
+  ids is the list of object ids that were out of date."""
+  def __init__(self,ids):
+    super(ConflictError,self).__init__("Objects were changed by someone else: %s" % ", ".join(ids))
+    self.ids = ids
+
+class GroupCommit(object):
+  """Group the commits of concurrent threads so one durable write (and one fsync) covers all of them.
+  
+  Each thread calls commit() with its batch. The first thread to arrive becomes the leader and writes
+  every batch that is waiting by calling write(batches), the others wait for the leader to finish.
+  Batches that arrive while the leader is writing are written together by the next leader.
+  
+  write() may return a list with an exception (or None) for each batch, to fail some batches of a group
+  without failing the others."""
+  
+  def __init__(self,write):
+    self.write = write
+    self.condition = threading.Condition()
+    self.pending = []
+    self.writing = False
+    
+    #Counters
+    self.commits = 0
+    self.groups = 0
+  
+  def commit(self,batch):
+    """Write a batch, returning once it (and whatever it was grouped with) is durable."""
+    entry = {'batch': batch,'done': False,'error': None}
+    with self.condition:
+      self.pending.append(entry)
+      while not entry['done'] and self.writing:
+        self.condition.wait()
+      if entry['done']:
+        if entry['error']:
+          raise entry['error']
+        return True
+      
+      #This thread is the leader for everything that is waiting
+      self.writing = True
+      group = self.pending
+      self.pending = []
+    
+    errors = None
+    try:
+      errors = self.write([e['batch'] for e in group])
+    except Exception,e:
+      errors = [e for g in group]
+    errors = errors or [None for g in group]
+    
+    with self.condition:
+      for e,error in zip(group,errors):
+        e['done'] = True
+        e['error'] = error
+      self.commits += len(group)
+      self.groups += 1
+      self.writing = False
+      self.condition.notify_all()
+    if entry['error']:
+      raise entry['error']
+    return True
+
+class Journal(object):
+  """A write-ahead journal of file contents, used to replace several files atomically.
+  
+  A commit appends one block holding the new contents of every file to the journal and fsyncs it,
+  then puts each file in place with a rename. A block that was only partly written is ignored when
+  the journal is replayed, so either every file in a commit is replaced or none are. Concurrent commits
+  share a block through GroupCommit.
+  
+  The files themselves are not fsynced on each commit. Instead, once the journal grows past
+  checkpoint_size, every file written since the last checkpoint is fsynced and the journal is emptied.
+  
+  A commit can give the version it expects each file to be at, which is checked against current_version(filename)
+  (and against earlier commits in the same group) while holding an exclusive lock on the journal, so other
+  processes using the same journal can't write in between. A commit with an out of date file raises ConflictError."""
+  
+  #Each block is the payload length and crc32, followed by a payload of files
+  header = struct.Struct(">II")
+  #Each file in a payload is the length of its name and of its contents, followed by the name and contents
+  file_header = struct.Struct(">HI")
+  
+  def __init__(self,path,directory,checkpoint_size = 1024 * 1024,current_version = None):
+    self.path = path
+    self.directory = directory
+    self.checkpoint_size = checkpoint_size
+    self.current_version = current_version
+    self.group_commit = GroupCommit(self._write)
+    self.dirty = set()
+    self.file = None
+  
+  def open(self):
+    """Open the journal for appending, and replay anything left in it from a crash.
+    
+    Returns the list of filenames that were replayed."""
+    self.file = open(self.path,'ab')
+    fcntl.flock(self.file.fileno(),fcntl.LOCK_EX)
+    try:
+      return self.replay()
+    finally:
+      fcntl.flock(self.file.fileno(),fcntl.LOCK_UN)
+  
+  def close(self):
+    if self.file:
+      fcntl.flock(self.file.fileno(),fcntl.LOCK_EX)
+      try:
+        self.checkpoint()
+      finally:
+        fcntl.flock(self.file.fileno(),fcntl.LOCK_UN)
+      self.file.close()
+      self.file = None
+  
+  @contextmanager
+  def locked(self):
+    """Hold the journal's exclusive lock, so no other process commits while something shared with it is updated.
+    
+    The lock is taken through a file of its own, so it also keeps out commits from this process."""
+    with open(self.path,'ab') as f:
+      fcntl.flock(f.fileno(),fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(f.fileno(),fcntl.LOCK_UN)
+  
+  def commit(self,files,versions = {}):
+    """Atomically replace files, given a dictionary of filename (relative to directory) to contents.
+    
+    versions is an optional dictionary of filename to the version it must currently be at."""
+    return self.group_commit.commit((files,versions))
+  
+  def replay(self):
+    """Put the contents of every complete block in the journal back in place.
+    
+    The journal has to be locked, or not in use by any other process."""
+    replayed = []
+    for files in self._blocks():
+      self._apply(files)
+      replayed.extend(files.keys())
+    if replayed:
+      self.checkpoint()
+    return replayed
+  
+  def checkpoint(self):
+    """Make every file in the journal and their directory durable, then empty the journal.
+    
+    Other processes may have written blocks to the journal too, so their files are made durable as well.
+    The journal has to be locked, or not in use by any other process."""
+    filenames = set(self.dirty)
+    for files in self._blocks():
+      filenames.update(files.keys())
+    for filename in filenames:
+      path = os.path.join(self.directory,filename)
+      if os.path.exists(path):
+        with open(path,'rb') as f:
+          os.fsync(f.fileno())
+    #The renames that put the files in place are only durable once the directory is, and after the
+    #journal is emptied nothing could redo them
+    if filenames:
+      fd = os.open(self.directory,os.O_RDONLY)
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+    self.dirty = set()
+    if self.file:
+      self.file.truncate(0)
+      os.fsync(self.file.fileno())
+    else:
+      with open(self.path,'wb') as f:
+        os.fsync(f.fileno())
+  
+  def _write(self,batches):
+    """Write a group of commits as one journal block with a single fsync, then apply them in order.
+    
+    Returns a list with a ConflictError (or None) for each commit."""
+    fcntl.flock(self.file.fileno(),fcntl.LOCK_EX)
+    try:
+      files = {}
+      errors = []
+      group_versions = {}
+      for batch_files,versions in batches:
+        conflicts = [f for f,version in versions.items() if group_versions.get(f,self._current_version(f)) != version]
+        if conflicts:
+          errors.append(ConflictError(conflicts))
+          continue
+        errors.append(None)
+        files.update(batch_files)
+        for f,version in versions.items():
+          group_versions[f] = version + 1
+      if not files:
+        return errors
+      
+      payload = self._encode(files)
+      self.file.write(self.header.pack(len(payload),zlib.crc32(payload) & 0xffffffff) + payload)
+      self.file.flush()
+      os.fsync(self.file.fileno())
+      self._apply(files)
+      if self.file.tell() >= self.checkpoint_size:
+        self.checkpoint()
+      return errors
+    finally:
+      fcntl.flock(self.file.fileno(),fcntl.LOCK_UN)
+  
+  def _blocks(self):
+    """Return the files of every complete block in the journal, in order."""
+    if not os.path.exists(self.path):
+      return []
+    blocks = []
+    with open(self.path,'rb') as f:
+      while True:
+        header = f.read(self.header.size)
+        if len(header) < self.header.size:
+          break
+        length,crc = self.header.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+          #The last commit never finished, so none of it is applied
+          break
+        blocks.append(self._decode(payload))
+    return blocks
+  
+  def _encode(self,files):
+    """Pack filename to contents into a payload, contents can be text or binary."""
+    data = []
+    for filename,contents in files.items():
+      filename = filename.encode('utf-8') if isinstance(filename,unicode) else filename
+      contents = contents.encode('utf-8') if isinstance(contents,unicode) else contents
+      data.append(self.file_header.pack(len(filename),len(contents)))
+      data.append(filename)
+      data.append(contents)
+    return "".join(data)
+  
+  def _decode(self,payload):
+    """Unpack a payload written by _encode, or a JSON payload written before journals held binary files."""
+    if payload[:1] == "{":
+      return json.loads(payload)
+    files = {}
+    pos = 0
+    while pos < len(payload):
+      name_length,contents_length = self.file_header.unpack_from(payload,pos)
+      pos += self.file_header.size
+      filename = payload[pos:pos + name_length]
+      pos += name_length
+      files[filename] = payload[pos:pos + contents_length]
+      pos += contents_length
+    return files
+  
+  def _current_version(self,filename):
+    return self.current_version(filename) if self.current_version else 0
+  
+  def _apply(self,files):
+    for filename,contents in files.items():
+      path = os.path.join(self.directory,filename)
+      #Temporary files are kept next to the journal, so they never show up in the directory as objects
+      tmp_path = os.path.join(os.path.dirname(self.path),"%s.tmp" % filename)
+      with open(tmp_path,'wb') as f:
+        f.write(contents.encode('utf-8') if isinstance(contents,unicode) else contents)
+      os.rename(tmp_path,path)
+      self.dirty.add(filename)
@@ -0,0 +1,176 @@
+import time
+import threading
+
+from functools import wraps
+
+#Upper bounds, in seconds, of the latency histogram buckets
+latency_buckets = (0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5)
+
+#Upper bounds of the buckets for the number of objects a request reads or writes
+count_buckets = (0,1,2,5,10,25,50,100,250,500,1000)
+
+def _labels(labels):
+  """Format a dictionary of labels the way Prometheus expects, for example {operation="move_ship"}."""
+  if not labels:
+    return ""
+  return "{%s}" % ",".join('%s="%s"' % (key,str(value).replace('\\','\\\\').replace('"','\\"')) for key,value in sorted(labels.items()))
+
+class Counter(object):
+  """A number that only goes up, kept separately for each set of label values."""
+  type = "counter"
+
+  def __init__(self,name,help):
+    self.name = name
+    self.help = help
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def inc(self,amount = 1,**labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      self.values[key] = self.values.get(key,0) + amount
+
+  def value(self,**labels):
+    return self.values.get(tuple(sorted(labels.items())),0)
+
+  def samples(self):
+    with self.lock:
+      return [(self.name,dict(key),value) for key,value in sorted(self.values.items())]
+
+class Gauge(object):
+  """A number that is read from a function each time the metrics are rendered."""
+  type = "gauge"
+
+  def __init__(self,name,help,function):
+    self.name = name
+    self.help = help
+    self.function = function
+
+  def samples(self):
+    return [(self.name,{},self.function())]
+
+class CounterFunction(Gauge):
+  """A total that only goes up and is kept somewhere else, read from a function each time the metrics are rendered."""
+  type = "counter"
+
+class Histogram(object):
+  """Counts of observed values in cumulative buckets, with their sum and count, kept for each set of label values."""
+  type = "histogram"
+
+  def __init__(self,name,help,buckets = latency_buckets):
+    self.name = name
+    self.help = help
+    self.buckets = tuple(sorted(buckets))
+    #Label values to [bucket counts, sum, count]
+    self.values = {}
+    self.lock = threading.Lock()
+
+  def observe(self,value,**labels):
+    key = tuple(sorted(labels.items()))
+    with self.lock:
+      series = self.values.get(key)
+      if series is None:
+        series = self.values[key] = [[0] * len(self.buckets),0,0]
+      for i,bound in enumerate(self.buckets):
+        if value <= bound:
+          series[0][i] += 1
+      series[1] += value
+      series[2] += 1
+
+  def count(self,**labels):
+    series = self.values.get(tuple(sorted(labels.items())))
+    return series[2] if series else 0
+
+  def samples(self):
+    samples = []
+    with self.lock:
+      for key,(bucket_counts,total,count) in sorted(self.values.items()):
+        labels = dict(key)
+        for bound,bucket_count in zip(self.buckets,bucket_counts):
+          samples.append(("%s_bucket" % self.name,dict(labels,le = repr(float(bound))),bucket_count))
+        samples.append(("%s_bucket" % self.name,dict(labels,le = "+Inf"),count))
+        samples.append(("%s_sum" % self.name,labels,total))
+        samples.append(("%s_count" % self.name,labels,count))
+    return samples
+
+class Registry(object):
+  """The metrics that are exposed, rendered in the Prometheus text format."""
+
+  def __init__(self):
+    self.metrics = []
+    self.lock = threading.Lock()
+
+  def add(self,metric):
+    """Add a metric, replacing any metric that already has its name."""
+    with self.lock:
+      self.metrics = [m for m in self.metrics if m.name != metric.name] + [metric]
+    return metric
+
+  def render(self):
+    lines = []
+    for metric in list(self.metrics):
+      lines.append("# HELP %s %s" % (metric.name,metric.help))
+      lines.append("# TYPE %s %s" % (metric.name,metric.type))
+      for name,labels,value in metric.samples():
+        lines.append("%s%s %s" % (name,_labels(labels),repr(float(value)) if isinstance(value,float) else value))
+    return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+storage_reads = registry.add(Counter("chodewars_storage_reads_total","Objects read from storage."))
+storage_writes = registry.add(Counter("chodewars_storage_writes_total","Objects written to storage."))
+operation_seconds = registry.add(Histogram("chodewars_operation_seconds","Time taken by game operations."))
+request_seconds = registry.add(Histogram("chodewars_request_seconds","Time taken to handle a request."))
+request_reads = registry.add(Histogram("chodewars_request_storage_reads","Objects read from storage while handling a request.",count_buckets))
+request_writes = registry.add(Histogram("chodewars_request_storage_writes","Objects written to storage while handling a request.",count_buckets))
+
+#Reads and writes made by the current thread since begin_request()
+local = threading.local()
+
+def read(count = 1):
+  """Count objects read from storage."""
+  storage_reads.inc(count)
+  if getattr(local,'counting',False):
+    local.reads += count
+
+def wrote(count = 1):
+  """Count objects written to storage."""
+  storage_writes.inc(count)
+  if getattr(local,'counting',False):
+    local.writes += count
+
+def begin_request():
+  """Start counting the storage reads and writes made by this thread."""
+  local.counting = True
+  local.reads = 0
+  local.writes = 0
+
+def end_request():
+  """Stop counting for this thread, returning the (reads, writes) made since begin_request()."""
+  local.counting = False
+  return (getattr(local,'reads',0),getattr(local,'writes',0))
+
+def record_request(handler,seconds,reads,writes):
+  """Record the time taken and the reads and writes made by a finished request."""
+  request_seconds.observe(seconds,handler = handler)
+  request_reads.observe(reads,handler = handler)
+  request_writes.observe(writes,handler = handler)
+
+def add_cache_metrics(cache):
+  """Expose the size of a game's cache, and its hits and misses."""
+  registry.add(Gauge("chodewars_cache_objects","Objects in the game's cache.",lambda: len(cache)))
+  registry.add(CounterFunction("chodewars_cache_hits_total","Lookups answered by the game's cache.",lambda: cache.hits))
+  registry.add(CounterFunction("chodewars_cache_misses_total","Lookups the game's cache had to load from storage.",lambda: cache.misses))
+
+def timed(operation):
+  """Decorator that records how long each call takes in the operation_seconds histogram."""
+  def decorator(fn):
+    @wraps(fn)
+    def wrapper(*args,**kwargs):
+      start = time.time()
+      try:
+        return fn(*args,**kwargs)
+      finally:
+        operation_seconds.observe(time.time() - start,operation = operation)
+    return wrapper
+  return decorator
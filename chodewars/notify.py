@@ -0,0 +1,132 @@
+import os
+import errno
+import socket
+import logging
+import threading
+
+from uuid import uuid4
+
+class Notifier(object):
+  """Tell the other processes of a game which objects were changed, so they can drop them from their caches.
+
+  Each process binds a Unix datagram socket in directory, and publish() sends the
+  changed ids to every other socket there. A socket left behind by a process that exited is removed the
+  first time a message to it is refused. Messages are sent just after the save, so another process can
+  still read its cached copy for a moment; saves from an out of date copy are caught by the version check."""
+
+  #Largest message sent at once, longer lists of ids are split over several messages
+  message_size = 32 * 1024
+
+  def __init__(self,directory):
+    self.log = logging.getLogger('chodewars.notify')
+    self.directory = directory
+    #Named after the process, and this notifier in case a process has more than one game
+    self.path = os.path.join(directory,"%s-%s.sock" % (os.getpid(),uuid4().hex[:8]))
+    self.sender = socket.socket(socket.AF_UNIX,socket.SOCK_DGRAM)
+    self.sender.settimeout(1.0)
+    self.receiver = None
+    self.thread = None
+    self.callbacks = []
+    #Sockets of the other processes, listed again when the directory changes
+    self.peers = []
+    self.peers_mtime = None
+
+    #Counters
+    self.sent = 0
+    self.received = 0
+
+  def subscribe(self,callback):
+    """Call callback(ids) with the ids other processes publish, starting the listening thread the first time."""
+    self.callbacks.append(callback)
+    if not self.receiver:
+      if not os.path.exists(self.directory):
+        os.makedirs(self.directory)
+      if os.path.exists(self.path):
+        os.remove(self.path)
+      self.receiver = socket.socket(socket.AF_UNIX,socket.SOCK_DGRAM)
+      self.receiver.bind(self.path)
+      self.thread = threading.Thread(target = self._listen,name = "chodewars-notify")
+      self.thread.daemon = True
+      self.thread.start()
+    return True
+
+  def publish(self,ids):
+    """Send a list of changed ids to every other process."""
+    ids = [str(id) for id in ids]
+    if not ids or not os.path.exists(self.directory):
+      return False
+    messages = []
+    message = []
+    size = 0
+    for id in ids:
+      if message and size + len(id) + 1 > self.message_size:
+        messages.append("\n".join(message))
+        message = []
+        size = 0
+      message.append(id)
+      size += len(id) + 1
+    messages.append("\n".join(message))
+
+    for path in self._peers():
+      try:
+        for m in messages:
+          self.sender.sendto(m,path)
+        self.sent += 1
+      except socket.error,e:
+        if e.errno in (errno.ECONNREFUSED,errno.ENOENT):
+          self.log.info("publish(): Removing %s, its process has exited" % path)
+          try:
+            os.remove(path)
+          except OSError:
+            pass
+          self.peers_mtime = None
+        else:
+          self.log.error("publish(): Could not send changes to %s: %s" % (path,e))
+    return True
+
+  def _peers(self):
+    """Return the paths of the other processes' sockets.
+    
+    Sockets are only added and removed as processes start and exit, which changes the directory's
+    modification time, so the directory is only listed again when that changes."""
+    mtime = os.stat(self.directory).st_mtime
+    if mtime != self.peers_mtime:
+      self.peers = [os.path.join(self.directory,f) for f in os.listdir(self.directory)
+                    if f.endswith(".sock") and os.path.join(self.directory,f) != self.path]
+      self.peers_mtime = mtime
+    return self.peers
+
+  def close(self):
+    """Stop listening and remove this process's socket."""
+    receiver = self.receiver
+    if receiver:
+      self.receiver = None
+      #Wake the listening thread so it sees it should stop
+      try:
+        self.sender.sendto("",self.path)
+      except socket.error:
+        pass
+      self.thread.join(1.0)
+      receiver.close()
+      if os.path.exists(self.path):
+        os.remove(self.path)
+    self.sender.close()
+
+  def _listen(self):
+    receiver = self.receiver
+    while True:
+      try:
+        message = receiver.recv(self.message_size + 1024)
+      except socket.error:
+        break
+      if not self.receiver:
+        break
+      if not message:
+        continue
+      self.received += 1
+      ids = message.split("\n")
+      for callback in self.callbacks:
+        try:
+          callback(ids)
+        except Exception:
+          self.log.exception("_listen(): Error handling changed ids")
@@ -7,5 +7,4 @@ class Player(Entity):
   
   This is linked to a user account, which is currently a Google account."""
   
-  def __init__(self,initial_state = {}):
-    super(Player,self).__init__(initial_state = initial_state)
+  __slots__ = ()
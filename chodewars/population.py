@@ -0,0 +1,82 @@
+from array import array
+from itertools import compress,imap,repeat
+from operator import add,mul
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+class PopulationTable(object):
+  """The population and growth of every habitable entity, held as columns so a tick is a few array operations.
+
+  Columns are arrays of C longs. A tick uses NumPy when it is installed, and the array module's C loops
+  (through map) otherwise, so no entity objects are touched. Each tick adds population_growth to the
+  population, which never goes below 0."""
+
+  def __init__(self,use_numpy = True):
+    self.numpy = numpy if use_numpy else None
+    self.ids = []
+    #Entity id to its position in the columns
+    self.index = {}
+    self.populations = array('l')
+    self.growths = array('l')
+    #Ids of the entities with a growth, and positions of the ones with a negative growth, None when out of date
+    self.growing = None
+    self.shrinking = None
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __contains__(self,id):
+    return str(id) in self.index
+
+  def add(self,entity):
+    """Add a habitable entity, or update the population and growth of one already in the table."""
+    self.extend([entity.id],[entity.population],[entity.population_growth])
+
+  def extend(self,ids,populations,growths):
+    """Add the columns of several entities at once."""
+    for id,population,growth in zip(ids,populations,growths):
+      id = str(id)
+      i = self.index.get(id)
+      if i is None:
+        self.index[id] = len(self.ids)
+        self.ids.append(id)
+        self.populations.append(population)
+        self.growths.append(growth)
+      else:
+        self.populations[i] = population
+        self.growths[i] = growth
+    self.growing = None
+
+  def population(self,id):
+    i = self.index.get(str(id))
+    return self.populations[i] if i is not None else None
+
+  def tick(self,ticks = 1):
+    """Advance every population by a number of ticks, returning the ids of the entities whose population changed."""
+    count = len(self.ids)
+    if not count:
+      return []
+    if self.growing is None:
+      self.growing = list(compress(self.ids,self.growths))
+      self.shrinking = list(compress(xrange(count),imap(lambda g: g < 0,self.growths)))
+    #Entities that were already at 0 and are still shrinking don't change
+    stuck = set(self.ids[i] for i in self.shrinking if self.populations[i] == 0)
+    if self.numpy:
+      populations = self.numpy.frombuffer(self.populations,dtype = self.numpy.int_)
+      growths = self.numpy.frombuffer(self.growths,dtype = self.numpy.int_)
+      updated = populations + growths * ticks
+      if self.shrinking:
+        self.numpy.maximum(updated,0,out = updated)
+      self.populations = array('l',updated.tostring())
+    else:
+      step = self.growths if ticks == 1 else array('l',imap(mul,self.growths,repeat(ticks,count)))
+      self.populations = array('l',imap(add,self.populations,step))
+      for i in self.shrinking:
+        if self.populations[i] < 0:
+          self.populations[i] = 0
+    if stuck:
+      return [id for id in self.growing if id not in stuck]
+    return list(self.growing)
@@ -0,0 +1,348 @@
+import threading
+
+from array import array
+from collections import OrderedDict
+
+from cluster import neighbor_table
+
+def split_name(sector_name):
+  """Return the cluster name and sector number of a sector name such as alpha-5."""
+  cluster_name,number = sector_name.rsplit('-',1)
+  return cluster_name,int(number)
+
+class Grid(object):
+  """Distances and next hops between the sectors of an x by y cluster, avoiding blocked sectors.
+
+  Ships can warp diagonally, so with nothing blocked the distance is the larger of the row and column
+  differences and no tables are needed. Otherwise the distances and next hops towards a destination are
+  found with a breadth first search the first time they are asked for, and the most recently used tables
+  are kept. Tables are indexed by sector number, -1 is a sector that can't reach the destination."""
+
+  def __init__(self,x,y,blocked = frozenset(),table_count = 64):
+    self.x = int(x)
+    self.y = int(y)
+    self.blocked = frozenset(blocked)
+    self.neighbors = neighbor_table(self.x,self.y)
+    self.table_count = table_count
+    #Destination to its (distances, next hops) tables
+    self.tables = OrderedDict()
+    self.lock = threading.Lock()
+
+    #Counters
+    self.searches = 0
+
+  def __contains__(self,sector_number):
+    return 1 <= sector_number <= self.x * self.y
+
+  def distance(self,a,b):
+    """Return the number of warps from sector number a to b, or None if b can't be reached."""
+    if a in self.blocked or b in self.blocked:
+      return None
+    if not self.blocked:
+      return max(abs((a - 1) // self.x - (b - 1) // self.x),abs((a - 1) % self.x - (b - 1) % self.x))
+    distance = self.table(b)[0][a]
+    return distance if distance >= 0 else None
+
+  def next_hop(self,a,b):
+    """Return the sector number to warp to from a on a shortest route to b, or None if a is b or b can't be reached."""
+    if a == b or a in self.blocked or b in self.blocked:
+      return None
+    if not self.blocked:
+      row = cmp((b - 1) // self.x,(a - 1) // self.x)
+      column = cmp((b - 1) % self.x,(a - 1) % self.x)
+      return a + row * self.x + column
+    return self.table(b)[1][a] or None
+
+  def path(self,a,b):
+    """Return the sector numbers of a shortest route from a to b, not including a, or None if b can't be reached."""
+    if self.distance(a,b) is None:
+      return None
+    path = []
+    while a != b:
+      a = self.next_hop(a,b)
+      path.append(a)
+    return path
+
+  def table(self,destination):
+    """Return the (distances, next hops) tables towards a destination, searching for them if they aren't kept."""
+    with self.lock:
+      tables = self.tables.pop(destination,None)
+      if tables is None:
+        tables = self._search(destination)
+      self.tables[destination] = tables
+      while len(self.tables) > self.table_count:
+        self.tables.popitem(last = False)
+      return tables
+
+  def _search(self,destination):
+    self.searches += 1
+    distances = array('i',[-1]) * (self.x * self.y + 1)
+    hops = array('i',[0]) * (self.x * self.y + 1)
+    distances[destination] = 0
+    neighbors = self.neighbors
+    blocked = self.blocked
+    frontier = [destination]
+    distance = 0
+    while frontier:
+      distance += 1
+      next_frontier = []
+      for n in frontier:
+        for m in neighbors[n]:
+          if distances[m] < 0 and m not in blocked:
+            distances[m] = distance
+            hops[m] = n
+            next_frontier.append(m)
+      frontier = next_frontier
+    return (distances,hops)
+
+  def changed(self,blocked):
+    """Return a grid with a different set of blocked sectors, keeping the tables the change doesn't affect.
+
+    A table still holds when a newly blocked sector isn't the next hop of any sector, and when a newly
+    unblocked sector doesn't give any of its neighbours a shorter route. Only the changed sector's own
+    entries are updated, in a copy, since the tables may still be used by this grid."""
+    grid = Grid(self.x,self.y,blocked,self.table_count)
+    added = grid.blocked - self.blocked
+    removed = self.blocked - grid.blocked
+    with self.lock:
+      tables = list(self.tables.items())
+    for destination,(distances,hops) in tables:
+      if destination in grid.blocked or any(n in hops for n in added):
+        continue
+      distances = array('i',distances)
+      hops = array('i',hops)
+      for n in added:
+        distances[n] = -1
+        hops[n] = 0
+      if all(self._reconnect(n,distances,hops,grid.blocked) for n in removed):
+        grid.tables[destination] = (distances,hops)
+    return grid
+
+  def _reconnect(self,n,distances,hops,blocked):
+    """Give an unblocked sector its distance and next hop, returning False if it shortens another sector's route."""
+    around = [m for m in self.neighbors[n] if m not in blocked]
+    reachable = [m for m in around if distances[m] >= 0]
+    if not reachable:
+      return True
+    nearest = min(reachable,key = lambda m: distances[m])
+    if any(distances[m] < 0 or distances[m] > distances[nearest] + 2 for m in around):
+      return False
+    distances[n] = distances[nearest] + 1
+    hops[n] = nearest
+    return True
+
+class RoutePlanner(object):
+  """Plans routes between sectors by name, through the warps of each cluster and the links between clusters.
+
+  Clusters of the same size with the same blocked sectors share a Grid, so their tables are only built once.
+  Routes between clusters go through linked sectors. The distances between every pair of linked sectors are
+  worked out the first time they are needed, and kept until a sector is blocked or unblocked.
+
+  load_cluster(cluster name) returns the Cluster object of a cluster the planner hasn't seen yet, for its size."""
+
+  def __init__(self,links = None,load_cluster = None,table_count = 64):
+    self.links = links or {}
+    self.load_cluster = load_cluster
+    self.table_count = table_count
+    #(x, y, blocked sector numbers) to the Grid of that geometry
+    self.grids = {}
+    #Cluster name to the key of its grid, grids no cluster uses are dropped
+    self.cluster_grids = {}
+    #Linked sectors with the distances and next steps between every pair of them, see _linked_table()
+    self.linked = None
+    self.lock = threading.RLock()
+
+  def add_cluster(self,cluster_name,x,y,blocked = ()):
+    with self.lock:
+      key = (int(x),int(y),frozenset(blocked))
+      if key not in self.grids:
+        self.grids[key] = Grid(x,y,blocked,self.table_count)
+      self._use_grid(cluster_name,key)
+      self.linked = None
+
+  def _use_grid(self,cluster_name,key):
+    """Point a cluster at a grid, dropping the grid it used before if no other cluster uses it."""
+    previous = self.cluster_grids.get(cluster_name)
+    self.cluster_grids[cluster_name] = key
+    if previous is not None and previous != key and previous not in self.cluster_grids.values():
+      del self.grids[previous]
+
+  def grid(self,cluster_name):
+    """Return the Grid of a cluster, or None if there is no such cluster.
+
+    Names that aren't clusters aren't remembered, they can come from players and the cluster may be created later."""
+    with self.lock:
+      key = self.cluster_grids.get(cluster_name)
+      if key is not None:
+        return self.grids[key]
+    cluster = self.load_cluster(cluster_name) if self.load_cluster else None
+    if not cluster:
+      return None
+    with self.lock:
+      if cluster_name not in self.cluster_grids:
+        self.add_cluster(cluster_name,cluster.x,cluster.y)
+      return self.grids[self.cluster_grids[cluster_name]]
+
+  def _locate(self,sector_name):
+    """Return (grid, sector number) of a sector name, or (None, None) if it isn't in a cluster."""
+    try:
+      cluster_name,number = split_name(sector_name)
+    except ValueError:
+      return None,None
+    grid = self.grid(cluster_name)
+    if not grid or number not in grid:
+      return None,None
+    return grid,number
+
+  def is_blocked(self,sector_name):
+    grid,number = self._locate(sector_name)
+    return bool(grid) and number in grid.blocked
+
+  def block(self,sector_names):
+    """Stop routes going through the named sectors."""
+    self._change(sector_names,True)
+
+  def unblock(self,sector_names):
+    self._change(sector_names,False)
+
+  def _change(self,sector_names,blocking):
+    with self.lock:
+      numbers = {}
+      for sector_name in sector_names:
+        grid,number = self._locate(sector_name)
+        if grid:
+          numbers.setdefault(split_name(sector_name)[0],set()).add(number)
+      for cluster_name,changed in numbers.items():
+        grid = self.grid(cluster_name)
+        blocked = grid.blocked | changed if blocking else grid.blocked - changed
+        key = (grid.x,grid.y,frozenset(blocked))
+        if key not in self.grids:
+          self.grids[key] = grid.changed(blocked)
+        self._use_grid(cluster_name,key)
+      if numbers:
+        self.linked = None
+
+  def _linked_table(self):
+    """Return (names, name to index, linked sectors of each cluster, distances, next steps) for the linked sectors.
+
+    The table is built with Floyd-Warshall over steps that are either a link or a route within a cluster."""
+    with self.lock:
+      if self.linked is not None:
+        return self.linked
+      names = sorted(set(self.links) | set(name for linked in self.links.values() for name in linked))
+      located = [(name,) + self._locate(name) for name in names]
+      located = [(name,grid,number) for name,grid,number in located if grid and number not in grid.blocked]
+      names = [name for name,grid,number in located]
+      index = dict((name,i) for i,name in enumerate(names))
+      by_cluster = {}
+      for i,(name,grid,number) in enumerate(located):
+        by_cluster.setdefault(split_name(name)[0],[]).append((i,number))
+
+      count = len(names)
+      distances = [[None] * count for i in xrange(count)]
+      steps = [[None] * count for i in xrange(count)]
+      for cluster_name,linked in by_cluster.items():
+        grid = self.grid(cluster_name)
+        for i,a in linked:
+          for j,b in linked:
+            distances[i][j] = grid.distance(a,b)
+            steps[i][j] = j if distances[i][j] is not None else None
+      for name in names:
+        for other in self.links.get(name,()):
+          i,j = index[name],index.get(other)
+          if j is not None and i != j and (distances[i][j] is None or distances[i][j] > 1):
+            distances[i][j] = 1
+            steps[i][j] = j
+      for k in xrange(count):
+        for i in xrange(count):
+          if distances[i][k] is None:
+            continue
+          for j in xrange(count):
+            if distances[k][j] is not None and (distances[i][j] is None or distances[i][k] + distances[k][j] < distances[i][j]):
+              distances[i][j] = distances[i][k] + distances[k][j]
+              steps[i][j] = steps[i][k]
+      self.linked = (names,index,by_cluster,distances,steps)
+      return self.linked
+
+  def _best(self,a,b):
+    """Return (distance, first linked sector, last linked sector) of the shortest route from a to b.
+
+    The linked sectors are indexes into the linked table, both are None for a route within one cluster.
+    Returns None if b can't be reached."""
+    grid_a,number_a = self._locate(a)
+    grid_b,number_b = self._locate(b)
+    if not grid_a or not grid_b:
+      return None
+    cluster_a = split_name(a)[0]
+    cluster_b = split_name(b)[0]
+    best = None
+    if cluster_a == cluster_b:
+      distance = grid_a.distance(number_a,number_b)
+      if distance is not None:
+        best = (distance,None,None)
+    names,index,by_cluster,distances,steps = self._linked_table()
+    #Distances to linked sectors use the tables towards them, which are shared by every query
+    starts = [(i,grid_a.distance(number_a,n)) for i,n in by_cluster.get(cluster_a,())]
+    ends = [(j,grid_b.distance(number_b,n)) for j,n in by_cluster.get(cluster_b,())]
+    for i,start in starts:
+      if start is None:
+        continue
+      for j,end in ends:
+        if end is None or distances[i][j] is None:
+          continue
+        distance = start + distances[i][j] + end
+        if best is None or distance < best[0]:
+          best = (distance,i,j)
+    return best
+
+  def distance(self,a,b):
+    """Return the number of warps on the shortest route from sector a to b, or None if b can't be reached."""
+    best = self._best(a,b)
+    return best[0] if best else None
+
+  def route(self,a,b):
+    """Return the names of the sectors on the shortest route from sector a to b, ending with b.
+
+    Returns an empty list if a is b, and None if b can't be reached."""
+    best = self._best(a,b)
+    if not best:
+      return None
+    distance,i,j = best
+    if i is None:
+      return self._within(a,b)
+    names,index,by_cluster,distances,steps = self._linked_table()
+    route = self._within(a,names[i])
+    while i != j:
+      k = steps[i][j]
+      if names[k] in self.links.get(names[i],()):
+        route.append(names[k])
+      else:
+        route.extend(self._within(names[i],names[k]))
+      i = k
+    route.extend(self._within(names[j],b))
+    return route
+
+  def next_hop(self,a,b):
+    """Return the name of the sector to warp to from a on the shortest route to b, or None."""
+    route = self.route(a,b)
+    return route[0] if route else None
+
+  def _within(self,a,b):
+    cluster_name,number_a = split_name(a)
+    grid = self.grid(cluster_name)
+    return ["%s-%s" % (cluster_name,n) for n in grid.path(number_a,split_name(b)[1])]
+
+  def distances(self,pairs):
+    """Return the distances of a list of (from, to) sector name pairs, in the same order."""
+    return self._batch(self.distance,pairs)
+
+  def routes(self,pairs):
+    """Return the routes of a list of (from, to) sector name pairs, in the same order."""
+    return self._batch(self.route,pairs)
+
+  def _batch(self,fn,pairs):
+    #Pairs going to the same destination are answered together, so they share its table
+    results = [None] * len(pairs)
+    for i in sorted(xrange(len(pairs)),key = lambda i: pairs[i][1]):
+      results[i] = fn(*pairs[i])
+    return results
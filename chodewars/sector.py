@@ -2,10 +2,10 @@ from cluster import Cluster
 from entity import Entity
 
 class Sector(Entity):
-  def __init__(self,initial_state = {}):
-    super(Sector,self).__init__(initial_state = initial_state)
-    
-    self.cluster_name = initial_state['cluster_name'] if 'cluster_name' in initial_state else ""
+  fields = Entity.fields + (
+    ('cluster_name',"",None),
+  )
+  __slots__ = ('cluster_name',)
     
   def __repr__(self):
     return "%s-%s" % (self.cluster_name,str(self.name))
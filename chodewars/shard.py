@@ -0,0 +1,275 @@
+import logging
+import threading
+import multiprocessing
+
+import metrics
+from game import Game,read_config
+
+def run_worker(config_file,clusters,conn):
+  """Entry point of a worker process, serving calls from the router until it is sent None."""
+  Worker(config_file,clusters).serve(conn)
+
+class Worker(object):
+  """Carries out the calls for players in the clusters it owns, in its own process with its own Game and cache.
+
+  Every object is still in the shared database, so a worker can read anything. It only changes objects in
+  its own clusters, apart from a ship arriving from another cluster, which takes it out of its old sector."""
+
+  def __init__(self,config_file,clusters):
+    self.clusters = set(clusters)
+    self.game = Game(config_file = config_file,clusters = clusters)
+    #(child, parent, previous parent) of the moves made by the current call, sent back with its result
+    self.moves = []
+    self.game.add_listener(self.moved)
+
+  def moved(self,child,parent,previous_parent):
+    self.moves.append((child,parent,previous_parent))
+
+  def serve(self,conn):
+    """Answer (method, args, kwargs) calls with (ok, result or error, storage reads, storage writes, moves made)."""
+    while True:
+      try:
+        call = conn.recv()
+      except EOFError:
+        break
+      if call is None:
+        break
+      method,args,kwargs = call
+      metrics.begin_request()
+      try:
+        result = (True,getattr(self,method)(*args,**kwargs))
+      except Exception,e:
+        self.game.log.exception("Worker.serve(): %s failed" % method)
+        result = (False,"%s: %s" % (e.__class__.__name__,e))
+      reads,writes = metrics.end_request()
+      moves,self.moves = self.moves,[]
+      conn.send(result + (reads,writes,moves))
+    conn.close()
+
+  def locate(self,player_id):
+    """Return the name of the cluster a player is in, or None if they don't have a sector yet.
+
+    This reads the database directly, since the player may have moved since this worker cached them."""
+    entity = self.game.db.load_object(player_id)
+    while entity and entity.type != "Sector":
+      entity = self.game.db.load_object(entity.parent) if entity.parent else None
+    return entity.cluster_name if entity else None
+
+  def get_player_by_id(self,player_id):
+    return self.game.get_player_by_id(player_id)
+
+  def get_view(self,player_id):
+    return self.game.get_view(self.game.get_player_by_id(player_id))
+
+  def sign_up(self,player_id,name,planet_name = None,ship_name = None):
+    """Create a player with a home sector in one of this worker's clusters, returning (player, cluster name)."""
+    player = self.game.sign_up(player_id,name,planet_name = planet_name,ship_name = ship_name)
+    ship = self.game.get_parent(player) if player else None
+    sector = self.game.get_parent(ship) if ship else None
+    return (player,sector.cluster_name if sector else None)
+
+  def run_command(self,player_id,command,sector_id = None,target_id = None):
+    """Carry out a command, returning (result, handoff).
+
+    Moves to a sector in a cluster another worker owns are only checked here. The handoff is
+    (ship id, sector name, ids to invalidate) for the router to pass to the owner of that cluster."""
+    player = self.game.get_player_by_id(player_id)
+    ship = self.game.get_parent(player) if player else None
+    if command == "move" and ship and sector_id:
+      sector = self.game.find_sector(sector_id)
+      if sector and sector.cluster_name not in self.clusters:
+        if not self.game.can_move(ship,sector):
+          return (False,None)
+        stale = [str(player.id),str(ship.id),str(ship.parent)]
+        #The other worker changes these, so they can't stay cached here. The router calls invalidate() once
+        #the ship has arrived, which gives the spatial index the new contents of the old sector
+        for id in stale:
+          self.game.cache.invalidate(id)
+        return (True,(str(ship.id),str(sector),stale))
+    return (self.game.run_command(player,command,sector_id = sector_id,target_id = target_id),None)
+
+  def scan(self,player_id,target_id = None):
+    return self.game.scan(self.game.get_player_by_id(player_id),target_id = target_id)
+  
+  def plan_trip(self,player_id,destination):
+    return self.game.plan_trip(self.game.get_player_by_id(player_id),destination)
+  
+  def arrive(self,ship_id,sector_name,stale):
+    """Move a ship that another worker checked into a sector in one of this worker's clusters."""
+    for id in stale:
+      self.game.cache.invalidate(id)
+    ship = self.game.load_object_by_id(ship_id)
+    sector = self.game.get_sector(sector_name)
+    if not ship or not sector:
+      return False
+    self.game.log.info("Worker.arrive(): Moving %s to %s from another cluster" % (ship,sector))
+    return self.game.assign_child(sector,ship)
+
+  def invalidate(self,ids):
+    self.game.invalidate(ids)
+    return True
+
+class Router(object):
+  """Runs a worker process for each group of clusters, and sends each call to the worker that owns the player's cluster.
+
+  The router has the methods of Game that the web handlers use (get_player_by_id, get_view, sign_up,
+  run_command, run_commands, autopilot and scan), so it can be used in place of a Game. Calls to one worker are sent one at a time, calls to
+  different workers run at the same time. The moves the workers make are passed to the router's listeners
+  (see Game.add_listener()) once the call that made them returns. A move to a cluster owned by another worker is checked by the
+  worker the player is in, and then carried out by the worker that owns the destination.
+
+  The workers share one database, which has to be sqlite. The file and log databases keep their name index
+  (and the log database its offsets) in memory, so processes would not see each other's objects."""
+
+  def __init__(self,config_file = "chodewars.cfg",workers = 0):
+    self.log = logging.getLogger('chodewars.shard')
+    self.config_file = config_file
+    config = read_config(config_file)
+    self.db_type = config.get('database','type')
+    self.cluster_list = [c.strip() for c in config.get('universe','clusters').split(',') if c.strip()]
+    count = max(1,min(workers or multiprocessing.cpu_count(),len(self.cluster_list)))
+
+    #Clusters are dealt out to the workers in turn
+    self.assignments = [self.cluster_list[i::count] for i in xrange(count)]
+    self.owners = {}
+    for i,clusters in enumerate(self.assignments):
+      for cluster_name in clusters:
+        self.owners[cluster_name] = i
+
+    #Player id to the name of the cluster they were last seen in
+    self.locations = {}
+    self.conns = []
+    self.locks = []
+    self.processes = []
+    self.next_worker = 0
+    self.lock = threading.Lock()
+    self.listeners = []
+
+  def start(self):
+    """Start the worker processes, returning False if the database can't be shared between them."""
+    if self.db_type != "sqlite":
+      self.log.error("Router.start(): Clusters can only be shared between processes with the sqlite database, not %s" % self.db_type)
+      return False
+    for clusters in self.assignments:
+      conn,worker_conn = multiprocessing.Pipe()
+      process = multiprocessing.Process(target = run_worker,args = (self.config_file,clusters,worker_conn),name = "chodewars-%s" % ",".join(clusters))
+      process.daemon = True
+      process.start()
+      self.conns.append(conn)
+      self.locks.append(threading.Lock())
+      self.processes.append(process)
+    self.log.info("Router.start(): Started %s workers for clusters %s" % (len(self.processes),self.assignments))
+    return True
+
+  def close(self):
+    """Stop every worker process."""
+    for conn,lock in zip(self.conns,self.locks):
+      with lock:
+        conn.send(None)
+    for process in self.processes:
+      process.join()
+    self.conns = []
+    self.locks = []
+    self.processes = []
+
+  def call(self,worker,method,*args,**kwargs):
+    """Call a method of a worker, returning its result. The worker's storage reads and writes are counted here."""
+    with self.locks[worker]:
+      self.conns[worker].send((method,args,kwargs))
+      ok,result,reads,writes,moves = self.conns[worker].recv()
+    metrics.read(reads)
+    metrics.wrote(writes)
+    for move in moves:
+      self._moved(*move)
+    if not ok:
+      self.log.error("Router.call(): %s failed in worker %s: %s" % (method,worker,result))
+      return None
+    return result
+
+  def add_listener(self,listener):
+    """Call listener(child, parent, previous parent) for each move a worker makes, as Game.add_listener() does."""
+    self.listeners.append(listener)
+    return listener
+
+  def remove_listener(self,listener):
+    if listener in self.listeners:
+      self.listeners.remove(listener)
+
+  def _moved(self,child,parent,previous_parent):
+    for listener in list(self.listeners):
+      try:
+        listener(child,parent,previous_parent)
+      except Exception:
+        self.log.exception("Router.call(): Error in listener %s" % listener)
+
+  def worker_for(self,player_id):
+    """Return the worker that owns the cluster the player is in."""
+    cluster_name = self.locations.get(player_id)
+    if cluster_name not in self.owners:
+      cluster_name = self.call(0,'locate',player_id)
+      if cluster_name:
+        self.locations[player_id] = cluster_name
+    return self.owners.get(cluster_name,0)
+
+  def get_player_by_id(self,player_id):
+    return self.call(self.worker_for(player_id),'get_player_by_id',player_id)
+
+  def get_view(self,player):
+    return self.call(self.worker_for(str(player.id)),'get_view',str(player.id))
+
+  def scan(self,player,target_id = None):
+    return self.call(self.worker_for(str(player.id)),'scan',str(player.id),target_id = target_id)
+  
+  def sign_up(self,player_id,name,planet_name = None,ship_name = None):
+    """Create a player in the next worker's clusters, so new players are spread over the workers."""
+    with self.lock:
+      worker = self.next_worker
+      self.next_worker = (self.next_worker + 1) % len(self.conns)
+    result = self.call(worker,'sign_up',player_id,name,planet_name = planet_name,ship_name = ship_name)
+    if not result:
+      return None
+    player,cluster_name = result
+    if cluster_name:
+      self.locations[player_id] = cluster_name
+    return player
+
+  def run_command(self,player,command,sector_id = None,target_id = None):
+    player_id = str(player.id)
+    worker = self.worker_for(player_id)
+    result = self.call(worker,'run_command',player_id,command,sector_id = sector_id,target_id = target_id)
+    if not result:
+      return False
+    done,handoff = result
+    if not handoff:
+      return done
+
+    #Hand the move off to the worker that owns the destination
+    ship_id,sector_name,stale = handoff
+    cluster_name = sector_name.split('-')[0]
+    destination = self.owners.get(cluster_name)
+    if destination is None:
+      self.log.error("Router.run_command(): No worker owns cluster %s" % cluster_name)
+      return False
+    arrived = self.call(destination,'arrive',ship_id,sector_name,stale)
+    if arrived:
+      self.locations[player_id] = cluster_name
+    #The old worker may have loaded the ship or its old sector again while it was moving
+    self.call(worker,'invalidate',stale)
+    return bool(arrived)
+  
+  def run_commands(self,player,commands):
+    """Carry out a list of commands one at a time, since a route may cross clusters owned by different workers."""
+    done = 0
+    for command in commands:
+      if not self.run_command(player,command.get('command'),sector_id = command.get('sector'),target_id = command.get('target')):
+        break
+      done += 1
+    return done
+  
+  def autopilot(self,player,destination):
+    route = self.call(self.worker_for(str(player.id)),'plan_trip',str(player.id),destination)
+    if route is None:
+      return None
+    if self.run_commands(player,[{'command': "move",'sector': name} for name in route]) != len(route):
+      return None
+    return route
@@ -0,0 +1,172 @@
+import threading
+
+class SpatialIndex(object):
+  """For each cluster, the ids of the objects in each sector, by type.
+
+  A cluster is added with add_cluster() the first time it is needed, and kept up to date with moved(),
+  which is a Game listener (see Game.add_listener()). Objects inside other objects (such as a ship landed
+  on a planet) are not in a sector, so they aren't indexed. Sectors changed by another process are given
+  their new contents with update_sectors(), and sectors_among() picks out the ids worth reading for that.
+  Changes made while a cluster is being loaded are recorded from begin_cluster() on, and applied on top
+  of what was loaded by add_cluster()."""
+
+  def __init__(self):
+    #Cluster name to (x, y, sector number to {type: set of ids})
+    self.clusters = {}
+    #Cluster name to the number of times it has been indexed, so a cache of the index can tell it was rebuilt
+    self.generations = {}
+    #Cluster name to the changes made since begin_cluster(), for clusters that are being loaded
+    self.pending = {}
+    #Ids of the indexed clusters and their sectors, to the cluster name
+    self.cluster_ids = {}
+    self.sector_ids = {}
+    self.lock = threading.Lock()
+
+  def __contains__(self,cluster_name):
+    return cluster_name in self.clusters
+
+  def begin_cluster(self,cluster_name):
+    """Start recording the changes to a cluster that is about to be loaded.
+
+    Returns False if the cluster is already indexed, so it doesn't need loading."""
+    with self.lock:
+      if cluster_name in self.clusters:
+        return False
+      self.pending.setdefault(cluster_name,[])
+      return True
+
+  def add_cluster(self,cluster,sectors,contents):
+    """Index a cluster from its sectors and a dictionary of sector id to the objects in it.
+
+    Changes recorded since begin_cluster() are applied after, in the order they were made. If another
+    thread indexed the cluster first, its index is kept since it is already up to date."""
+    occupied = {}
+    with self.lock:
+      if cluster.name in self.clusters:
+        return False
+      for sector in sectors:
+        number = int(sector.name)
+        for entity in contents.get(str(sector.id),()):
+          occupied.setdefault(number,{}).setdefault(entity.type,set()).add(str(entity.id))
+      self.clusters[cluster.name] = (int(cluster.x),int(cluster.y),occupied)
+      self.cluster_ids[str(cluster.id)] = cluster.name
+      for sector in sectors:
+        self.sector_ids[str(sector.id)] = cluster.name
+      self.generations[cluster.name] = self.generations.get(cluster.name,0) + 1
+      for change,args in self.pending.pop(cluster.name,()):
+        change(*args)
+      return True
+
+  def moved(self,child,parent,previous_parent):
+    with self.lock:
+      self._record(self._move,(child,parent,previous_parent),(parent,previous_parent))
+      self._move(child,parent,previous_parent)
+
+  def update_sectors(self,sectors,contents):
+    """Replace what is in each of the sectors with the objects in contents, a dictionary of sector id to objects.
+
+    Sectors of clusters that aren't indexed are skipped. Returns (cluster name, sector number) of the
+    sectors that were updated."""
+    updated = []
+    with self.lock:
+      for sector in sectors:
+        self._record(self._update,(sector,contents.get(str(sector.id),())),(sector,))
+        if self._update(sector,contents.get(str(sector.id),())):
+          updated.append((sector.cluster_name,int(sector.name)))
+    return updated
+
+  def sectors_among(self,ids):
+    """Return the ids in a list that may be sectors of indexed clusters: the indexed sectors, and the ids not
+    in the index if an indexed cluster is among them.
+    
+    A move saves the sectors on both sides, and sectors are created in the same save as their cluster, so
+    nothing else (such as planets saved by a tick) needs to be read to find the sectors that changed."""
+    ids = [str(id) for id in ids]
+    with self.lock:
+      if any(id in self.cluster_ids for id in ids):
+        return [id for id in ids if id not in self.cluster_ids]
+      return [id for id in ids if id in self.sector_ids]
+  
+  def _record(self,change,args,sectors):
+    """Add a change to the pending list of every cluster being loaded that it touches, once."""
+    for cluster_name in set(s.cluster_name for s in sectors if s and s.type == "Sector"):
+      if cluster_name in self.pending:
+        self.pending[cluster_name].append((change,args))
+
+  def _move(self,child,parent,previous_parent):
+    if previous_parent and previous_parent.type == "Sector":
+      self._remove(previous_parent,child)
+    if parent.type == "Sector":
+      self._add(parent,child)
+
+  def _update(self,sector,entities):
+    if sector.cluster_name not in self.clusters:
+      return False
+    self.sector_ids[str(sector.id)] = sector.cluster_name
+    number = int(sector.name)
+    types = {}
+    for entity in entities:
+      types.setdefault(entity.type,set()).add(str(entity.id))
+    occupied = self.clusters[sector.cluster_name][2]
+    if types:
+      occupied[number] = types
+    else:
+      occupied.pop(number,None)
+    return True
+
+  def _add(self,sector,entity):
+    if sector.cluster_name not in self.clusters:
+      return
+    self.sector_ids[str(sector.id)] = sector.cluster_name
+    occupied = self.clusters[sector.cluster_name][2]
+    occupied.setdefault(int(sector.name),{}).setdefault(entity.type,set()).add(str(entity.id))
+
+  def _remove(self,sector,entity):
+    if sector.cluster_name not in self.clusters:
+      return
+    occupied = self.clusters[sector.cluster_name][2]
+    types = occupied.get(int(sector.name),{})
+    ids = types.get(entity.type,set())
+    ids.discard(str(entity.id))
+    if not ids:
+      types.pop(entity.type,None)
+      if not types:
+        occupied.pop(int(sector.name),None)
+
+  def geometry(self,cluster_name):
+    """Return (x, y, generation) of an indexed cluster, or None if it isn't indexed."""
+    with self.lock:
+      if cluster_name not in self.clusters:
+        return None
+      x,y,occupied = self.clusters[cluster_name]
+      return (x,y,self.generations[cluster_name])
+
+  def types_at(self,cluster_name,sector_number):
+    """Return the set of types of the objects in a sector of an indexed cluster."""
+    with self.lock:
+      if cluster_name not in self.clusters:
+        return set()
+      return set(self.clusters[cluster_name][2].get(sector_number,()))
+
+  def within(self,cluster_name,sector_number,radius,types = None):
+    """Return (sector number, distance, ids) for every occupied sector within radius warps of a sector.
+
+    Warps are diagonal, so the sectors within radius are a square around it. Only ids of the given
+    types are returned (every type if types is None). Sectors are ordered by distance then number."""
+    with self.lock:
+      if cluster_name not in self.clusters:
+        return None
+      x,y,occupied = self.clusters[cluster_name]
+      row,column = (sector_number - 1) // x,(sector_number - 1) % x
+      #Look up each sector of the square, or go through the occupied sectors if there are fewer of them
+      if (2 * radius + 1) ** 2 < len(occupied):
+        numbers = [r * x + c + 1 for r in xrange(max(0,row - radius),min(y,row + radius + 1))
+                                 for c in xrange(max(0,column - radius),min(x,column + radius + 1))]
+      else:
+        numbers = [n for n in occupied if max(abs((n - 1) // x - row),abs((n - 1) % x - column)) <= radius]
+      found = []
+      for n in numbers:
+        ids = [id for type,type_ids in occupied.get(n,{}).items() if types is None or type in types for id in type_ids]
+        if ids:
+          found.append((n,max(abs((n - 1) // x - row),abs((n - 1) % x - column)),sorted(ids)))
+    return sorted(found,key = lambda f: (f[1],f[0]))
@@ -0,0 +1,40 @@
+// Sends the move, land and takeoff links over a WebSocket instead of loading a new page,
+// and applies the updates the server pushes to #location. Without WebSockets the links work as before.
+$(function() {
+  if (!window.WebSocket || !$('#location').length) return;
+
+  var commands = ['move', 'land', 'takeoff'];
+  var connected = false;
+  var socket = new WebSocket((window.location.protocol == 'https:' ? 'wss://' : 'ws://') + window.location.host + '/ws');
+  socket.onopen = function() { connected = true; };
+  socket.onclose = function() { connected = false; };
+
+  socket.onmessage = function(e) {
+    var message = JSON.parse(e.data);
+    var current = $('#location');
+    if (message.event == 'warps') {
+      // The player's ship moved, so the whole location is replaced
+      current.replaceWith(message.html);
+    } else if (message.location != current.attr('data-id')) {
+      return;
+    } else if (message.event == 'entered') {
+      if (!current.find('.children [data-id="' + message.entity.id + '"]').length) {
+        current.find('.children').first().append(message.html);
+      }
+    } else if (message.event == 'left') {
+      current.find('.children [data-id="' + message.entity.id + '"]').remove();
+    }
+  };
+
+  $(document).on('click', 'a[href^="/c/"]', function(e) {
+    var match = /^\/c\/(\w+)\/\??(.*)$/.exec($(this).attr('href'));
+    if (!connected || !match || $.inArray(match[1], commands) < 0) return;
+    var command = {command: match[1]};
+    $.each(match[2].split('&'), function(i, pair) {
+      var parts = pair.split('=');
+      if (parts[0]) command[parts[0]] = decodeURIComponent(parts[1] || '');
+    });
+    socket.send(JSON.stringify(command));
+    e.preventDefault();
+  });
+});
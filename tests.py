@@ -1,4 +1,9 @@
-from chodewars import game,player,sector,ship
+import os
+import json
+import time
+import zlib
+import threading
+from chodewars import game,player,sector,ship,db,metrics,shard,notify,feed,routes,population,codec,spatial,entity
 from random import choice
 
 game_obj = None
@@ -29,7 +34,635 @@ class Action(object):
           print "\tcreating home sector with planet and ship..."
           self.result = "return_true" if game_obj.assign_home_sector(created_player,"Test Planet","Test Ship") else "return_false"
         
-    if actions[0] == "get":
+      if actions[1] == "index":
+        #Reconnect so the name index is loaded from disk instead of memory
+        game_obj = game.Game()
+        indexed_ship = game_obj.load_object("Test Ship")
+        print "\tloaded %s from the name index, in sector %s" % (indexed_ship,game_obj.get_parent(indexed_ship))
+        indexed_sector = game_obj.load_object(str(game_obj.get_parent(indexed_ship)))
+        self.result = "return_true" if indexed_sector and indexed_sector.id == indexed_ship.parent else "return_false"
+        
+      if actions[1] == "accented":
+        #Names from players are unicode, and can be looked up by either unicode or UTF-8
+        accented = game_obj.sign_up("zoe@email.com",u"Zo\xeb",u"Plan\xe8te Zo\xeb",u"Jos\xe9's Ship")
+        game_obj = game.Game()
+        found = [game_obj.load_object(u"Zo\xeb"),game_obj.load_object("Zo\xc3\xab"),game_obj.load_object(u"Plan\xe8te Zo\xeb"),game_obj.load_object(u"Jos\xe9's Ship")]
+        print "\tsigned up %s and loaded %s from the name index" % (accented,found)
+        self.result = "return_true" if accented and all(found) and str(found[0].id) == str(found[1].id) == "zoe@email.com" and str(found[3].id) == str(game_obj.get_player_by_id("zoe@email.com").parent) else "return_false"
+        
+      if actions[1] == "sqlite":
+        #Store a sector with a child in a separate SQLite database and load it back
+        sqlite_db = db.SqliteDatabase(location = "data",name = "test")
+        sqlite_db.connect()
+        sqlite_db.big_bang()
+        test_sector = sector.Sector(initial_state = {'cluster_name':'alpha','name':'5'})
+        test_ship = game.Ship(initial_state = {'name':'SQLite Ship'})
+        test_sector.add_child(test_ship)
+        test_ship.parent = test_sector.id
+        sqlite_db.save_objects([test_sector,test_ship])
+        loaded_sector = sqlite_db.load_object_by_name("alpha-5")
+        print "\tloaded %s with children %s" % (loaded_sector,sqlite_db.load_objects(loaded_sector.children))
+        #Children keep their order after one is removed and another added
+        others = [game.Ship(initial_state = {'name':'SQLite Ship %s' % n}) for n in xrange(3)]
+        for other in others:
+          loaded_sector.add_child(other)
+        sqlite_db.save_objects([loaded_sector])
+        loaded_sector.remove_child(others[0])
+        loaded_sector.add_child(test_ship)
+        loaded_sector.remove_child(test_ship)
+        loaded_sector.add_child(others[0])
+        sqlite_db.save_objects([loaded_sector])
+        reordered = sqlite_db.load_object_by_name("alpha-5").children
+        print "\tchildren after removing and adding are in order: %s" % (reordered == loaded_sector.children)
+        #Names are stored as unicode, whether they are saved one at a time or in bulk
+        accented = [game.Ship(initial_state = {'name':u"Sh\xeep %s" % n}) for n in xrange(2)]
+        sqlite_db.save_objects(accented[:1])
+        sqlite_db.bulk_load([accented[1:]])
+        by_name = sqlite_db.load_objects_by_name([u"Sh\xeep 0","Sh\xc3\xaep 1"])
+        print "\tloaded %s by accented names" % by_name
+        self.result = "return_true" if reordered == loaded_sector.children == [str(o.id) for o in others[1:] + [others[0]]] and [str(o.id) for o in by_name if o] == [str(o.id) for o in accented] else "return_false"
+    
+      if actions[1] == "journal":
+        #A big bang waits for a commit holding the journal lock, such as one from another process
+        journal_db = db.FlatFileDatabase(location = "data",name = "journalled")
+        journal_db.connect()
+        journal_ship = journal_db.save_object(game.Ship(initial_state = {'name':'Journal Ship'}))
+        held = threading.Event()
+        kept = []
+        def commit():
+          with journal_db.journal.locked():
+            held.set()
+            time.sleep(0.2)
+            kept.append(os.path.exists(os.path.join(journal_db.path,str(journal_ship.id))))
+        committer = threading.Thread(target = commit)
+        committer.start()
+        held.wait()
+        started = time.time()
+        journal_db.big_bang()
+        waited = time.time() - started
+        committer.join()
+        print "\tbig bang waited %.2f seconds for the journal lock, objects were kept until then: %s" % (waited,kept)
+        self.result = "return_true" if waited >= 0.15 and kept == [True] and not journal_db.load_object_by_name("Journal Ship") and os.path.getsize(journal_db.journal_path) == 0 else "return_false"
+        
+      if actions[1] == "segments":
+        #Write enough saves to fill several small segments, then reopen the database from them
+        log_db = db.LogDatabase(location = "data",name = "segments",segment_size = 512,compact_segments = 100)
+        log_db.connect()
+        log_db.big_bang()
+        log_ships = [game.Ship(initial_state = {'name':'Log Ship %s' % n}) for n in xrange(5)]
+        for n in xrange(4):
+          for log_ship in log_ships:
+            log_ship.population = n
+          log_db.save_objects(log_ships)
+        segment_count = len(log_db.segments)
+        log_db.close()
+        log_db = db.LogDatabase(location = "data",name = "segments",segment_size = 512,compact_segments = 100)
+        log_db.connect()
+        replayed = [s.population if s else None for s in log_db.load_objects([s.id for s in log_ships])]
+        
+        #A save of two records where only the first was written is dropped when the segments are read again
+        torn_ship = log_db.load_object(log_ships[0].id)
+        torn_ship.population = 99
+        torn_ship.version += 1
+        payload = log_db._encode(torn_ship)
+        segment_path = log_db._segment_path(log_db.segments[-1])
+        size = os.path.getsize(segment_path)
+        log_db.close()
+        with open(segment_path,'ab') as f:
+          f.write(log_db.header.pack(len(payload),zlib.crc32(payload) & 0xffffffff,1) + payload)
+        log_db = db.LogDatabase(location = "data",name = "segments",segment_size = 512,compact_segments = 100)
+        log_db.connect()
+        torn = log_db.load_object(log_ships[0].id)
+        truncated = os.path.getsize(segment_path) == size
+        
+        #Compacting leaves one segment for the full ones, and reopening still finds the latest records
+        compacted = log_db.compact()
+        after_compact = len(log_db.segments)
+        log_db.close()
+        log_db = db.LogDatabase(location = "data",name = "segments",segment_size = 512,compact_segments = 100)
+        log_db.connect()
+        reloaded = [s.population if s else None for s in log_db.load_objects([s.id for s in log_ships])]
+        log_db.close()
+        print "\treplayed %s segments as %s, torn save gave population %s (truncated %s), compacted to %s segments as %s" % (segment_count,replayed,torn.population,truncated,after_compact,reloaded)
+        self.result = "return_true" if segment_count > 2 and replayed == [3] * 5 and torn.population == 3 and truncated and compacted and after_compact == 2 and reloaded == [3] * 5 else "return_false"
+    
+      if actions[1] == "codec":
+        #Save with the binary codec into a directory that already has an object saved as JSON
+        binary_db = db.FlatFileDatabase(location = "data",name = "codec",codec = "binary")
+        binary_db.connect()
+        binary_db.big_bang()
+        json_ship = game.Ship(initial_state = {'name':'JSON Ship'})
+        with open(os.path.join(binary_db.path,json_ship.id),'w') as f:
+          f.write(json.dumps(json_ship.to_dict()))
+        binary_sector = sector.Sector(initial_state = {'cluster_name':'alpha','name':'7','children':[json_ship.id]})
+        binary_db.save_objects([binary_sector])
+        loaded = binary_db.load_objects([binary_sector.id,json_ship.id])
+        print "\tloaded %s from binary and %s from JSON" % (loaded[0],loaded[1])
+        #Names typed with accents arrive as UTF-8 str or as unicode, and both load back as unicode
+        binary_codec = codec.get_codec("binary")
+        accented = [player.Player(initial_state = {'name':name}) for name in ("Jos\xc3\xa9",u"Zo\xeb")]
+        names = [codec.decode(binary_codec.encode(p.to_dict()))['name'] for p in accented]
+        print "\tloaded names %s" % repr(names)
+        self.result = "return_true" if loaded[0].to_dict() == binary_sector.to_dict() and loaded[1].to_dict() == json_ship.to_dict() and names == [u"Jos\xe9",u"Zo\xeb"] else "return_false"
+    
+      if actions[1] == "allocations":
+        #Allocate every free sector of a 2x2 cluster where sector 3 is already occupied
+        test_cluster = game.Cluster(initial_state = {'name':'test','x':2,'y':2})
+        test_cluster.build_free_sectors([3])
+        allocated = [test_cluster.allocate_sector() for i in range(4)]
+        print "\tallocated sectors %s" % str(allocated)
+        self.result = "return_true" if sorted(allocated[:3]) == [1,2,4] and allocated[3] is None else "return_false"
+    
+        
+        #Sectors that were free when the list was built and then moved into are not given out
+        config_file = os.path.join("data","full.cfg")
+        with open(config_file,'w') as f:
+          f.write("[database]\nlocation = data/full\n\n[universe]\ncluster_size = 2\nclusters = tiny\n")
+        full_game = game.Game(bigbang = True,config_file = config_file)
+        first = full_game.sign_up("first@email.com","First","First Planet","First Ship")
+        first_ship = full_game.get_parent(first)
+        full_game.move_ship(first_ship,choice(full_game.get_available_warps(ship = first_ship)))
+        homes = [full_game.assign_home_sector(full_game.add_player(player.Player(initial_state = {'id':"%s@email.com" % n,'name':n})),"Planet %s" % n,"Ship %s" % n) for n in ("second","third","fourth")]
+        print "\tassigned home sectors in a full cluster: %s" % homes
+        if homes != [True,True,False]:
+          self.result = "return_false"
+    
+      if actions[1] == "neighbors":
+        #Corner and edge sectors of a 10x10 cluster
+        test_cluster = game.Cluster(initial_state = {'name':'test','x':10,'y':10})
+        corners = [sorted(test_cluster.neighbors(n)) for n in (1,10,90,100)]
+        print "\tneighbours of sectors 1, 10, 90 and 100 are %s" % str(corners)
+        self.result = "return_true" if corners == [[2,11,12],[9,19,20],[79,80,89,99,100],[89,90,99]] else "return_false"
+    
+      if actions[1] == "conflict":
+        #Keep a copy of the ship, which goes out of date when the ship is moved
+        ship = game_obj.load_object("Test Ship")
+        stale_ship = game.Ship(initial_state = ship.to_dict())
+        game_obj.move_ship(ship,choice(game_obj.get_available_warps(ship = ship)))
+        try:
+          game_obj.db.save_object(game.Ship(initial_state = stale_ship.to_dict()))
+          print "\tsaving an out of date copy did not raise ConflictError"
+          self.result = "return_false"
+        except db.ConflictError,e:
+          print "\tsaving an out of date copy raised: %s" % e
+          destination = choice(game_obj.get_available_warps(ship = ship))
+          assigned = game_obj.assign_child(destination,stale_ship)
+          moved_ship = game_obj.db.load_object(ship.id)
+          print "\tassign_child() to %s with the out of date copy returned %s" % (destination,assigned)
+          
+          #A move into an out of date copy of a sector fails, and leaves the objects as they were
+          ship = game_obj.load_object_by_id(ship.id)
+          location = game_obj.get_parent(ship)
+          target = choice(game_obj.get_available_warps(ship = ship))
+          stale_target = sector.Sector(initial_state = target.to_dict())
+          game_obj.save_object(target)
+          try:
+            game_obj._assign_child(stale_target,ship)
+            unchanged = False
+          except db.ConflictError:
+            unchanged = ship.parent == str(location.id) and str(ship.id) in location.children and str(ship.id) not in stale_target.children
+          print "\tfailed move into an out of date copy of %s left the objects unchanged: %s" % (target,unchanged)
+          
+          #move_ship() fails when assign_child() runs out of retries
+          stale_ship = game.Ship(initial_state = ship.to_dict())
+          game_obj.save_object(ship)
+          game_obj.conflict_retries = 1
+          try:
+            gave_up = game_obj.move_ship(stale_ship,target)
+          finally:
+            game_obj.conflict_retries = 5
+          stayed = game_obj.db.load_object(ship.id).parent == str(location.id)
+          print "\tmove_ship() with an out of date copy and one try returned %s, ship stayed in %s: %s" % (gave_up,location,stayed)
+          self.result = "return_true" if assigned and moved_ship.parent == str(destination.id) and unchanged and gave_up is False and stayed else "return_false"
+    
+      if actions[1] == "writers":
+        #Threads saving the same cached object each get their own version
+        ship = game_obj.load_object("Test Ship")
+        version = game_obj.db.load_object(ship.id).version
+        results = []
+        def save_ship():
+          for n in xrange(20):
+            try:
+              results.append(bool(game_obj.save_object(ship)))
+            except db.ConflictError:
+              results.append(False)
+        writers = [threading.Thread(target = save_ship) for n in xrange(4)]
+        for writer in writers:
+          writer.start()
+        for writer in writers:
+          writer.join()
+        saved_version = game_obj.db.load_object(ship.id).version
+        print "\t%s of %s saves from 4 threads succeeded, version went from %s to %s" % (results.count(True),len(results),version,saved_version)
+        self.result = "return_true" if all(results) and saved_version == version + len(results) == ship.version else "return_false"
+    
+      if actions[1] == "movers":
+        #Ships move back and forth between two sectors from several threads. Before each move the target is
+        #saved again from the database, as another request would, so the cached copy held for the move
+        #is out of date and it conflicts and is retried
+        here,there = game_obj.get_sectors(["alpha-98","alpha-99"])
+        movers = [game.Ship(initial_state = {'name':"Mover Ship %s" % n}) for n in xrange(4)]
+        for mover in movers:
+          game_obj.assign_child(game_obj.load_object_by_id(here.id),mover)
+        results = []
+        resaved = []
+        #Mover id to the sector it was last moved to
+        moved_to = dict((str(mover.id),str(here.id)) for mover in movers)
+        def fly(mover):
+          for n in xrange(10):
+            target = game_obj.load_object_by_id((there,here)[n % 2].id)
+            try:
+              resaved.append(game_obj.save_object(game_obj.db.load_object(target.id)))
+            except db.ConflictError:
+              resaved.append(None)
+            assigned = game_obj.assign_child(target,game_obj.load_object_by_id(mover.id))
+            results.append(assigned)
+            if assigned:
+              moved_to[str(mover.id)] = str(target.id)
+        fliers = [threading.Thread(target = fly,args = (mover,)) for mover in movers]
+        for flier in fliers:
+          flier.start()
+        for flier in fliers:
+          flier.join()
+        
+        #Each ship is in the sector it was last moved to, which lists it, and the other sector doesn't
+        stored = dict((str(s.id),s) for s in game_obj.db.load_objects([here.id,there.id]))
+        linked = []
+        for mover in movers:
+          parent = game_obj.db.load_object(mover.id).parent
+          other = str(there.id) if parent == str(here.id) else str(here.id)
+          linked.append(parent == moved_to[str(mover.id)] and str(mover.id) in stored[parent].children and str(mover.id) not in stored[other].children)
+        print "\t%s of %s moves from 4 threads succeeded, with %s targets saved first, both sides of each link agree: %s" % (results.count(True),len(results),len(filter(None,resaved)),linked)
+        self.result = "return_true" if results.count(True) and any(resaved) and all(linked) else "return_false"
+    
+      if actions[1] == "metrics":
+        #Count the storage reads of a direct load, and time a call to get_available_warps
+        ship = game_obj.load_object("Test Ship")
+        timed_calls = metrics.operation_seconds.count(operation = "get_available_warps")
+        metrics.begin_request()
+        game_obj.db.load_objects([ship.id,ship.parent])
+        game_obj.get_available_warps(ship = ship,read_only = True)
+        reads,writes = metrics.end_request()
+        metrics.add_cache_metrics(game_obj.cache)
+        rendered = metrics.registry.render()
+        print "\tcounted %s reads and %s writes, rendered %s lines of metrics" % (reads,writes,len(rendered.splitlines()))
+        self.result = "return_true" if reads >= 2 and writes == 0 and metrics.operation_seconds.count(operation = "get_available_warps") == timed_calls + 1 and 'chodewars_operation_seconds_bucket{le="+Inf",operation="get_available_warps"}' in rendered and "# TYPE chodewars_cache_hits_total counter\nchodewars_cache_hits_total %s\n" % game_obj.cache.hits in rendered else "return_false"
+    
+      if actions[1] == "bigbang":
+        #Create two 5x5 clusters eagerly in each type of database, with planets in some sectors
+        self.result = "return_true"
+        for db_type in ("file","sqlite","log"):
+          config_file = os.path.join("data","bigbang.cfg")
+          with open(config_file,'w') as f:
+            f.write("[database]\ntype = %s\nlocation = data/bigbang\n\n[universe]\ncluster_size = 5\nclusters = one,two\neager = true\nplanet_density = 0.3\nprocesses = 2\n" % db_type)
+          eager_game = game.Game(bigbang = True,config_file = config_file)
+          cluster = eager_game.load_object("two")
+          sectors = eager_game.get_children(cluster)
+          planet_sectors = [s.name for s in sectors if s.children]
+          warps = eager_game.get_available_warps(ship = game.Ship(initial_state = {'parent':eager_game.load_object("one-13").id}),read_only = True)
+          new_player = eager_game.add_player(player.Player(initial_state = {'id':"eager@email.com",'name':"Eager Player"}))
+          eager_game.assign_home_sector(new_player,"Eager Planet","Eager Ship")
+          home = eager_game.get_parent(eager_game.get_parent(new_player))
+          print "\t%s: %s has %s sectors, %s with planets, sector 13 has %s saved warps, home sector is %s" % (db_type,cluster,len(sectors),len(planet_sectors),len([w for w in warps if w.version]),home)
+          if len(sectors) != 25 or len(warps) != 8 or not all(w.version for w in warps) or home.name in planet_sectors and home.cluster_name == "two":
+            self.result = "return_false"
+    
+      if actions[1] == "shards":
+        #Two 3x3 clusters, linked by sectors one-9 and two-1, each owned by its own worker
+        config_file = os.path.join("data","shard.cfg")
+        with open(config_file,'w') as f:
+          f.write("[database]\ntype = sqlite\nlocation = data/shard\n\n[universe]\ncluster_size = 3\nclusters = one,two\nlinks = one-9 two-1\n")
+        game.Game(bigbang = True,config_file = config_file)
+        router = shard.Router(config_file = config_file,workers = 2)
+        router.start()
+        try:
+          traveller = router.sign_up("traveller@email.com","Traveller","Home","Traveller Ship")
+          #The moves the workers make are passed on by the router, as a Game passes on its own
+          moves = []
+          router.add_listener(lambda child,parent,previous_parent: moves.append((str(child),str(previous_parent),str(parent))))
+          path = []
+          #Sector 5 is next to every other sector, so this reaches one-9 from any home sector
+          for destination in ("one-5","one-9","two-1","one-9"):
+            router.run_command(traveller,"move",sector_id = destination)
+            path.append((destination,str(router.get_view(traveller).location),router.worker_for(traveller.id)))
+          print "\tmoves (destination, location, worker): %s" % path
+          print "\trouter listener saw %s" % moves
+          self.result = "return_true" if path[-2:] == [("two-1","two-1",1),("one-9","one-9",0)] and moves[-2:] == [("Traveller Ship","one-9","two-1"),("Traveller Ship","two-1","one-9")] else "return_false"
+        finally:
+          router.close()
+    
+      if actions[1] == "notify":
+        #Two games sharing a universe, as if they were in different processes
+        config_file = os.path.join("data","notify.cfg")
+        with open(config_file,'w') as f:
+          f.write("[database]\nlocation = data/notify\n\n[universe]\ncluster_size = 3\n")
+        first = game.Game(bigbang = True,config_file = config_file)
+        second = game.Game(config_file = config_file)
+        for g in (first,second):
+          g.listen_for_changes(notify.Notifier(os.path.join("data","notify","changes")))
+        try:
+          first.sign_up("notify@email.com","Notify Player","Notify Planet","Notify Ship")
+          cached_ship = second.load_object("Notify Ship")
+          origin = second.get_parent(cached_ship)
+          second.visualize_cluster(cluster_name = origin.cluster_name)
+          destination = choice([s for s in first.get_available_warps(ship = first.load_object("Notify Ship"),read_only = True) if s.cluster_name == origin.cluster_name])
+          first.move_ship(first.load_object("Notify Ship"),destination)
+          for i in xrange(100):
+            if cached_ship.id not in second.cache and "Ship" in second.spatial.types_at(destination.cluster_name,int(destination.name)):
+              break
+            time.sleep(0.01)
+          moved_ship = second.load_object_by_id(cached_ship.id)
+          print "\tsecond game sees %s in %s after it moved to %s" % (moved_ship,second.get_parent(moved_ship),destination)
+          
+          #The other game's move updates its two sectors in the index, so only their tiles are drawn again
+          drawn = second.map.drawn
+          second.visualize_cluster(cluster_name = origin.cluster_name)
+          redrawn = second.map.drawn - drawn
+          generation = second.spatial.geometry(origin.cluster_name)[2]
+          scanned = second.scan(second.get_player_by_id("notify@email.com"))
+          print "\tsecond game redrew %s tiles, index generation %s, scan around %s" % (redrawn,generation,scanned.centre)
+          
+          #Objects saved without their sector, such as planets saved by a tick, aren't read again for the index
+          planet = second.load_object("Notify Planet")
+          metrics.begin_request()
+          second.invalidate([planet.id])
+          planet_reads,writes = metrics.end_request()
+          metrics.begin_request()
+          second.invalidate([moved_ship.parent])
+          sector_reads,writes = metrics.end_request()
+          print "\tinvalidating the planet read %s objects, and its sector %s" % (planet_reads,sector_reads)
+          
+          #A database that isn't told about changes keeps the names others wrote to the index when it writes it
+          unnotified = db.FlatFileDatabase(location = os.path.join("data","notify"),name = "universe")
+          unnotified.connect()
+          first.save_object(game.Ship(initial_state = {'name':"First Index Ship"}))
+          unnotified.save_object(game.Ship(initial_state = {'name':"Unnotified Index Ship"}))
+          with open(unnotified.index_path) as f:
+            names = json.loads(f.read())['names']
+          print "\tindex on disk has both new ships: %s" % ("First Index Ship" in names and "Unnotified Index Ship" in names)
+          self.result = "return_true" if moved_ship is not cached_ship and str(second.get_parent(moved_ship)) == str(destination) and second.db.names.get(str(destination)) and 0 < redrawn <= 2 and generation == 1 and planet_reads == 0 and sector_reads == 1 and str(scanned.centre) == str(destination) and "First Index Ship" in names and "Unnotified Index Ship" in names else "return_false"
+        finally:
+          for g in (first,second):
+            g.notifier.close()
+    
+      if actions[1] == "feed":
+        #Watch the ship's sector, the sector it moves to and the ship itself
+        ship = game_obj.load_object("Test Ship")
+        origin = game_obj.get_parent(ship)
+        destination = choice(game_obj.get_available_warps(ship = ship))
+        events = []
+        sector_feed = feed.Feed()
+        recorder = lambda event,location,entity: events.append((event,str(location),entity.name))
+        for id in (origin.id,destination.id,ship.id):
+          sector_feed.subscribe(id,recorder)
+        game_obj.add_listener(sector_feed.moved)
+        try:
+          game_obj.move_ship(ship,destination)
+        finally:
+          game_obj.remove_listener(sector_feed.moved)
+        print "\tevents from moving %s from %s: %s" % (ship,origin,events)
+        self.result = "return_true" if events == [("left",str(origin),ship.name),("entered",str(destination),ship.name),("moved",str(destination),ship.name)] else "return_false"
+    
+      if actions[1] == "autopilot":
+        #Fly to the far corner of the cluster, then try a batch with a hop that isn't a warp
+        test_player = game_obj.get_player_by_id("email@email.com")
+        ship = game_obj.get_parent(test_player)
+        start = str(game_obj.get_parent(ship))
+        destination = "alpha-1" if start != "alpha-1" else "alpha-100"
+        writes = metrics.storage_writes.value()
+        route = game_obj.autopilot(test_player,destination)
+        route_writes = metrics.storage_writes.value() - writes
+        arrived = str(game_obj.get_parent(ship))
+        game_obj.autopilot(test_player,"alpha-1")
+        done = game_obj.run_commands(test_player,[{'command':"move",'sector':"alpha-2"},{'command':"move",'sector':"alpha-50"},{'command':"move",'sector':"alpha-3"}])
+        print "\tflew %s from %s to %s through %s with %s writes, then made %s of 3 moves to %s" % (ship,start,arrived,route,route_writes,done,game_obj.get_parent(ship))
+        
+        #From a planet, a batch takes off to the planet's sector and carries on, the same as single moves
+        outpost = game.Planet(initial_state = {'name':"Autopilot Outpost"})
+        game_obj.assign_child(game_obj.get_parent(ship),outpost)
+        landed = game_obj.run_commands(test_player,[{'command':"land",'target':outpost.id}])
+        departed = game_obj.run_commands(test_player,[{'command':"move",'sector':"alpha-2"},{'command':"move",'sector':"alpha-3"}])
+        print "\tlanded on %s %s time, then made %s of 2 moves to %s" % (outpost,landed,departed,game_obj.get_parent(ship))
+        
+        #A blocked neighbour is left out of the warps, can_move and batches alike
+        game_obj.routes.block(["alpha-4"])
+        try:
+          offered = [str(s) for s in game_obj.get_available_warps(ship = ship)]
+          allowed = game_obj.can_move(ship,game_obj.get_sector("alpha-4"))
+          batched = game_obj.run_commands(test_player,[{'command':"move",'sector':"alpha-4"}])
+        finally:
+          game_obj.routes.unblock(["alpha-4"])
+        unblocked = "alpha-4" in [str(s) for s in game_obj.get_available_warps(ship = ship)]
+        print "\twith alpha-4 blocked it was offered %s, can_move said %s and a batch made %s moves; unblocked it is offered %s" % ("alpha-4" in offered,allowed,batched,unblocked)
+        blocking = "alpha-4" not in offered and not allowed and batched == 0 and unblocked and str(game_obj.get_parent(ship)) == "alpha-3"
+        self.result = "return_true" if route and route[-1] == destination == arrived and route_writes <= 5 and done == 1 and landed == 1 and departed == 2 and blocking else "return_false"
+    
+      if actions[1] == "routes":
+        #Two 6x6 clusters linked by one-36 two-1, checked against a breadth first search as sectors are blocked
+        clusters = dict((name,game.Cluster(initial_state = {'name':name,'x':6,'y':6})) for name in ("one","two"))
+        links = game.parse_links("one-36 two-1")
+        planner = routes.RoutePlanner(links,load_cluster = clusters.get)
+        def search(a,b,blocked):
+          distances = {a: 0}
+          frontier = [a]
+          while frontier and b not in distances:
+            next_frontier = []
+            for name in frontier:
+              cluster_name,number = name.split('-')
+              for warp in ["%s-%s" % (cluster_name,n) for n in clusters[cluster_name].neighbors(number)] + links.get(name,[]):
+                if warp not in distances and warp not in blocked:
+                  distances[warp] = distances[name] + 1
+                  next_frontier.append(warp)
+            frontier = next_frontier
+          return None if a in blocked else distances.get(b)
+        crossing = planner.route("one-1","two-36")
+        names = ["%s-%s" % (c,n) for c in ("one","two") for n in range(1,37)]
+        blocked = set()
+        mismatches = []
+        for step in range(6):
+          pairs = [(choice(names),choice(names)) for i in range(40)]
+          for (a,b),route in zip(pairs,planner.routes(pairs)):
+            expected = search(a,b,blocked)
+            if route is None:
+              if expected is not None:
+                mismatches.append((a,b,route,expected))
+            elif len(route) != expected or (route and route[-1] != b) or blocked.intersection(route):
+              mismatches.append((a,b,route,expected))
+          #Block a few more sectors, and every third step unblock them all
+          if step % 3 == 2:
+            planner.unblock(blocked)
+            blocked = set()
+          else:
+            changed = set(choice(names) for i in range(4))
+            planner.block(changed)
+            blocked |= changed
+        #Names that aren't clusters yet are not remembered, and a cluster added later can be routed to
+        missing = planner.route("one-1","three-1")
+        clusters["three"] = game.Cluster(initial_state = {'name':"three",'x':6,'y':6})
+        added = planner.route("three-1","three-8")
+        print "\tone-1 to two-36 is %s, %s mismatched routes: %s, %s grids kept, three-1 to three-8 is %s then %s" % (crossing,len(mismatches),mismatches[:3],len(planner.grids),missing,added)
+        self.result = "return_true" if not mismatches and missing is None and added == ["three-8"] and len(planner.grids) <= 2 and crossing == ["one-8","one-15","one-22","one-29","one-36","two-1","two-8","two-15","two-22","two-29","two-36"] else "return_false"
+    
+      if actions[1] == "tick":
+        #Columns with growing, still and shrinking populations, then a tick of the test game
+        table = population.PopulationTable(use_numpy = False)
+        table.extend(["grows","still","shrinks","empty"],[1000,1000,10,0],[5,0,-20,-1])
+        first = table.tick()
+        second = table.tick(2)
+        columns = list(table.populations)
+        planet = game_obj.load_object("Test Planet")
+        before = planet.population
+        writes = metrics.storage_writes.value()
+        saved = game_obj.tick()
+        saved_planet = game_obj.db.load_object(planet.id)
+        cached_population = game_obj.load_object_by_id(planet.id).population
+        print "\tchanged %s then %s, populations %s, game tick saved %s objects with %s writes, Test Planet %s -> %s" % (first,second,columns,saved,metrics.storage_writes.value() - writes,before,saved_planet.population)
+        
+        #Another process adds a planet and changes the Test Planet's population, and tells this game about both
+        colony = game.Planet(initial_state = {'name':"Other Process Colony",'population':100,'population_growth':3})
+        game_obj.db.save_object(colony)
+        changed_planet = game_obj.db.load_object(planet.id)
+        changed_planet.population = 50
+        game_obj.db.save_object(changed_planet)
+        game_obj.invalidate([colony.id,planet.id])
+        game_obj.tick()
+        grown = [game_obj.db.load_object(id).population for id in (colony.id,planet.id)]
+        print "\tafter changes from another process, the colony and Test Planet are %s" % grown
+        self.result = "return_true" if first == ["grows","shrinks"] and second == ["grows"] and columns == [1015,1000,0,0] and saved >= 1 and saved_planet.population == before + planet.population_growth and cached_population == saved_planet.population and grown == [103,50 + planet.population_growth] else "return_false"
+    
+      if actions[1] == "lazy":
+        #Ten ticks of lazy population pass without anything being written
+        config_file = os.path.join("data","lazy.cfg")
+        with open(config_file,'w') as f:
+          f.write("[database]\nlocation = data/lazy\n\n[universe]\ncluster_size = 3\n\n[population]\nmode = lazy\ntick_seconds = 60\n")
+        lazy_game = game.Game(bigbang = True,config_file = config_file)
+        lazy_player = lazy_game.sign_up("lazy@email.com","Lazy Player","Lazy Planet","Lazy Ship")
+        planet = lazy_game.load_object("Lazy Planet")
+        lazy_game.get_view(lazy_player)
+        stamped = lazy_game.db.load_object(planet.id).population_time
+        writes = metrics.storage_writes.value()
+        now = stamped + 10 * 60 + 30
+        populations = [lazy_game.evaluate_populations([planet],now = now)[0].population,lazy_game.evaluate_populations([planet],now = now + 29)[0].population]
+        idle_writes = metrics.storage_writes.value() - writes
+        stored = lazy_game.db.load_object(planet.id).population
+        ticked = lazy_game.tick()
+        print "\tpopulation after 10.5 and 10.98 ticks is %s, with %s writes (%s stored), tick() saved %s" % (populations,idle_writes,stored,ticked)
+        
+        #Threads reading the same planet at the same time add the growth once. Reading the growth of this
+        #copy of the planet is slowed down, so the other threads reach the update while one is part way through it
+        growth = entity.Entity.__dict__['population_growth']
+        class SlowPlanet(game.Planet):
+          __slots__ = ()
+          def slow_growth(self):
+            time.sleep(0.01)
+            return growth.__get__(self)
+          population_growth = property(slow_growth,growth.__set__)
+        slow_planet = SlowPlanet(initial_state = planet.to_dict())
+        grown = []
+        for n in xrange(5):
+          later = now + (n + 1) * 10 * 60
+          before = slow_planet.population
+          readers = [threading.Thread(target = lazy_game.evaluate_populations,args = ([slow_planet],),kwargs = {'now': later}) for i in xrange(4)]
+          for reader in readers:
+            reader.start()
+          for reader in readers:
+            reader.join()
+          grown.append(slow_planet.population - before)
+        print "\tpopulation grew by %s when read by 4 threads at once" % sorted(set(grown))
+        self.result = "return_true" if stamped and populations == [1050,1050] and idle_writes == 0 and stored == 1000 and ticked == 0 and set(grown) == set([50]) else "return_false"
+    
+      if actions[1] == "scan":
+        #Scan around the test ship, checked against loading every sector within 2 warps
+        test_player = game_obj.get_player_by_id("email@email.com")
+        ship = game_obj.get_parent(test_player)
+        first = game_obj.scan(test_player)
+        game_obj.move_ship(ship,choice(game_obj.get_available_warps(ship = ship)))
+        centre = game_obj.get_parent(ship)
+        game_obj.cache.clear()
+        metrics.begin_request()
+        scanned = game_obj.scan(game_obj.get_player_by_id("email@email.com"))
+        reads,writes = metrics.end_request()
+        cluster = game_obj.load_object(centre.cluster_name)
+        x = cluster.x
+        row,column = (int(centre.name) - 1) // x,(int(centre.name) - 1) % x
+        names = ["%s-%s" % (centre.cluster_name,n) for n in xrange(1,x * cluster.y + 1) if max(abs((n - 1) // x - row),abs((n - 1) % x - column)) <= 2]
+        expected = []
+        for s in game_obj.get_sectors(names,create = False):
+          found = sorted(str(c.id) for c in game_obj.get_children(s) if c.type in ("Planet","Ship"))
+          if found:
+            expected.append((str(s),found))
+        got = sorted((name,sorted(str(e.id) for e in entities)) for name,distance,entities in scanned.sectors)
+        print "\tscan of %s found %s, with %s reads" % (scanned.centre,[(name,distance,entities) for name,distance,entities in scanned.sectors],reads)
+        
+        #Only the player's location and what is in it can be targeted
+        elsewhere = [s for s in game_obj.get_sectors(names,create = False) if str(s.id) != str(centre.id)][0]
+        targets = [game_obj.scan(test_player,target_id = centre.id) is not None,game_obj.scan(test_player,target_id = elsewhere.id) is not None]
+        print "\tscan targeting the location and %s: %s" % (elsewhere,targets)
+        
+        #A move made while a cluster is being loaded is applied over the sectors loaded before it
+        index = spatial.SpatialIndex()
+        index.begin_cluster(cluster.name)
+        index.moved(ship,elsewhere,centre)
+        index.add_cluster(cluster,game_obj.get_sectors(names,create = False),{str(centre.id):[ship]})
+        replayed = "Ship" in index.types_at(cluster.name,int(elsewhere.name)) and "Ship" not in index.types_at(cluster.name,int(centre.name))
+        print "\tmove during the load replayed: %s" % replayed
+        self.result = "return_true" if first and got == sorted(expected) and any(ship in entities for name,distance,entities in scanned.sectors if distance == 0) and reads <= 4 + sum(len(e) for n,d,e in scanned.sectors) and targets == [True,False] and replayed else "return_false"
+    
+      if actions[1] == "map":
+        #Draw the test player's cluster, move the ship and draw it again
+        test_player = game_obj.get_player_by_id("email@email.com")
+        ship = game_obj.get_parent(test_player)
+        game_obj.visualize_cluster(test_player)
+        game_obj.move_ship(ship,choice(game_obj.get_available_warps(ship = ship)))
+        drawn = game_obj.map.drawn
+        lines = game_obj.visualize_cluster(test_player)
+        redrawn = game_obj.map.drawn - drawn
+        here = game_obj.get_parent(ship)
+        map_cluster = game_obj.load_object(here.cluster_name)
+        expected = []
+        for s in game_obj.get_sectors(["%s-%s" % (map_cluster.name,n) for n in xrange(1,map_cluster.x * map_cluster.y + 1)],create = False):
+          types = set(c.type for c in game_obj.get_children(s))
+          expected.append("@" if s.name == here.name else "*" if types >= set(["Planet","Ship"]) else "P" if "Planet" in types else "S" if "Ship" in types else "+" if types else ".")
+        drawn_tiles = [tile for line in lines for tile in line.split(" ")]
+        window = game_obj.get_view(test_player).map
+        print "\tmap of %s after moving to %s redrew %s tiles:\n\t  %s" % (map_cluster,here,redrawn,"\n\t  ".join(lines))
+        self.result = "return_true" if drawn_tiles == expected and redrawn <= 2 and [here for row in window for name,tile,here in row].count(True) == 1 and len(window) <= 7 else "return_false"
+    
+    if actions[0] == "get" and actions[1] == "cached":
+      hits = game_obj.cache.hits
+      first = game_obj.get_player_by_id(actions[2])
+      second = game_obj.get_player_by_id(actions[2])
+      print "\tcache has %s objects, %s hits and %s misses" % (len(game_obj.cache),game_obj.cache.hits,game_obj.cache.misses)
+      self.result = "return_true" if first is second and game_obj.cache.hits > hits else "return_false"
+    
+    elif actions[0] == "get" and actions[1] == "warps":
+      #The second listing finds every sector in the cache by name
+      ship = game_obj.get_parent(game_obj.get_player_by_id(actions[2]))
+      game_obj.get_available_warps(ship = ship)
+      reads = metrics.storage_reads.value()
+      warps = game_obj.get_available_warps(ship = ship)
+      reads = metrics.storage_reads.value() - reads
+      print "\tlisted warps %s with %s reads" % (warps,reads)
+      
+      #A link to a cluster that doesn't exist is left out, and the other warps are still listed
+      location = str(game_obj.get_parent(ship))
+      links = game_obj.links.get(location)
+      game_obj.links[location] = (links or []) + ["missing-1"]
+      try:
+        linked = game_obj.get_available_warps(ship = ship,read_only = True)
+      finally:
+        if links is None:
+          del game_obj.links[location]
+        else:
+          game_obj.links[location] = links
+      print "\twith a link to a missing cluster, listed warps %s" % linked
+      self.result = "return_true" if warps and reads == 0 and [str(s) for s in linked] == [str(s) for s in warps] else "return_false"
+    
+    elif actions[0] == "get" and actions[1] == "view":
+      view = game_obj.get_view(game_obj.get_player_by_id(actions[2]))
+      print "\tview of %s shows %s with children %s and warps %s" % (view.player,view.location,list(view.children),list(view.warps))
+      self.result = "return_true" if view.ship in view.children and view.warps else "return_false"
+    
+    elif actions[0] == "get":
       loaded_object = None
       if actions[1] == "player":
         if len(actions[2]) > 0:
@@ -110,6 +743,106 @@ move_ship = Test("move a ship to an adjacent sector")
 move_ship.add(Action("Move Ship","move ship","return_true"))
 tests.append(move_ship)
 
+reload_index = Test("load objects by name from the name index")
+reload_index.add(Action("Reload Index","create index","return_true"))
+tests.append(reload_index)
+
+accented_names = Test("sign up and look up players with accented names")
+accented_names.add(Action("Accented Names","create accented","return_true"))
+tests.append(accented_names)
+
+cached_player = Test("load the same player object from the cache")
+cached_player.add(Action("Load Cached Player","get cached email@email.com","return_true"))
+tests.append(cached_player)
+
+cached_warps = Test("list warps from sectors in the cache")
+cached_warps.add(Action("Cached Warps","get warps email@email.com","return_true"))
+tests.append(cached_warps)
+
+sqlite_db = Test("save and load objects with the SQLite database")
+sqlite_db.add(Action("SQLite Database","create sqlite","return_true"))
+tests.append(sqlite_db)
+
+journalled_bang = Test("delete a universe while the journal is in use")
+journalled_bang.add(Action("Journalled Big Bang","create journal","return_true"))
+tests.append(journalled_bang)
+
+log_segments = Test("reopen, repair and compact the segments of the log database")
+log_segments.add(Action("Log Segments","create segments","return_true"))
+tests.append(log_segments)
+
+codecs = Test("load objects saved with different codecs")
+codecs.add(Action("Binary Codec","create codec","return_true"))
+tests.append(codecs)
+
+allocate_sectors = Test("allocate free sectors until a cluster is full")
+allocate_sectors.add(Action("Allocate Sectors","create allocations","return_true"))
+tests.append(allocate_sectors)
+
+neighbors = Test("list the neighbouring sectors of edge sectors")
+neighbors.add(Action("Neighbour Table","create neighbors","return_true"))
+tests.append(neighbors)
+
+player_view = Test("build the view of a player's location")
+player_view.add(Action("Player View","get view email@email.com","return_true"))
+tests.append(player_view)
+
+conflict = Test("retry an assignment made from an out of date copy")
+conflict.add(Action("Conflicting Save","create conflict","return_true"))
+tests.append(conflict)
+
+writers = Test("save the same object from several threads")
+writers.add(Action("Concurrent Writers","create writers","return_true"))
+tests.append(writers)
+
+movers = Test("move ships between the same sectors from several threads")
+movers.add(Action("Concurrent Moves","create movers","return_true"))
+tests.append(movers)
+
+instrumentation = Test("count storage reads and time game operations")
+instrumentation.add(Action("Metrics","create metrics","return_true"))
+tests.append(instrumentation)
+
+eager_universe = Test("create every sector of a universe in a big bang")
+eager_universe.add(Action("Eager Big Bang","create bigbang","return_true"))
+tests.append(eager_universe)
+
+sharded = Test("hand a ship off between the workers of two clusters")
+sharded.add(Action("Sharded Clusters","create shards","return_true"))
+tests.append(sharded)
+
+notifications = Test("drop objects another game saved from the cache")
+notifications.add(Action("Change Notifications","create notify","return_true"))
+tests.append(notifications)
+
+sector_updates = Test("tell the subscribers of a sector when a ship leaves and enters")
+sector_updates.add(Action("Sector Feed","create feed","return_true"))
+tests.append(sector_updates)
+
+autopilot = Test("fly a ship along a route in one move")
+autopilot.add(Action("Autopilot","create autopilot","return_true"))
+tests.append(autopilot)
+
+route_planner = Test("plan the shortest routes between sectors as sectors are blocked")
+route_planner.add(Action("Route Planner","create routes","return_true"))
+tests.append(route_planner)
+
+population_tick = Test("grow the population of habitable planets")
+population_tick.add(Action("Population Tick","create tick","return_true"))
+tests.append(population_tick)
+
+lazy_population = Test("work out populations when they are read")
+lazy_population.add(Action("Lazy Population","create lazy","return_true"))
+tests.append(lazy_population)
+
+radius_scan = Test("scan the ships and planets near a sector")
+radius_scan.add(Action("Radius Scan","create scan","return_true"))
+tests.append(radius_scan)
+
+cluster_map = Test("draw a map of a cluster and redraw the sectors that changed")
+cluster_map.add(Action("Cluster Map","create map","return_true"))
+tests.append(cluster_map)
+
 #load_ship = Test("load the current status of a ship")
 #load_ship.add(Action("Load Ship","get ship email@email.com"))
 #tests.append(load_ship)